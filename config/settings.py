@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -132,10 +133,50 @@ ASGI_APPLICATION = 'config.asgi.application'
 # 本番環境ではRedisなどを使用
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        # InMemoryChannelLayer の期限切れの掃除を間引き（team6.channel_layers）、group_send の配信先の数の記録を足したもの
+        'BACKEND': 'team6.metrics.MeasuredInMemoryChannelLayer',
     },
 }
 
+# 3. ルーム状態ストアのバッキングストア (CACHES のエイリアス名)
+# ルーム状態はプロセス内メモリに保持し、ここで指定したキャッシュへ一定間隔で書き出す
+# None にするとバッキングストアを使わない
+TEAM6_ROOM_STATE_BACKING = 'default'
+
+# 4. 複数プロセス構成（daphne を複数起動してすべてのコアを使う場合）
+# 環境変数 TEAM6_BROKER_SOCKET に Unix ソケットのパスを指定すると、ルーム状態とチャネルレイヤーを
+# ブローカープロセス（python manage.py run_broker）経由で全プロセスが共有する。詳しくは README を参照
+TEAM6_BROKER_SOCKET = os.environ.get('TEAM6_BROKER_SOCKET') or None
+# python manage.py run_workers から起動されたワーカーでは 1 になる。ルームの接続はルームごとに
+# 1つのワーカーへ集められるので、チャネルレイヤーはプロセス内のままにし、ブローカーはルーム状態の書き出し先にだけ使う
+TEAM6_ROUTED_WORKER = os.environ.get('TEAM6_ROUTED_WORKER') == '1'
+if TEAM6_BROKER_SOCKET and not TEAM6_ROUTED_WORKER:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'team6.broker.BrokerChannelLayer',
+            'CONFIG': {'path': TEAM6_BROKER_SOCKET},
+        },
+    }
+
+# 5. 再起動をまたいで対局を続けるためのスナップショット
+# 終了時と一定間隔でルーム状態をこのファイルへ書き出し、起動後に接続し直したルームから復元する
+# 環境変数 TEAM6_SNAPSHOT_PATH で場所を変えられる（空文字にすると使わない）
+TEAM6_SNAPSHOT_PATH = os.environ.get('TEAM6_SNAPSHOT_PATH', str(BASE_DIR / 'room_snapshot.bin')) or None
+
+# 6. /metrics（Prometheus 形式のメトリクス）を読めるアドレス
+TEAM6_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# run_workers のプロキシがワーカーの /metrics を読むときに付ける合言葉（run_workers が起動ごとに作って渡す）
+# ワーカーへは Unix ソケットで接続するので接続元のアドレスがなく、アドレスの代わりにこれでプロキシを見分ける
+TEAM6_METRICS_PROXY_TOKEN = os.environ.get('TEAM6_METRICS_PROXY_TOKEN') or None
+
+# 7. サンプリング・プロファイラー（team6.profiling）
+# 環境変数 TEAM6_PROFILE=1 で起動時から有効にする。実行中は SIGUSR2 を送るたびに開始・停止できる
+TEAM6_PROFILE = os.environ.get('TEAM6_PROFILE') == '1'
+TEAM6_PROFILE_DIR = os.environ.get('TEAM6_PROFILE_DIR', str(BASE_DIR / 'profiles'))
+
+# 8. ルームのイベントをプレイヤーのチャネルへ直接送る（False なら group_send。manage.py bench_rooms での比較用）
+TEAM6_DIRECT_ROOM_SEND = True
+
 
 LOGIN_REDIRECT_URL = '/dashboard/'
 LOGOUT_REDIRECT_URL = '/login/'
\ No newline at end of file
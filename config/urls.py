@@ -30,4 +30,6 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('signup/', views.signup, name='signup'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('profile', views.profile_view, name='profile'),
 ]
\ No newline at end of file
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class Team6Config(AppConfig):
     name = 'team6'
+
+    def ready(self):
+        from . import profiling
+        profiling.install()
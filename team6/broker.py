@@ -0,0 +1,521 @@
+"""
+プロセス間ブローカー
+
+daphne を複数プロセスで動かすときに、同じホストの全プロセスで共有するものを
+1つのブローカープロセス（python manage.py run_broker）が Unix ソケット越しに提供する。
+
+    - キー・バリュー（ルーム状態。バージョン付き）
+    - ルーム単位のロック（同じルームのイベントを全プロセスで1件ずつ処理するため）
+    - チャネルレイヤー（send / group_send。BrokerChannelLayer から使う）
+    - トピックの購読と配信（全プロセスへの通知。ランキングのレートの変更など）
+
+フレームは「4バイトの長さ + JSON」。要求は [op, 要求ID, 引数...]、応答は ['r', 要求ID, 結果]、
+ブローカーからのメッセージ配送は ['m', [チャネル名...], メッセージ]、トピックの配信は ['p', トピック, メッセージ]。
+ソケットファイルは作成したユーザーだけが読み書きできるようにする。
+スナップショットのパスを渡すと、一定間隔と終了時にキー・バリューを書き出し、
+再起動後は引かれたキーをそこから復元する（team6.snapshot）。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import time
+import uuid
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .metrics import group_sends
+from .snapshot import SnapshotFile
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+GROUP_EXPIRY = 86400  # グループ登録の有効期限（秒）
+SNAPSHOT_INTERVAL = 30.0  # スナップショットを書き出す間隔（秒）
+SHUTDOWN_GRACE = 1.0      # 停止時に接続中のクライアントの残りの要求を待つ時間（秒）
+
+
+def _pack(obj):
+    body = json.dumps(obj, separators=(',', ':')).encode()
+    return _HEADER.pack(len(body)) + body
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"フレームが大きすぎます: {length}")
+    return json.loads(await reader.readexactly(length))
+
+
+# --- ブローカー本体 ---
+
+class _Connection:
+    def __init__(self, writer):
+        self.writer = writer
+        self.prefix = None
+        self.locks = set()
+        self.topics = set()
+
+    def send(self, obj):
+        if not self.writer.is_closing():
+            self.writer.write(_pack(obj))
+
+
+class BrokerServer:
+    """
+    Args:
+        path (str): Unix ソケットのパス
+        snapshot_path (str): スナップショットファイルのパス（None なら取らない）
+    """
+
+    def __init__(self, path, snapshot_path=None):
+        self.path = path
+        self._snapshot = SnapshotFile(snapshot_path) if snapshot_path else None
+        self._entries = {}     # キー -> [値, バージョン, 有効期限]
+        self._clock = 0
+        self._locks = {}       # キー -> [保持している接続, 待っている (接続, 要求ID) の deque]
+        self._groups = {}      # グループ名 -> {チャネル名: 有効期限}
+        self._prefixes = {}    # プロセスのチャネル接頭辞 -> 接続
+        self._topics = {}      # トピック -> 購読している接続の集合
+        self._handlers = set()
+
+    async def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        logger.info("broker listening on %s", self.path)
+        snapshotter = asyncio.ensure_future(self._snapshot_loop()) if self._snapshot else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # 停止時（キャンセル）は、終了したワーカーが最後に送った分を読み終えてから書き出す
+            if snapshotter is not None:
+                snapshotter.cancel()
+                if self._handlers:
+                    await asyncio.wait(self._handlers, timeout=SHUTDOWN_GRACE)
+                self._snapshot.save(self._snapshot_items())
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            if self._snapshot.changed:
+                prepared = self._snapshot.prepare(self._snapshot_items())
+                await asyncio.get_running_loop().run_in_executor(None, self._snapshot.write, prepared)
+
+    def _snapshot_items(self):
+        now = time.monotonic()
+        return [(key, entry[1], entry[0], entry[2] - now) for key, entry in self._entries.items() if entry[2] > now]
+
+    async def _handle(self, reader, writer):
+        conn = _Connection(writer)
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                op, request_id, *args = await _read_frame(reader)
+                result = getattr(self, f'op_{op}')(conn, request_id, *args)
+                if result is not _DEFERRED and request_id is not None:
+                    conn.send(['r', request_id, result])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("broker connection error")
+        finally:
+            self._handlers.discard(task)
+            self._disconnect(conn)
+            writer.close()
+
+    def _disconnect(self, conn):
+        if conn.prefix and self._prefixes.get(conn.prefix) is conn:
+            del self._prefixes[conn.prefix]
+        for key in list(conn.locks):
+            self._release(conn, key)
+        for topic in conn.topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(conn)
+                if not subscribers:
+                    del self._topics[topic]
+        for holder_and_waiters in self._locks.values():
+            waiters = holder_and_waiters[1]
+            if any(c is conn for c, _ in waiters):
+                holder_and_waiters[1] = deque((c, r) for c, r in waiters if c is not conn)
+
+    # キー・バリュー
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def op_hello(self, conn, request_id, prefix):
+        conn.prefix = prefix
+        self._prefixes[prefix] = conn
+        return True
+
+    def op_get(self, conn, request_id, key):
+        entry = self._live(key)
+        if entry is None and self._snapshot is not None:
+            restored = self._snapshot.lookup(key)
+            if restored is not None:
+                self._clock += 1
+                entry = self._entries[key] = [restored[0], self._clock, time.monotonic() + restored[1]]
+        return [None, 0] if entry is None else [entry[0], entry[1]]
+
+    def op_set(self, conn, request_id, key, value, ttl):
+        if self._snapshot is not None:
+            self._snapshot.touch(key)
+        self._clock += 1
+        if value is None:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = [value, self._clock, time.monotonic() + ttl]
+        return self._clock
+
+    def op_cas(self, conn, request_id, key, version, value, ttl):
+        entry = self._live(key)
+        if (entry[1] if entry else 0) != version:
+            return False
+        self.op_set(conn, request_id, key, value, ttl)
+        return True
+
+    # ロック
+
+    def op_lock(self, conn, request_id, key):
+        holder = self._locks.get(key)
+        if holder is None:
+            self._locks[key] = [conn, deque()]
+            conn.locks.add(key)
+            return True
+        holder[1].append((conn, request_id))
+        return _DEFERRED
+
+    def op_unlock(self, conn, request_id, key):
+        self._release(conn, key)
+        return True
+
+    def _release(self, conn, key):
+        holder = self._locks.get(key)
+        if holder is None or holder[0] is not conn:
+            return
+        conn.locks.discard(key)
+        waiters = holder[1]
+        if not waiters:
+            del self._locks[key]
+            return
+        next_conn, next_request = waiters.popleft()
+        holder[0] = next_conn
+        next_conn.locks.add(key)
+        next_conn.send(['r', next_request, True])
+
+    # チャネルレイヤー
+
+    def _deliver(self, channels, message):
+        by_conn = {}
+        for channel in channels:
+            conn = self._prefixes.get(channel.split('!', 1)[0])
+            if conn is not None:
+                by_conn.setdefault(conn, []).append(channel)
+        for conn, names in by_conn.items():
+            conn.send(['m', names, message])
+
+    def op_send(self, conn, request_id, channel, message):
+        self._deliver([channel], message)
+        return True
+
+    def op_group_add(self, conn, request_id, group, channel):
+        self._groups.setdefault(group, {})[channel] = time.monotonic() + GROUP_EXPIRY
+        return True
+
+    def op_group_discard(self, conn, request_id, group, channel):
+        members = self._groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self._groups[group]
+        return True
+
+    def op_group_send(self, conn, request_id, group, message):
+        members = self._groups.get(group)
+        if not members:
+            return True
+        now = time.monotonic()
+        for channel in [c for c, expires in members.items() if expires <= now]:
+            del members[channel]
+        self._deliver(list(members), message)
+        return True
+
+    # トピック
+
+    def op_subscribe(self, conn, request_id, topic):
+        self._topics.setdefault(topic, set()).add(conn)
+        conn.topics.add(topic)
+        return True
+
+    def op_publish(self, conn, request_id, topic, message):
+        for subscriber in self._topics.get(topic, ()):
+            subscriber.send(['p', topic, message])
+        return True
+
+    def op_flush(self, conn, request_id):
+        self._entries.clear()
+        self._groups.clear()
+        return True
+
+
+_DEFERRED = object()
+
+
+# --- クライアント ---
+
+class BrokerClient:
+    """
+    ブローカーへの接続（プロセス・イベントループごとに1本）
+
+    Attributes:
+        prefix (str): このプロセス宛てのチャネル名の接頭辞
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.prefix = f"p{uuid.uuid4().hex[:12]}"
+        self._reader = None
+        self._writer = None
+        self._pending = {}
+        self._next_id = 0
+        self._connecting = None
+        self._handlers = []
+        self._subscriptions = {}  # トピック -> 受け取る関数のリスト
+
+    def on_message(self, handler):
+        """ブローカーから配送されたメッセージを受け取る関数を登録する: handler(チャネル名のリスト, メッセージ)"""
+        self._handlers.append(handler)
+
+    async def _connect(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.get_running_loop().create_task(self._open())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        asyncio.get_running_loop().create_task(self._read_loop(self._reader))
+        self._writer.write(_pack(['hello', None, self.prefix]))
+        # つなぎ直したとき（ブローカーの再起動など）は購読し直す
+        for topic in self._subscriptions:
+            self._writer.write(_pack(['subscribe', None, topic]))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                if frame[0] == 'r':
+                    future = self._pending.pop(frame[1], None)
+                    if future is not None and not future.done():
+                        future.set_result(frame[2])
+                elif frame[0] == 'p':
+                    for handler in self._subscriptions.get(frame[1], ()):
+                        handler(frame[2])
+                else:
+                    for handler in self._handlers:
+                        handler(frame[1], frame[2])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("broker connection closed")
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("broker connection closed"))
+            self._pending.clear()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    async def call(self, op, *args):
+        """要求を送り、応答を待つ"""
+        await self._connect()
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        self._writer.write(_pack([op, self._next_id, *args]))
+        return await future
+
+    async def cast(self, op, *args):
+        """要求を送るだけで応答を待たない（送信順はブローカー側で保たれる）"""
+        await self._connect()
+        self._writer.write(_pack([op, None, *args]))
+
+    async def subscribe(self, topic, handler):
+        """
+        トピックに publish されたメッセージを受け取る関数を登録する: handler(メッセージ)
+
+        同じ関数を何度登録しても1回だけ呼ばれる。handler はイベントループ上で呼ばれるので、待たずに終わること
+        """
+        handlers = self._subscriptions.setdefault(topic, [])
+        if handler not in handlers:
+            handlers.append(handler)
+        await self.call('subscribe', topic)
+
+    # キー・バリューとロック
+
+    async def get_versioned(self, key):
+        value, version = await self.call('get', key)
+        return value, version
+
+    async def set(self, key, value, ttl):
+        await self.cast('set', key, value, ttl)
+
+    async def compare_and_set(self, key, version, value, ttl):
+        return await self.call('cas', key, version, value, ttl)
+
+    def lock(self, key):
+        """async with client.lock(key): ... の形で使う"""
+        return _BrokerLock(self, key)
+
+
+class _BrokerLock:
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+
+    async def __aenter__(self):
+        await self.client.call('lock', self.key)
+
+    async def __aexit__(self, *exc):
+        await self.client.cast('unlock', self.key)
+
+
+def cast_now(path, requests):
+    """
+    イベントループの外（プロセス終了時など）から要求をまとめて送る。応答は待たない
+
+    Args:
+        path (str): ブローカーのソケットのパス
+        requests (list): (op, 引数...) のリスト
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(b''.join(_pack([op, None, *args]) for op, *args in requests))
+
+
+_clients = {}
+
+
+def get_client(path):
+    """このイベントループ用のクライアントを返す（なければ作る）"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get((path, loop))
+    if client is None:
+        for stale in [k for k in _clients if k[1].is_closed()]:
+            del _clients[stale]
+        client = _clients[(path, loop)] = BrokerClient(path)
+    return client
+
+
+# --- チャネルレイヤー ---
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    ブローカー経由で複数プロセスにまたがってメッセージを届けるチャネルレイヤー
+
+    settings.CHANNEL_LAYERS の例:
+        'BACKEND': 'team6.broker.BrokerChannelLayer',
+        'CONFIG': {'path': '/tmp/team6-broker.sock'},
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = path
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self._queues = {}
+        self._client = None
+
+    def _get_client(self):
+        client = get_client(self.path)
+        if client is not self._client:
+            self._client = client
+            self._queues = {}
+            client.on_message(self._dispatch)
+        return client
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _dispatch(self, channels, message):
+        for channel in channels:
+            queue = self._queue(channel)
+            if queue.full():
+                # 受け取られていないチャネル（切断済みなど）の古いメッセージを捨てる
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def new_channel(self, prefix='specific'):
+        client = self._get_client()
+        await client._connect()
+        return f"{client.prefix}!{prefix}.{uuid.uuid4().hex}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        client = self._get_client()
+        if channel.startswith(client.prefix + '!'):
+            # 同じプロセス宛てはブローカーを経由しない
+            queue = self._queue(channel)
+            if queue.full():
+                raise ChannelFull(channel)
+            queue.put_nowait(message)
+            return
+        await client.cast('send', channel, message)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._get_client()
+        queue = self._queue(channel)
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # コンシューマーの終了: 空のキューは残さない
+            if queue.empty() and self._queues.get(channel) is queue:
+                del self._queues[channel]
+            raise
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._get_client().call('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._get_client().call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        # 配信先の数はブローカー側でしか分からないので、ここでは回数だけ数える
+        group_sends.inc('broker')
+        await self._get_client().cast('group_send', group, message)
+
+    async def flush(self):
+        await self._get_client().call('flush')
+        self._queues = {}
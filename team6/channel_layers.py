@@ -0,0 +1,39 @@
+"""
+プロセス内のチャネルレイヤー
+
+channels の InMemoryChannelLayer は receive と group_send のたびに _clean_expired を呼び、
+全チャネルのキューと全グループのメンバーを見て期限切れを掃除する。1件の送受信のたびに
+接続数に比例した走査が入るので、接続が増えるほど1手の配信が遅くなる（manage.py bench_rooms で見える）。
+
+ThrottledInMemoryChannelLayer はこの掃除を CLEAN_INTERVAL に1回までにする。
+メッセージの期限は60秒、グループの期限は1日なので、掃除が CLEAN_INTERVAL 遅れても
+期限切れのメッセージやメンバーが残る時間がその分延びるだけで、届くメッセージは変わらない。
+
+_clean_expired は channels の非公開のメソッドなので、上書きはこのクラスだけに閉じ込めておく。
+channels の更新でなくなった場合は掃除を間引けなくなるだけで、動作は元の InMemoryChannelLayer と同じになる。
+"""
+
+import logging
+import time
+
+from channels.layers import InMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+CLEAN_INTERVAL = 1.0  # 期限切れのメッセージとグループのメンバーを掃除する間隔（秒）
+
+if not hasattr(InMemoryChannelLayer, '_clean_expired'):
+    logger.warning("InMemoryChannelLayer._clean_expired がないため、期限切れの掃除を間引けません")
+
+
+class ThrottledInMemoryChannelLayer(InMemoryChannelLayer):
+    """期限切れの掃除を CLEAN_INTERVAL に1回までにした InMemoryChannelLayer"""
+
+    _last_clean = 0.0
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self._last_clean < CLEAN_INTERVAL:
+            return
+        self._last_clean = now
+        super()._clean_expired()
@@ -1,66 +1,70 @@
 import json
+import logging
 import uuid
 import hashlib
 import random
-from .game_logic.ecard import ECard
+from .game_logic.ecard import ROUNDS, ECardMatch, bot_card
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.core.cache import cache
-from django.contrib.auth.models import User
 from .models import UserProfile
 from team6.game_logic.tictactoe import TicTacToe
+from .game_logic import move_codec, tictactoe_ai
+from .matchmaking import BOT_NAME, BOT_ROOM_PREFIX, matchmaking
+from .metrics import MetricsMixin
+from .protocol import DeltaStateMixin, encode_frame
+from .ratings import DEFAULT_RATING, record_result
+from .records import record_game
+from .resume import ResumeMixin
+from .rooms import RoomMemberMixin
+from .spectators import SpectatorMixin
+from .timers import TurnTimerMixin
+
+logger = logging.getLogger(__name__)
+
+# --- 1. マッチング用 (レート帯つき待機列) ---
+class MatchmakingConsumer(MetricsMixin, AsyncWebsocketConsumer):
+    metrics_game = 'matchmaking'
 
-# --- 1. マッチング用 (不具合修正版) ---
-class MatchmakingConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
+        self.game = self.scope['url_route']['kwargs'].get('game', 'tictactoe')
         if not self.user.is_authenticated:
             await self.close()
             return
         await self.accept()
 
-        # 現在の待機情報を取得
-        waiting_data = await database_sync_to_async(cache.get)("waiting_player_data")
-
-        # マッチング条件: 待機者がいて、かつ自分自身ではないこと
-        if waiting_data and waiting_data['username'] != self.user.username:
-            # マッチング成立！ 待機列を即座にクリア
-            await database_sync_to_async(cache.delete)("waiting_player_data")
-            
-            new_room_name = f"match_{uuid.uuid4().hex[:8]}"
-            
-            # 自分に通知
+        rating = await self.get_rating()
+        matched = await matchmaking.join(self.game, self.user.username, self.channel_name, rating)
+        if not matched:
             await self.send(text_data=json.dumps({
-                'type': 'match_found', 'room_name': new_room_name
+                'type': 'waiting',
+                'queue_depth': len(matchmaking.queues[self.game])
             }))
-            # 相手(待機者)に通知
-            await self.channel_layer.send(
-                waiting_data['channel_name'],
-                {'type': 'match_found_event', 'room_name': new_room_name}
-            )
-        else:
-            # 待機列に自分を登録 (重複を防ぐため上書き)
-            new_waiting_data = {
-                'channel_name': self.channel_name,
-                'username': self.user.username
-            }
-            await database_sync_to_async(cache.set)("waiting_player_data", new_waiting_data, 60)
-            await self.send(text_data=json.dumps({'type': 'waiting'}))
 
     async def disconnect(self, close_code):
         # 自分が待機者だった場合、接続が切れたら待機列から削除（ゴースト防止）
-        waiting_data = await database_sync_to_async(cache.get)("waiting_player_data")
-        if waiting_data and waiting_data['channel_name'] == self.channel_name:
-            await database_sync_to_async(cache.delete)("waiting_player_data")
+        if self.user.is_authenticated:
+            matchmaking.leave(self.game, self.channel_name)
+
+    @database_sync_to_async
+    def get_rating(self):
+        rating = UserProfile.objects.filter(user=self.user).values_list('rating', flat=True).first()
+        return rating if rating is not None else DEFAULT_RATING
 
     async def match_found_event(self, event):
         await self.send(text_data=json.dumps({
-            'type': 'match_found', 'room_name': event['room_name']
+            'type': 'match_found', 'room_name': event['room_name'], 'game': event['game']
         }))
 
 # --- 2. ゲーム対戦用 (再入室対応版) ---
-class TicTacToeConsumer(AsyncWebsocketConsumer):
+class TicTacToeConsumer(MetricsMixin, SpectatorMixin, TurnTimerMixin, ResumeMixin, RoomMemberMixin,
+                        DeltaStateMixin, AsyncWebsocketConsumer):
+    metrics_game = 'tictactoe'
+
     async def connect(self):
+        self.setup_state_sync()
+        self.setup_spectator()
+        self.setup_resume()
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         # 修正ポイント: 日本語のルーム名を英数字のハッシュ値に変換する
         # unicodeのルーム名を直接使うとエラーになるため、sha256などで英数字のみの文字列にする
@@ -71,14 +75,47 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
         if not self.user.is_authenticated:
             await self.close()
             return
+        if self.spectating:
+            # 観戦者はプレイヤーのグループに入らず、リレーから間引いた状態を受け取る
+            await self.start_spectating(f"game_state_{self.room_name}")
+            return
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
 
-        room_key = f"game_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        # ルームの状態はアクターが所有し、読み書きはすべてアクター内で直列に行う
+        await self.enter_room(f"game_state_{self.room_name}")
+        await self.room.submit(self.join_room)
 
-        if not room_data:
+    async def join_room(self, room):
+        # 再接続なら猶予を取り消し、見逃した差分だけを送る（この後の配信は差分になる）
+        await self.resume_session(room)
+        room_data = room.state
+
+        if not room_data and self.room_name.startswith(BOT_ROOM_PREFIX):
+            # マッチング待ちがタイムアウトした人向けの CPU 対戦ルーム
+            players = [self.user.username, BOT_NAME]
+            random.shuffle(players)
+            room_data = {
+                'board': [' ' for _ in range(9)],
+                'current_player': 'X',
+                'player_x': players[0],
+                'player_o': players[1],
+                'bot': 'X' if players[0] == BOT_NAME else 'O', # CPU のマーク
+                'game_over': False,
+                'winner': None,
+                'winning_line': [],
+                'moves': [],
+                'ratings_updated': False
+            }
+            room.state = room_data
+            await self.send_room({
+                'type': 'game_start_event',
+                'player_x': room_data['player_x'],
+                'player_o': room_data['player_o']
+            })
+            self.play_bot_move(room_data)
+        elif not room_data:
             # 最初の1人目
             room_data = {
                 'board': [' ' for _ in range(9)],
@@ -89,8 +126,10 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
                 'game_over': False,
                 'winner': None,
                 'winning_line': [],
+                'moves': [],
                 'ratings_updated': False # レート二重更新防止フラグ
             }
+            room.state = room_data
         elif room_data['player_o'] is None and room_data['player_x'] != self.user.username:
             # 2人目が揃ったタイミングでランダムに割り振る
             players = [room_data.pop('player_wait'), self.user.username]
@@ -100,23 +139,28 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
             room_data['player_o'] = players[1] # 後攻
 
             # 全員に開始演出を通知
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'game_start_event',
-                    'player_x': room_data['player_x'],
-                    'player_o': room_data['player_o']
-                }
-            )
+            await self.send_room({
+                'type': 'game_start_event',
+                'player_x': room_data['player_x'],
+                'player_o': room_data['player_o']
+            })
         
-        # 状態を保存してブロードキャスト
-        await database_sync_to_async(cache.set)(room_key, room_data, 3600)
         await self.broadcast_state(room_data)
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        room_key = f"game_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        data = self.count_message(json.loads(text_data))
+        if self.spectating:
+            # 観戦者は操作できない
+            return
+        await self.room.submit(self.handle_message, data)
+
+    async def handle_message(self, room, data):
+        # 連番の抜けを検知したクライアントからの再同期要求
+        if data.get('type') == 'resync':
+            await self.send_snapshot(room)
+            return
+
+        room_data = room.state
 
         if not room_data:
             return
@@ -134,19 +178,14 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
                 
                 # レート更新
                 if not room_data.get('ratings_updated'):
-                    await self.handle_game_end_ratings(room_data)
+                    await self.handle_game_end(room_data)
                     room_data['ratings_updated'] = True
-                
-                await database_sync_to_async(cache.set)(room_key, room_data, 3600)
 
                 # 相手に「離脱」イベントを通知 (自分を除外するために channel_name を付与)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'opponent_retired_event',
-                        'sender_channel_name': self.channel_name
-                    }
-                )
+                await self.send_room({
+                    'type': 'opponent_retired_event',
+                    'sender_channel_name': self.channel_name
+                })
 
                 # 通常のステート更新も送る (背景の盤面などを更新するため)
                 await self.broadcast_state(room_data)
@@ -154,7 +193,7 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
 
         # リセット要求の処理
         if data.get('type') == 'reset':
-            await self.handle_reset_request(room_data, room_key)
+            await self.handle_reset_request(room_data)
             return
 
         if data.get('type') == 'move':
@@ -165,59 +204,84 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
             if self.user.username != allowed_user:
                 return
 
-            game = TicTacToe()
-            game.board = room_data['board']
-            game.current_player = current_mark
+            # 終了済みの盤面なら from_board の時点で game_over になり、着手は弾かれる
+            game = TicTacToe.from_board(room_data['board'], current_mark)
             
             position = int(data.get('position', -1))
-            if game.make_move(position)['success']:
-                res = game.get_state()
-                room_data.update({
-                    'board': res['board'],
-                    'current_player': res['current_player'],
-                    'game_over': res['game_over'],
-                    'winner': res['winner'],
-                    'winning_line': res.get('winning_line', [])
-                })
+            if game.play(position):
+                room_data.update(game.get_state())
+                room_data.setdefault('moves', []).append(position)
 
                 # --- レート更新ロジックの追加 ---
                 if room_data['game_over'] and not room_data.get('ratings_updated'):
-                    await self.handle_game_end_ratings(room_data)
+                    await self.handle_game_end(room_data)
                     room_data['ratings_updated'] = True # 更新済みフラグを立てる
 
-                await database_sync_to_async(cache.set)(room_key, room_data, 3600)
                 await self.broadcast_state(room_data)
 
+                # CPU 対戦なら続けて CPU が打つ
+                if self.play_bot_move(room_data):
+                    if room_data['game_over'] and not room_data.get('ratings_updated'):
+                        await self.handle_game_end(room_data)
+                        room_data['ratings_updated'] = True
+                    await self.broadcast_state(room_data)
+
+    def play_bot_move(self, room_data):
+        """
+        CPU の手番なら最善手を打つ（表を引くだけなので待ち時間はない）
+
+        Returns:
+            bool: CPU が打ったらTrue
+        """
+        if room_data['game_over'] or room_data.get('bot') != room_data['current_player']:
+            return False
+        game = TicTacToe.from_board(room_data['board'], room_data['current_player'])
+        position = tictactoe_ai.best_move(game)
+        game.play(position)
+        room_data.update(game.get_state())
+        room_data.setdefault('moves', []).append(position)
+        return True
+
     async def disconnect(self, close_code):
-        # ゲーム中の切断を敗北として扱う処理
-        room_key = f"game_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        if self.spectating:
+            await self.stop_spectating()
+            return
+        room = getattr(self, 'room', None)
+        if room is None:
+            return
+        await room.submit(self.leave_room)
+        await self.exit_room()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-        if room_data and not room_data['game_over'] and room_data['player_o'] is not None:
-            # ゲーム中かつ2人揃っている状態で切断された場合
-            is_me_x = (room_data['player_x'] == self.user.username)
-            room_data['winner'] = 'O' if is_me_x else 'X'
-            room_data['game_over'] = True
+    async def leave_room(self, room):
+        room_data = room.state
 
-            # 終了理由を記録 (切断による終了)
-            room_data['end_reason'] = 'retired'
-            
-            # レート更新
-            if not room_data.get('ratings_updated'):
-                await self.handle_game_end_ratings(room_data)
-                room_data['ratings_updated'] = True
-            
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
-            
-            # 残っている相手に通知を送信
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'opponent_retired_event'
-                }
-            )
+        if room_data and not room_data['game_over'] and room_data['player_o'] is not None:
+            # ゲーム中かつ2人揃っている状態で切断された場合、すぐには負けにせず再接続を待つ
+            self.mark_away(room, room_data)
+            await self.broadcast_state(room_data)
 
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+    async def forfeit_away(self, room, room_data, username):
+        # 猶予までに戻らなかった切断を敗北として扱う処理
+        if room_data['game_over']:
+            return
+        is_me_x = (room_data['player_x'] == username)
+        room_data['winner'] = 'O' if is_me_x else 'X'
+        room_data['game_over'] = True
+
+        # 終了理由を記録 (切断による終了)
+        room_data['end_reason'] = 'retired'
+
+        # レート更新
+        if not room_data.get('ratings_updated'):
+            await self.handle_game_end(room_data)
+            room_data['ratings_updated'] = True
+
+        # 残っている相手に通知を送信
+        await self.send_room({
+            'type': 'opponent_retired_event'
+        })
+        await self.broadcast_state(room_data)
 
     # リタイアイベントのブロードキャスト用
     async def opponent_retired_event(self, event):
@@ -228,7 +292,7 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
             'type': 'opponent_retired'
         }))
 
-    async def handle_reset_request(self, room_data, room_key):
+    async def handle_reset_request(self, room_data):
         """リセット投票の管理"""
         # リセット希望者リストがなければ作成
         if 'reset_requested' not in room_data:
@@ -238,8 +302,10 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
         if self.user.username in room_data['reset_requested']:
             return
 
-        # リストに自分を追加
+        # リストに自分を追加（CPU 対戦なら CPU はいつでも同意する）
         room_data['reset_requested'].append(self.user.username)
+        if room_data.get('bot'):
+            room_data['reset_requested'].append(BOT_NAME)
 
         # 全員（2人）が揃ったかチェック
         if len(room_data['reset_requested']) >= 2:
@@ -250,65 +316,47 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
                 'game_over': False,
                 'winner': None,
                 'winning_line': [],
+                'moves': [],
                 'ratings_updated': False,
                 'reset_requested': [] # リストを空に戻す
             })
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
+            room_data.pop('end_reason', None)
+            self.play_bot_move(room_data)
             await self.broadcast_state(room_data)
         else:
-            # まだ1人目なら、キャッシュを更新して現在の状況を通知
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
-            
+            # まだ1人目なら、現在の状況を通知
             # クライアント側に「相手の同意待ち」であることを伝える通知（任意）
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'game_update_event',
-                    'state': room_data
-                }
-            )
-
-    async def handle_game_end_ratings(self, room_data):
-        """勝敗に応じてレートを更新する"""
+            await self.broadcast_state(room_data)
+
+    async def handle_game_end(self, room_data):
+        """対局記録とレート更新をキューに積む（DB への書き込みはまとめて後で行う）"""
         winner = room_data['winner']
         p_x = room_data['player_x']
         p_o = room_data['player_o']
 
-        # 二人揃っていない場合は更新しない
         if not p_x or not p_o:
             return
 
-        if winner == 'X':
-            await self.update_user_ratings(p_x, p_o, is_draw=False)
-        elif winner == 'O':
-            await self.update_user_ratings(p_o, p_x, is_draw=False)
-        # 引き分けの場合は今回は変動なし（必要ならここに追加）
+        record_game(
+            'tictactoe', p_x, p_o,
+            {'X': p_x, 'O': p_o}.get(winner, winner),
+            move_codec.encode_tictactoe(room_data.get('moves', [])),
+            room_data.get('end_reason') or 'normal',
+        )
 
-    @database_sync_to_async
-    def update_user_ratings(self, winner_name, loser_name, is_draw=False):
-        """データベースを操作してレートを増減させる"""
-        try:
-            winner_user = User.objects.get(username=winner_name)
-            loser_user = User.objects.get(username=loser_name)
-            
-            w_profile = winner_user.profile
-            l_profile = loser_user.profile
-
-            if not is_draw:
-                w_profile.rating += 16
-                l_profile.rating -= 16
-                # レートがマイナスにならないようにガード
-                if l_profile.rating < 0:
-                    l_profile.rating = 0
-            
-            w_profile.save()
-            l_profile.save()
-        except Exception as e:
-            print(f"Rating update error: {e}")
+        # CPU 対戦の場合はレートを更新しない
+        if room_data.get('bot'):
+            return
+
+        score = {'X': 1.0, 'O': 0.0, 'draw': 0.5}.get(winner)
+        if score is not None:
+            record_result(p_x, p_o, score)
 
     async def handle_reset(self):
-        room_key = f"game_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        await self.room.submit(self._reset_room)
+
+    async def _reset_room(self, room):
+        room_data = room.state
         if room_data:
             room_data.update({
                 'board': [' ' for _ in range(9)],
@@ -316,22 +364,41 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
                 'game_over': False,
                 'winner': None,
                 'winning_line': [],
+                'moves': [],
                 'ratings_updated': False # リセット時はフラグも戻す
             })
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
+            room_data.pop('end_reason', None)
             await self.broadcast_state(room_data)
 
+    def turn_of(self, room_data):
+        # 2人揃った対局中の、人の手番ごと（CPU はすぐ打つので期限を設けない）
+        if not room_data or room_data['game_over'] or room_data.get('player_o') is None:
+            return None
+        if room_data.get('bot') == room_data['current_player']:
+            return None
+        return room_data['current_player'], len(room_data.get('moves', []))
+
+    async def forfeit_turn(self, room, room_data):
+        # 時間切れは手番のプレイヤーの負け
+        room_data['winner'] = 'O' if room_data['current_player'] == 'X' else 'X'
+        room_data['game_over'] = True
+        room_data['end_reason'] = 'timeout'
+
+        if not room_data.get('ratings_updated'):
+            await self.handle_game_end(room_data)
+            room_data['ratings_updated'] = True
+
+        await self.broadcast_state(room_data)
+
     async def broadcast_state(self, room_data):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {'type': 'game_update_event', 'state': room_data}
-        )
+        # 手番が変わっていればサーバー側の期限を設け直す（turn_deadline も一緒に配信する）
+        self.sync_turn_timer(self.room, room_data, self.turn_of(self.room.stream.last))
+        frames = self.room.stream.publish(room_data, self.snapshot_type)
+        await self.send_room({'type': 'game_update_event', 'frames': frames})
+        await self.publish_spectators(frames['full'])
 
     async def game_update_event(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'game_state',
-            **event['state']
-        }))
+        await self.send_frames(event['frames'])
 
     async def game_start_event(self, event):
         await self.send(text_data=json.dumps({
@@ -344,10 +411,20 @@ class TicTacToeConsumer(AsyncWebsocketConsumer):
 
 
 # team6/consumers.py の末尾に追記
+import asyncio
 from team6.game_logic.hitandblow import HitAndBlow
+from team6.game_logic.hitandblow_bot import HitAndBlowSolver
+
+class HitAndBlowConsumer(MetricsMixin, SpectatorMixin, TurnTimerMixin, ResumeMixin, RoomMemberMixin,
+                         DeltaStateMixin, AsyncWebsocketConsumer):
+    metrics_game = 'hitandblow'
+
+    snapshot_type = None
 
-class HitAndBlowConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        self.setup_state_sync()
+        self.setup_spectator()
+        self.setup_resume()
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'hb_{self.room_name}'
         self.user = self.scope["user"]
@@ -355,235 +432,481 @@ class HitAndBlowConsumer(AsyncWebsocketConsumer):
         if not self.user.is_authenticated:
             await self.close()
             return
+        if self.spectating:
+            await self.start_spectating(f"hb_state_{self.room_name}")
+            return
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
 
-        room_key = f"hb_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        await self.enter_room(f"hb_state_{self.room_name}")
+        await self.room.submit(self.join_room)
 
-        if not room_data:
+    async def join_room(self, room):
+        await self.resume_session(room)
+        room_data = room.state
+
+        if not room_data and self.room_name.startswith(BOT_ROOM_PREFIX):
+            # マッチング待ちがタイムアウトした人向けの CPU 対戦ルーム（人が先攻）
+            room_data = {
+                'phase': 'setup', 'player_x': self.user.username, 'player_o': BOT_NAME,
+                'secret_x': None, 'secret_o': random.sample(range(10), HitAndBlow().digits),
+                'current_turn': 'X', 'history': [], 'game_over': False, 'bot': 'O'
+            }
+            room.state = room_data
+            await self.send_room({'type': 'game_start_event', 'player_x': room_data['player_x'], 'player_o': room_data['player_o']})
+        elif not room_data:
             room_data = {
                 'phase': 'setup', 'player_x': self.user.username, 'player_o': None,
                 'secret_x': None, 'secret_o': None, 'current_turn': 'X',
                 'history': [], 'game_over': False
             }
+            room.state = room_data
         elif room_data['player_o'] is None and room_data['player_x'] != self.user.username:
             room_data['player_o'] = self.user.username
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {'type': 'game_start_event', 'player_x': room_data['player_x'], 'player_o': room_data['player_o']}
-            )
+            await self.send_room({'type': 'game_start_event', 'player_x': room_data['player_x'], 'player_o': room_data['player_o']})
 
-        await database_sync_to_async(cache.set)(room_key, room_data, 3600)
         await self.broadcast_state(room_data)
 
     async def disconnect(self, close_code):
-        room_key = f"hb_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        if self.spectating:
+            await self.stop_spectating()
+            return
+        room = getattr(self, 'room', None)
+        if room is None:
+            return
+        await room.submit(self.leave_room)
+        await self.exit_room()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def leave_room(self, room):
+        room_data = room.state
 
-        # ゲーム中かつ相手がいる状態で切断した場合、相手の不戦勝とする
+        # ゲーム中かつ相手がいる状態で切断した場合、猶予までに戻らなければ相手の不戦勝とする
         if room_data and not room_data.get('game_over') and room_data.get('player_o'):
-            is_x = (self.user.username == room_data['player_x'])
-            winner = room_data['player_o'] if is_x else room_data['player_x']
-            
-            room_data['game_over'] = True
-            room_data['winner'] = winner
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
-            
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'player_left_event',
-                    'left_user': self.user.username,
-                    'winner': winner
-                }
-            )
+            self.mark_away(room, room_data)
+            await self.broadcast_state(room_data)
 
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+    async def forfeit_away(self, room, room_data, username):
+        if room_data.get('game_over'):
+            return
+        is_x = (username == room_data['player_x'])
+        winner = room_data['player_o'] if is_x else room_data['player_x']
+
+        room_data['game_over'] = True
+        room_data['winner'] = winner
+        room_data['end_reason'] = 'retired'
+        self.save_record(room_data, 'retired')
+
+        await self.send_room({
+            'type': 'player_left_event',
+            'left_user': username,
+            'winner': winner
+        })
+        await self.broadcast_state(room_data)
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        room_key = f"hb_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
+        data = self.count_message(json.loads(text_data))
+        if self.spectating:
+            # 観戦者は操作できない
+            return
+        await self.room.submit(self.handle_message, data)
+
+    async def handle_message(self, room, data):
+        # 連番の抜けを検知したクライアントからの再同期要求
+        if data.get('type') == 'resync':
+            await self.send_snapshot(room)
+            return
+
+        room_data = room.state
 
         if not room_data or room_data['game_over']: return
 
         if data['type'] == 'set_secret':
+            # 数字を決められるのは準備中だけ（重複のある数字列だと CPU の候補が尽きる）
+            code = self.parse_code(data.get('value'))
+            if room_data['phase'] != 'setup' or code is None:
+                return
             if self.user.username == room_data['player_x']:
-                room_data['secret_x'] = data['value']
+                room_data['secret_x'] = code
             else:
-                room_data['secret_o'] = data['value']
+                room_data['secret_o'] = code
             if room_data['secret_x'] and room_data['secret_o']:
                 room_data['phase'] = 'playing'
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
             await self.broadcast_state(room_data)
 
+            if await self.play_bot_guess(room, room_data):
+                await self.broadcast_state(room_data)
+
         elif data['type'] == 'guess':
-            hb = HitAndBlow()
-            is_x = (self.user.username == room_data['player_x'])
-            secret = room_data['secret_o'] if is_x else room_data['secret_x']
-            result = hb.calculate_result(secret, data['value'])
-            room_data['history'].append({'user': self.user.username, 'guess': "".join(map(str, data['value'])), 'hit': result['hit'], 'blow': result['blow']})
-            if result['hit'] == 3:
-                room_data['game_over'] = True
-                room_data['winner'] = self.user.username
-            else:
-                room_data['current_turn'] = 'O' if is_x else 'X'
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
+            # 手番バリデーション
+            mark = 'X' if self.user.username == room_data['player_x'] else 'O'
+            code = self.parse_code(data.get('value'))
+            if room_data['phase'] != 'playing' or room_data['current_turn'] != mark or code is None:
+                return
+            self.apply_guess(room_data, mark, code)
             await self.broadcast_state(room_data)
 
+            # CPU 対戦なら続けて CPU が予想する
+            if await self.play_bot_guess(room, room_data):
+                await self.broadcast_state(room_data)
+
+    @staticmethod
+    def parse_code(value):
+        """
+        クライアントから届いた数字列を検証する
+
+        Returns:
+            list: 桁数が合い、重複のない数字の列ならそのリスト。そうでなければ None
+        """
+        if not isinstance(value, list) or not all(type(d) is int for d in value):
+            return None
+        return value if HitAndBlow().is_valid_input(value) else None
+
+    def apply_guess(self, room_data, mark, guess):
+        """
+        予想を判定して履歴に追加し、勝敗判定と手番の交代を行う
+
+        Returns:
+            dict: {'hit': 数, 'blow': 数}
+        """
+        hb = HitAndBlow()
+        username = room_data['player_x'] if mark == 'X' else room_data['player_o']
+        secret = room_data['secret_o'] if mark == 'X' else room_data['secret_x']
+        result = hb.calculate_result(secret, guess)
+        room_data['history'].append({'user': username, 'guess': "".join(map(str, guess)), 'hit': result['hit'], 'blow': result['blow']})
+        if result['hit'] == hb.digits:
+            room_data['game_over'] = True
+            room_data['winner'] = username
+            self.save_record(room_data, 'normal')
+        else:
+            room_data['current_turn'] = 'O' if mark == 'X' else 'X'
+        return result
+
+    def save_record(self, room_data, end_reason):
+        """終了した対局を記録用のキューに積む"""
+        digits = HitAndBlow().digits
+        unset = [0xF] * digits  # 正解を決める前に終わった場合
+        moves = move_codec.encode_hitandblow(
+            digits,
+            [int(d) for d in room_data['secret_x'] or unset],
+            [int(d) for d in room_data['secret_o'] or unset],
+            [[int(c) for c in entry['guess']] for entry in room_data['history']],
+        )
+        record_game('hitandblow', room_data['player_x'], room_data['player_o'],
+                    room_data['winner'], moves, end_reason)
+
+    async def play_bot_guess(self, room, room_data):
+        """
+        CPU の手番なら予想する
+
+        候補の絞り込みは NumPy で数ミリ秒だが、初回の判定表の作成などで
+        イベントループを止めないようにスレッドで実行する。
+
+        Returns:
+            bool: CPU が予想した（または予想できずに対局を終えた）らTrue
+        """
+        mark = room_data.get('bot')
+        if (not mark or room_data['game_over'] or room_data['phase'] != 'playing'
+                or room_data['current_turn'] != mark):
+            return False
+
+        solver = getattr(room, 'hb_solver', None)
+        bot_entries = [entry for entry in room_data['history'] if entry['user'] == BOT_NAME]
+        if solver is None or solver.observed != len(bot_entries):
+            # ルームのアクターが作り直された場合（共有モードで別のプロセスが進めた場合も）は履歴から候補を復元する
+            solver = room.hb_solver = HitAndBlowSolver(HitAndBlow().digits)
+            for entry in bot_entries:
+                solver.observe([int(c) for c in entry['guess']], entry['hit'], entry['blow'])
+
+        try:
+            guess = await asyncio.get_running_loop().run_in_executor(None, solver.next_guess)
+        except ValueError:
+            # 判定結果に矛盾がある（CPU の手番のまま止まらないように、勝敗なしで終える）
+            logger.exception("CPU の予想に失敗しました: %s", room.key)
+            room.hb_solver = None
+            room_data['game_over'] = True
+            room_data['winner'] = 'draw'
+            self.save_record(room_data, 'normal')
+            return True
+        result = self.apply_guess(room_data, mark, guess)
+        solver.observe(guess, result['hit'], result['blow'])
+        return True
+
+    def turn_of(self, room_data):
+        # 数字を決める間は2人まとめて1つの期限、予想は人の手番ごと
+        if not room_data or room_data['game_over'] or not room_data.get('player_o'):
+            return None
+        if room_data['phase'] == 'setup':
+            return ('setup',)
+        if room_data['current_turn'] == room_data.get('bot'):
+            return None
+        return room_data['current_turn'], len(room_data['history'])
+
+    async def forfeit_turn(self, room, room_data):
+        if room_data['phase'] == 'setup':
+            # 数字を決めなかった方の負け（どちらも決めなかったら引き分け）
+            late = [mark for mark in ('x', 'o') if room_data[f'secret_{mark}'] is None]
+            if len(late) == 1:
+                room_data['winner'] = room_data['player_o'] if late == ['x'] else room_data['player_x']
+            else:
+                room_data['winner'] = 'draw'
+        else:
+            # 予想しなかった手番のプレイヤーの負け
+            room_data['winner'] = room_data['player_o'] if room_data['current_turn'] == 'X' else room_data['player_x']
+        room_data['game_over'] = True
+        room_data['end_reason'] = 'timeout'
+        self.save_record(room_data, 'timeout')
+        await self.broadcast_state(room_data)
+
     async def broadcast_state(self, room_data):
+        self.sync_turn_timer(self.room, room_data, self.turn_of(self.room.stream.last))
         clean_data = room_data.copy()
         clean_data['secret_x_set'] = room_data['secret_x'] is not None
         clean_data['secret_o_set'] = room_data['secret_o'] is not None
         if 'secret_x' in clean_data: del clean_data['secret_x']
         if 'secret_o' in clean_data: del clean_data['secret_o']
-        await self.channel_layer.group_send(self.room_group_name, {'type': 'game_update', 'state': clean_data})
+        frames = self.room.stream.publish(clean_data, self.snapshot_type)
+        await self.send_room({'type': 'game_update', 'frames': frames})
+        await self.publish_spectators(frames['full'])
 
     async def game_update(self, event):
-        await self.send(text_data=json.dumps(event['state']))
+        await self.send_frames(event['frames'])
 
     async def game_start_event(self, event):
         await self.send(text_data=json.dumps({'type': 'game_start', 'player_x': event['player_x'], 'player_o': event['player_o']}))
 
     async def player_left_event(self, event):
         await self.send(text_data=json.dumps({'type': 'player_left', 'left_user': event['left_user'], 'winner': event['winner']}))
-import json
-from channels.generic.websocket import AsyncWebsocketConsumer
-from django.core.cache import cache
-from channels.db import database_sync_to_async
-from .game_logic.ecard import ECard
+class ECardConsumer(MetricsMixin, SpectatorMixin, TurnTimerMixin, RoomMemberMixin, AsyncWebsocketConsumer):
+    metrics_game = 'ecard'
 
-class ECardConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'ecard_{self.room_name}'
         self.user = self.scope["user"]
+        self.setup_spectator()
+        if self.spectating:
+            # 観戦者には手札を伏せた状態だけを送る
+            await self.start_spectating(f"ecard_state_{self.room_name}")
+            return
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
 
-        cache_key = f"ecard_state_{self.room_name}"
-        game_data = await database_sync_to_async(cache.get)(cache_key)
+        await self.enter_room(f"ecard_state_{self.room_name}")
+        await self.room.submit(self.join_room)
 
-        if not game_data:
-            game_data = {
-                'players': {}, 
-                'hands': {}, 
-                'current_battle': {}, 
-                'game_over': False,
-                'points': {}
-            }
-        
-        # 終了状態なら対戦カードのみリセット（ポイントは維持）
-        if game_data.get('game_over'):
-            game_data['current_battle'] = {}
-            game_data['game_over'] = False
+    async def disconnect(self, close_code):
+        if self.spectating:
+            await self.stop_spectating()
+            return
+        if getattr(self, 'room', None) is not None:
+            await self.exit_room()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
+    async def join_room(self, room):
+        game_data = room.state
         username = self.user.username
-        if username not in game_data['points']:
-            game_data['points'][username] = 0
-
-        # 陣営と手札の割り当て（2人まで）
-        if username not in game_data['players'] and len(game_data['players']) < 2:
-            side = 'emperor_side' if not game_data['players'] else 'slave_side'
-            game_data['players'][username] = side
-            # 手札配布
-            game_data['hands'][username] = ['E', 'C', 'C', 'C', 'C'] if side == 'emperor_side' else ['S', 'C', 'C', 'C', 'C']
-
-        await database_sync_to_async(cache.set)(cache_key, game_data, 3600)
+        before = self.turn_of(game_data)
+
+        if not game_data and self.room_name.startswith(BOT_ROOM_PREFIX):
+            # マッチング待ちがタイムアウトした人向けの CPU 対戦ルーム
+            players = [username, BOT_NAME]
+            random.shuffle(players)
+            game_data = ECardMatch(players).get_state()
+            game_data['bot'] = BOT_NAME
+        elif not game_data:
+            # 1人目: 相手が来るまで試合は始めない
+            game_data = {'players': [username]}
+        elif 'round' not in game_data and username not in game_data['players']:
+            # 2人目が来たら試合開始（先に入った人が最初の皇帝側）
+            game_data = ECardMatch(game_data['players'] + [username]).get_state()
+        elif game_data.get('game_over') and username in game_data['players']:
+            # 試合終了後に入り直したら同じ2人で新しい試合を始める
+            bot = game_data.get('bot')
+            game_data = ECardMatch(game_data['players']).get_state()
+            if bot:
+                game_data['bot'] = bot
+
+        room.state = game_data
+        await self.play_bot_card(room)
+        self.sync_turn_timer(room, game_data, before)
 
         # 2人揃ったなら全員に通知、そうでなければ自分だけに通知
-        if len(game_data['players']) == 2:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {'type': 'game_ready_event', 'game_data': game_data}
-            )
+        if 'round' in room.state:
+            await self.send_room({'type': 'game_ready_event', 'frames': self.player_frames(room.state, self.initial_state)})
+            await self.publish_spectators(await self.spectator_frame(room))
         else:
-            await self.send_individual_state(game_data)
-
-    async def send_individual_state(self, game_data):
-        username = self.user.username
-        opp_name = next((u for u in game_data['players'] if u != username), None)
-        opp_points = game_data['points'].get(opp_name, 0) if opp_name else 0
-
-        await self.send(text_data=json.dumps({
+            await self.send(text_data=encode_frame(self.initial_state(None, self.user.username)))
+
+    @staticmethod
+    def player_frames(game_data, build, *args):
+        """
+        プレイヤーごとに内容が違う（手札を含む）メッセージを、送信側でプレイヤーの数だけ JSON 化しておく
+
+        Args:
+            game_data (dict): 試合の状態
+            build: (試合, ユーザー名, *args) からメッセージ（観戦者向けは None を渡す）を作る関数
+
+        Returns:
+            dict: {'players': {ユーザー名: テキスト}, 'others': 観戦者向けのテキスト（送らないなら None）}
+        """
+        match = ECardMatch.from_state(game_data) if 'round' in game_data else None
+        deadline = game_data.get('turn_deadline')
+
+        def encode(message):
+            if deadline is not None:
+                # カードを出す期限（UNIX 時刻）
+                message['turn_deadline'] = deadline
+            return encode_frame(message)
+
+        others = build(match, None, *args)
+        return {
+            'players': {name: encode(build(match, name, *args)) for name in game_data['players']},
+            'others': encode(others) if others is not None else None,
+        }
+
+    async def send_player_frame(self, frames):
+        """player_frames で用意したものから自分の分をそのまま送る"""
+        text = frames['players'].get(self.user.username, frames['others'])
+        if text is not None:
+            await self.send(text_data=text)
+
+    @staticmethod
+    def initial_state(match, username):
+        if match is None or username not in match.players:
+            # 相手待ち、または観戦者
+            return {
+                'type': 'initial_state', 'hand': [], 'side': None,
+                'points': 0, 'opp_points': 0, 'is_ready': False
+            }
+        opp_name = next(u for u in match.players if u != username)
+        return {
             'type': 'initial_state',
-            'hand': game_data['hands'].get(username, []),
-            'side': game_data['players'].get(username),
-            'points': game_data['points'].get(username, 0),
-            'opp_points': opp_points,
-            'is_ready': len(game_data['players']) == 2
-        }))
+            'hand': match.hands[username],
+            'side': match.side_of(username),
+            'points': match.points[username],
+            'opp_points': match.points[opp_name],
+            'round': match.round,
+            'rounds': ROUNDS,
+            'played': username in match.pending,
+            'is_ready': True
+        }
 
     async def game_ready_event(self, event):
-        await self.send_individual_state(event['game_data'])
+        await self.send_player_frame(event['frames'])
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        room_key = f"hb_state_{self.room_name}"
-        room_data = await database_sync_to_async(cache.get)(room_key)
-
-        if not room_data: return
-
-        # --- 追加: リセット処理 ---
-        if data.get('type') == 'reset':
-            room_data.update({
-                'phase': 'setup',
-                'secret_x': None,
-                'secret_o': None,
-                'current_turn': 'X',
-                'history': [],
-                'game_over': False,
-                'winner': None
-            })
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
-            await self.broadcast_state(room_data)
+        data = self.count_message(json.loads(text_data))
+        if self.spectating:
+            # 観戦者は操作できない
             return
+        await self.room.submit(self.handle_message, data)
 
-        if room_data['game_over']: return
-
-        if data['type'] == 'set_secret':
-            # (既存の secret 設定ロジック)
-            if self.user.username == room_data['player_x']:
-                room_data['secret_x'] = data['value']
-            else:
-                room_data['secret_o'] = data['value']
-            if room_data['secret_x'] and room_data['secret_o']:
-                room_data['phase'] = 'playing'
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
-            await self.broadcast_state(room_data)
+    async def handle_message(self, room, data):
+        game_data = room.state
+        if not game_data or 'round' not in game_data or game_data['game_over']:
+            return
 
-        elif data['type'] == 'guess':
-            # (既存の guess 判定ロジック)
-            hb = HitAndBlow()
-            is_x = (self.user.username == room_data['player_x'])
-            secret = room_data['secret_o'] if is_x else room_data['secret_x']
-            result = hb.calculate_result(secret, data['value'])
-            room_data['history'].append({
-                'user': self.user.username, 
-                'guess': "".join(map(str, data['value'])), 
-                'hit': result['hit'], 
-                'blow': result['blow']
-            })
-            if result['hit'] == 3:
-                room_data['game_over'] = True
-                room_data['winner'] = self.user.username
-            else:
-                room_data['current_turn'] = 'O' if is_x else 'X'
-            await database_sync_to_async(cache.set)(room_key, room_data, 3600)
-            await self.broadcast_state(room_data)
+        if data.get('type') == 'play_card':
+            before = self.turn_of(game_data)
+            match = ECardMatch.from_state(game_data)
+            try:
+                result = match.play(self.user.username, data.get('card'))
+            except ValueError as e:
+                await self.send(text_data=json.dumps({'type': 'error', 'message': str(e)}))
+                return
+            game_data.update(match.get_state())
+            self.sync_turn_timer(room, game_data, before)
+            if match.game_over:
+                record_game('ecard', match.players[0], match.players[1], match.winner,
+                            move_codec.encode_ecard(match.history))
+            if result is not None:
+                await self.send_room({'type': 'round_end', 'frames': self.player_frames(game_data, self.round_result, result)})
+                await self.play_bot_card(room)
+            # 相手のカード待ちでも、観戦者にはどちらが出したかを知らせる
+            await self.publish_spectators(await self.spectator_frame(room))
+
+    async def play_bot_card(self, room):
+        """
+        CPU 対戦なら CPU のカードを先に出しておく（均衡戦略の表を引くだけ）
+
+        カードは同時に出す規則なので、先に決めても人の選択には影響しない。
+        """
+        game_data = room.state
+        bot = game_data.get('bot')
+        if not bot or game_data['game_over'] or bot in game_data['pending']:
+            return
+        match = ECardMatch.from_state(game_data)
+        match.play(bot, bot_card(match.side_of(bot), match.hands[bot]))
+        game_data.update(match.get_state())
+
+    def turn_of(self, game_data):
+        # 2人が同時に1枚ずつ出すので、出し合う1回ごとに1つの期限（ラウンドと残りの手札の枚数で決まる）
+        if not game_data or 'round' not in game_data or game_data['game_over']:
+            return None
+        return game_data['round'], len(game_data['hands'][game_data['players'][0]])
+
+    async def forfeit_turn(self, room, game_data):
+        # カードを出さなかった方の負け（どちらも出さなかったら引き分け）
+        match = ECardMatch.from_state(game_data)
+        late = [name for name in match.players if name not in match.pending]
+        match.game_over = True
+        match.winner = next(name for name in match.players if name not in late) if len(late) == 1 else 'draw'
+        game_data.update(match.get_state())
+        record_game('ecard', match.players[0], match.players[1], match.winner,
+                    move_codec.encode_ecard(match.history), 'timeout')
+        result = {'message': f"{'・'.join(late)} の時間切れ", 'round_over': True,
+                  'emperor_card': None, 'slave_card': None}
+        await self.send_room({'type': 'round_end', 'frames': self.player_frames(game_data, self.round_result, result)})
+        await self.publish_spectators(await self.spectator_frame(room))
+
+    @staticmethod
+    def round_result(match, username, result):
+        if username is None:
+            # 観戦者には送らない
+            return None
+        opp_name = next(u for u in match.players if u != username)
+        return {
+            'type': 'round_result',
+            'message': result['message'],
+            'round_over': result['round_over'],
+            'is_over': match.game_over,
+            'winner': match.winner,
+            'emperor_card': result['emperor_card'],
+            'slave_card': result['slave_card'],
+            'new_hand': match.hands.get(username, []),
+            'side': match.side_of(username),
+            'round': match.round,
+            'rounds': ROUNDS,
+            'points': match.points.get(username, 0),
+            'opp_points': match.points.get(opp_name, 0)
+        }
 
     async def round_end(self, event):
-        username = self.user.username
-        gd = event['game_data']
-        opp_name = next((u for u in gd['points'] if u != username), None)
-        await self.send(text_data=json.dumps({
-            'type': 'round_result',
-            'message': event['message'],
-            'is_over': event['is_over'],
-            'new_hand': gd['hands'].get(username, []),
-            'points': gd['points'].get(username, 0),
-            'opp_points': gd['points'].get(opp_name, 0) if opp_name else 0
-        }))
+        await self.send_player_frame(event['frames'])
+
+    async def spectator_frame(self, room):
+        """観戦用のフレーム（手札と伏せて出したカードは含めない）"""
+        game_data = room.state
+        if not game_data:
+            return None
+        if 'round' not in game_data:
+            return encode_frame({'type': 'spectator_state', 'players': game_data['players'], 'is_ready': False})
+        match = ECardMatch.from_state(game_data)
+        return encode_frame({
+            'type': 'spectator_state',
+            'players': match.players,
+            'sides': {name: match.side_of(name) for name in match.players},
+            'hand_sizes': {name: len(hand) for name, hand in match.hands.items()},
+            'played': [name for name in match.players if name in match.pending],
+            'points': match.points,
+            'history': match.history,
+            'round': match.round,
+            'rounds': ROUNDS,
+            'game_over': match.game_over,
+            'winner': match.winner,
+            'turn_deadline': game_data.get('turn_deadline'),
+            'is_ready': True
+        })
@@ -1,3 +1,20 @@
+"""
+Eカードの判定と対戦エンジン
+
+1ラウンド: 皇帝側は 皇帝1枚+市民4枚、奴隷側は 奴隷1枚+市民4枚を持ち、
+両者が同時に1枚ずつ出す。市民同士なら両方捨てて続行し、特殊カードが出たら決着する。
+1試合は ROUNDS ラウンドで、SWITCH_EVERY ラウンドごとに陣営を入れ替える。
+皇帝側が勝てば EMPEROR_WIN_POINTS 点、奴隷側が勝てば SLAVE_WIN_POINTS 点を得る。
+
+ラウンドの状態は「お互いの残り市民の枚数 k」だけで決まる（市民同士でしか続かないので両者同じ枚数）。
+各 k で「特殊カードを出すか、市民を出すか」の 2×2 のゼロ和ゲームを k の小さい方から解き、
+均衡の混合戦略を表にしておく。CPU の1手はこの表を引いて乱数を1回振るだけ。
+"""
+
+import random
+from functools import lru_cache
+
+
 class ECard:
     EMPEROR = 'E'
     CITIZEN = 'C'
@@ -22,4 +39,214 @@ class ECard:
             return "市民の勝利（皇帝側の守り）！", 'emperor_side', True
         
         # 4. 市民 vs 市民 (引き分け・継続)
-        return "市民同士、引き分け...", None, False
\ No newline at end of file
+        return "市民同士、引き分け...", None, False
+
+CITIZENS = 4            # 1ラウンドの市民カードの枚数
+ROUNDS = 12             # 1試合のラウンド数
+SWITCH_EVERY = 3        # 陣営を入れ替える間隔（ラウンド数）
+EMPEROR_WIN_POINTS = 1  # 皇帝側が勝ったときの得点
+SLAVE_WIN_POINTS = 5    # 奴隷側が勝ったときの得点
+
+SIDES = ('emperor_side', 'slave_side')
+
+
+def initial_hand(side):
+    """陣営ごとの最初の手札"""
+    special = ECard.EMPEROR if side == 'emperor_side' else ECard.SLAVE
+    return [special] + [ECard.CITIZEN] * CITIZENS
+
+
+def _solve_2x2(a, b, c, d):
+    """
+    2×2 のゼロ和ゲームを解く（行プレイヤーが最大化する）
+
+    行列は [[a, b], [c, d]]
+
+    Returns:
+        tuple: (行プレイヤーが1行目を選ぶ確率, 列プレイヤーが1列目を選ぶ確率, ゲームの値)
+    """
+    # 純粋戦略の鞍点があればそれが均衡
+    for i, row in enumerate(((a, b), (c, d))):
+        for j in range(2):
+            column = (a, c) if j == 0 else (b, d)
+            if row[j] == min(row) and row[j] == max(column):
+                return float(i == 0), float(j == 0), float(row[j])
+    denominator = a - b - c + d
+    p = (d - c) / denominator
+    q = (d - b) / denominator
+    value = (a * d - b * c) / denominator
+    return p, q, value
+
+
+@lru_cache(maxsize=None)
+def solve_round(citizens):
+    """
+    残り市民 citizens 枚の局面の均衡を求める（皇帝側から見た得点差がゲームの値）
+
+    Returns:
+        tuple: (皇帝側が皇帝を出す確率, 奴隷側が奴隷を出す確率, 皇帝側から見た期待得点差)
+    """
+    if citizens == 0:
+        # 特殊カードしか残っていない: 皇帝 対 奴隷で奴隷側の勝ち
+        return 1.0, 1.0, float(-SLAVE_WIN_POINTS)
+    continuation = solve_round(citizens - 1)[2]
+    # 行: 皇帝側（皇帝 / 市民）、列: 奴隷側（奴隷 / 市民）
+    return _solve_2x2(-SLAVE_WIN_POINTS, EMPEROR_WIN_POINTS,
+                      EMPEROR_WIN_POINTS, continuation)
+
+
+# 残り市民の枚数 -> (皇帝を出す確率, 奴隷を出す確率)
+STRATEGY = tuple(solve_round(k)[:2] for k in range(CITIZENS + 1))
+
+
+def bot_card(side, hand, rng=random):
+    """
+    CPU が出すカードを選ぶ（均衡の混合戦略の表を引く）
+
+    Args:
+        side (str): 'emperor_side' または 'slave_side'
+        hand (list): 現在の手札
+        rng: 乱数生成器（random モジュール互換）
+
+    Returns:
+        str: 出すカード
+    """
+    citizens = hand.count(ECard.CITIZEN)
+    p_emperor, p_slave = STRATEGY[citizens]
+    if side == 'emperor_side':
+        return ECard.EMPEROR if rng.random() < p_emperor else ECard.CITIZEN
+    return ECard.SLAVE if rng.random() < p_slave else ECard.CITIZEN
+
+
+class ECardMatch:
+    """
+    12ラウンドの1試合
+
+    Attributes:
+        players (list): プレイヤー名 [先に皇帝側になる人, もう1人]
+        round (int): 現在のラウンド（1から）
+        hands (dict): プレイヤー名 -> 手札
+        pending (dict): 今の手番で出されたカード（両者揃うと判定する）
+        points (dict): プレイヤー名 -> 得点
+        history (list): 決着したラウンドの結果
+        game_over (bool): 試合終了フラグ
+        winner (str): 勝者（引き分けは 'draw'、未決着は None）
+    """
+
+    def __init__(self, players):
+        self.players = list(players)
+        self.round = 1
+        self.points = {name: 0 for name in self.players}
+        self.pending = {}
+        self.history = []
+        self.game_over = False
+        self.winner = None
+        self.deal()
+
+    @classmethod
+    def from_state(cls, state):
+        """get_state() の辞書から復元する"""
+        match = cls.__new__(cls)
+        match.players = list(state['players'])
+        match.round = state['round']
+        match.hands = {name: list(hand) for name, hand in state['hands'].items()}
+        match.pending = dict(state['pending'])
+        match.points = dict(state['points'])
+        match.history = list(state['history'])
+        match.game_over = state['game_over']
+        match.winner = state['winner']
+        return match
+
+    def side_of(self, player):
+        """現在のラウンドでのプレイヤーの陣営"""
+        index = self.players.index(player)
+        if (self.round - 1) // SWITCH_EVERY % 2:
+            index = 1 - index
+        return SIDES[index]
+
+    def player_of(self, side):
+        return next(name for name in self.players if self.side_of(name) == side)
+
+    def deal(self):
+        """現在のラウンドの手札を配る"""
+        self.hands = {name: initial_hand(self.side_of(name)) for name in self.players}
+        self.pending = {}
+
+    def play(self, player, card):
+        """
+        カードを出す
+
+        Args:
+            player (str): プレイヤー名
+            card (str): 出すカード
+
+        Returns:
+            dict: 両者のカードが揃って判定したらその結果
+                  {'message', 'round_over', 'winner_side', 'emperor_card', 'slave_card'}、
+                  相手待ちなら None
+
+        Raises:
+            ValueError: 出せないカード・手番のとき
+        """
+        if self.game_over:
+            raise ValueError("試合は終了しています")
+        if player not in self.hands or card not in self.hands[player]:
+            raise ValueError("手札にないカードです")
+        if player in self.pending:
+            raise ValueError("このターンはすでにカードを出しています")
+        self.pending[player] = card
+        if len(self.pending) < 2:
+            return None
+
+        emperor, slave = self.player_of('emperor_side'), self.player_of('slave_side')
+        emperor_card, slave_card = self.pending[emperor], self.pending[slave]
+        self.hands[emperor].remove(emperor_card)
+        self.hands[slave].remove(slave_card)
+        self.pending = {}
+
+        message, winner_side, round_over = ECard.judge(emperor_card, slave_card)
+        result = {
+            'message': message, 'round_over': round_over, 'winner_side': winner_side,
+            'emperor_card': emperor_card, 'slave_card': slave_card,
+        }
+        if round_over:
+            turn = CITIZENS + 1 - len(self.hands[emperor])
+            self.finish_round(winner_side, turn, emperor_card, slave_card)
+        return result
+
+    def finish_round(self, winner_side, turn, emperor_card, slave_card):
+        """ラウンドの勝者に得点を与え、次のラウンドへ進む（最終ラウンドなら試合終了）"""
+        winner = self.player_of(winner_side)
+        self.points[winner] += EMPEROR_WIN_POINTS if winner_side == 'emperor_side' else SLAVE_WIN_POINTS
+        self.history.append({
+            'round': self.round, 'winner': winner, 'side': winner_side,
+            'turn': turn, 'emperor_card': emperor_card, 'slave_card': slave_card,
+        })
+        if self.round >= ROUNDS:
+            self.game_over = True
+            first, second = self.players
+            if self.points[first] == self.points[second]:
+                self.winner = 'draw'
+            else:
+                self.winner = max(self.players, key=self.points.get)
+            return
+        self.round += 1
+        self.deal()
+
+    def get_state(self):
+        """
+        現在の試合状態を辞書で返す（JSON にできる形）
+
+        Returns:
+            dict: 試合状態
+        """
+        return {
+            'players': list(self.players),
+            'round': self.round,
+            'hands': {name: list(hand) for name, hand in self.hands.items()},
+            'pending': dict(self.pending),
+            'points': dict(self.points),
+            'history': list(self.history),
+            'game_over': self.game_over,
+            'winner': self.winner,
+        }
@@ -0,0 +1,98 @@
+"""
+Eカードのモンテカルロ・シミュレーター
+
+CPU 同士（または指定した戦略同士）のラウンドを大量に対戦させ、
+陣営ごとの勝率と1ラウンドあたりの期待得点を集計する。
+ラウンドはまとめて NumPy の配列で進め、チャンクごとにプロセスプールへ分配する。
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .ecard import CITIZENS, EMPEROR_WIN_POINTS, SLAVE_WIN_POINTS, STRATEGY, solve_round
+
+CHUNK_ROUNDS = 1_000_000  # 1タスクで対戦させるラウンド数
+
+
+def simulate_rounds(rounds, seed=None, emperor=None, slave=None):
+    """
+    rounds ラウンドをまとめて対戦させる
+
+    Args:
+        rounds (int): ラウンド数
+        seed: 乱数のシード
+        emperor (list): 残り市民の枚数ごとの、皇帝側が皇帝を出す確率（省略時は均衡戦略）
+        slave (list): 残り市民の枚数ごとの、奴隷側が奴隷を出す確率（省略時は均衡戦略）
+
+    Returns:
+        dict: {'rounds', 'emperor_wins', 'slave_wins', 'turns'}
+              turns[i] は i+1 手目で決着したラウンド数
+    """
+    emperor = [p for p, _ in STRATEGY] if emperor is None else emperor
+    slave = [q for _, q in STRATEGY] if slave is None else slave
+    rng = np.random.default_rng(seed)
+
+    alive = np.ones(rounds, dtype=bool)
+    emperor_wins = slave_wins = 0
+    turns = []
+    for citizens in range(CITIZENS, -1, -1):
+        n = int(alive.sum())
+        emperor_special = rng.random(n) < emperor[citizens]
+        slave_special = rng.random(n) < slave[citizens]
+        slave_won = emperor_special & slave_special
+        decided = emperor_special | slave_special
+        emperor_wins += int((decided & ~slave_won).sum())
+        slave_wins += int(slave_won.sum())
+        turns.append(int(decided.sum()))
+        # 市民同士だったラウンドだけが次の手に進む
+        alive[alive] = ~decided
+    return {'rounds': rounds, 'emperor_wins': emperor_wins, 'slave_wins': slave_wins, 'turns': turns}
+
+
+def _merge(results):
+    total = {'rounds': 0, 'emperor_wins': 0, 'slave_wins': 0, 'turns': [0] * (CITIZENS + 1)}
+    for result in results:
+        total['rounds'] += result['rounds']
+        total['emperor_wins'] += result['emperor_wins']
+        total['slave_wins'] += result['slave_wins']
+        total['turns'] = [a + b for a, b in zip(total['turns'], result['turns'])]
+    return total
+
+
+def simulate(rounds, workers=None, seed=None, emperor=None, slave=None):
+    """
+    rounds ラウンドをプロセスプールで分担して対戦させ、結果を集計する
+
+    Args:
+        rounds (int): ラウンド数
+        workers (int): プロセス数（省略時は CPU 数。1 なら同じプロセスで実行する）
+        seed: 乱数のシード（チャンクごとに独立な系列を作る）
+        emperor, slave: simulate_rounds と同じ
+
+    Returns:
+        dict: simulate_rounds の結果の合計に、勝率と期待得点を加えたもの
+    """
+    sizes = [CHUNK_ROUNDS] * (rounds // CHUNK_ROUNDS)
+    if rounds % CHUNK_ROUNDS:
+        sizes.append(rounds % CHUNK_ROUNDS)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(size, s, emperor, slave) for size, s in zip(sizes, seeds)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(sizes) == 1:
+        results = [simulate_rounds(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sizes))) as pool:
+            results = list(pool.map(simulate_rounds, *zip(*args)))
+
+    total = _merge(results)
+    n = max(1, total['rounds'])
+    total['emperor_win_rate'] = total['emperor_wins'] / n
+    total['slave_win_rate'] = total['slave_wins'] / n
+    # 皇帝側から見た1ラウンドあたりの得点差（均衡戦略同士なら solve_round(CITIZENS) の値に近づく）
+    total['emperor_edge'] = (total['emperor_wins'] * EMPEROR_WIN_POINTS
+                             - total['slave_wins'] * SLAVE_WIN_POINTS) / n
+    total['expected_edge'] = solve_round(CITIZENS)[2]
+    return total
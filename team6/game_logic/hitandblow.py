@@ -1,4 +1,108 @@
+import itertools
 import random
+from functools import lru_cache
+from math import perm
+
+import numpy as np
+
+# 全組み合わせの判定表を作る最大桁数（4桁で 5040×5040 = 約25MB。5桁だと約900MBになる）
+MAX_MATRIX_DIGITS = 4
+
+# 判定結果は1バイトに詰める: 上位4ビットがヒット数、下位4ビットがブロー数
+_POPCOUNT = np.array([bin(i).count('1') for i in range(1024)], dtype=np.uint8)
+_CHUNK_CELLS = 1 << 23  # 一度に比較する要素数の上限（一時配列のメモリを抑える）
+
+
+def encode_score(hit, blow):
+    return (hit << 4) | blow
+
+
+def decode_score(score):
+    """判定結果の1バイトを (ヒット, ブロー) に戻す（NumPy 配列でもよい）"""
+    return score >> 4, score & 0xF
+
+
+@lru_cache(maxsize=None)
+def all_codes(digits):
+    """
+    重複なしの digits 桁の数字列をすべて辞書順に列挙する
+
+    Returns:
+        numpy.ndarray: (組み合わせ数, digits) の uint8 配列（3桁で720通り、4桁で5040通り）
+    """
+    codes = np.array(list(itertools.permutations(range(10), digits)), dtype=np.uint8)
+    codes.setflags(write=False)
+    return codes
+
+
+@lru_cache(maxsize=None)
+def _digit_masks(digits):
+    # 各数字列に含まれる数字の集合をビットマスクにしたもの
+    masks = (np.left_shift(1, all_codes(digits).astype(np.uint16))).sum(axis=1, dtype=np.uint16)
+    masks.setflags(write=False)
+    return masks
+
+
+def code_indices(codes):
+    """
+    数字列を all_codes の行番号に変換する
+
+    Args:
+        codes: (n, digits) の配列、またはリストのリスト
+
+    Returns:
+        numpy.ndarray: 行番号の配列
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    digits = codes.shape[1]
+    # i 桁目より前に出てきた、i 桁目より小さい数字の個数
+    earlier_smaller = np.tril(codes[:, None, :] < codes[:, :, None], k=-1).sum(axis=2)
+    weights = np.array([perm(9 - i, digits - 1 - i) for i in range(digits)], dtype=np.int64)
+    return ((codes - earlier_smaller) * weights).sum(axis=1)
+
+
+def score_codes(guesses, secrets):
+    """
+    予想と正解の全組み合わせを判定する
+
+    Args:
+        guesses: (g, digits) の配列
+        secrets: (s, digits) の配列
+
+    Returns:
+        numpy.ndarray: (g, s) の uint8 配列（encode_score 形式）
+    """
+    guesses = np.asarray(guesses, dtype=np.uint8)
+    secrets = np.asarray(secrets, dtype=np.uint8)
+    digits = guesses.shape[1]
+    guess_masks = np.left_shift(1, guesses.astype(np.uint16)).sum(axis=1, dtype=np.uint16)
+    secret_masks = np.left_shift(1, secrets.astype(np.uint16)).sum(axis=1, dtype=np.uint16)
+
+    result = np.empty((len(guesses), len(secrets)), dtype=np.uint8)
+    rows = max(1, _CHUNK_CELLS // max(1, len(secrets) * digits))
+    for start in range(0, len(guesses), rows):
+        g = guesses[start:start + rows]
+        hits = (g[:, None, :] == secrets[None, :, :]).sum(axis=2, dtype=np.uint8)
+        common = _POPCOUNT[guess_masks[start:start + rows, None] & secret_masks[None, :]]
+        result[start:start + rows] = (hits << 4) | (common - hits)
+    return result
+
+
+@lru_cache(maxsize=None)
+def score_matrix(digits):
+    """
+    全組み合わせの判定表（初回だけ計算し、桁数ごとにキャッシュする）
+
+    Returns:
+        numpy.ndarray: (N, N) の uint8 配列。[予想の行番号, 正解の行番号] が判定結果
+    """
+    if digits > MAX_MATRIX_DIGITS:
+        raise ValueError(f"判定表は {MAX_MATRIX_DIGITS} 桁までです")
+    codes = all_codes(digits)
+    matrix = score_codes(codes, codes)
+    matrix.setflags(write=False)
+    return matrix
+
 
 class HitAndBlow:
     """3桁のヒット・アンド・ブロー判定ロジック"""
@@ -20,10 +124,42 @@ class HitAndBlow:
                 blow += 1
         return {'hit': hit, 'blow': blow}
 
+    def score_many(self, guess, secrets):
+        """
+        1つの予想を複数の正解とまとめて判定する
+
+        Args:
+            guess (list): 予想 (例: [1, 2, 3])
+            secrets: 正解のリスト、または (n, digits) の配列
+
+        Returns:
+            tuple: (ヒット数の配列, ブロー数の配列)
+        """
+        if self.digits <= MAX_MATRIX_DIGITS:
+            row = score_matrix(self.digits)[code_indices([guess])[0]]
+            return decode_score(row[code_indices(secrets)])
+        return decode_score(score_codes([guess], secrets)[0])
+
+    def score_guesses(self, guesses, secret):
+        """
+        複数の予想を1つの正解とまとめて判定する
+
+        Args:
+            guesses: 予想のリスト、または (n, digits) の配列
+            secret (list): 正解 (例: [1, 2, 3])
+
+        Returns:
+            tuple: (ヒット数の配列, ブロー数の配列)
+        """
+        if self.digits <= MAX_MATRIX_DIGITS:
+            column = code_indices([secret])[0]
+            return decode_score(score_matrix(self.digits)[code_indices(guesses), column])
+        return decode_score(score_codes(guesses, [secret])[:, 0])
+
     def is_valid_input(self, input_list):
         """入力が有効か（桁数、重複なし、数字のみ）をチェック"""
         if len(input_list) != self.digits:
             return False
         if len(set(input_list)) != self.digits:
             return False
-        return all(0 <= x <= 9 for x in input_list)
\ No newline at end of file
+        return all(0 <= x <= 9 for x in input_list)
@@ -0,0 +1,101 @@
+"""
+ヒット・アンド・ブローの CPU
+
+残っている正解候補を all_codes の行番号の配列で持ち、判定結果を受け取るたびに
+その結果と矛盾する候補を取り除く（前回の候補から絞るだけなので全体を見直さない）。
+次の予想は「その予想で候補がいくつに分かれるか」を判定表から数え、
+残る候補数の期待値が最も小さいものを選ぶ。制限時間に達したらそれまでの最善を使う。
+"""
+
+import random
+import time
+
+import numpy as np
+
+from .hitandblow import MAX_MATRIX_DIGITS, all_codes, encode_score, score_codes, score_matrix
+
+TIME_BUDGET = 0.005    # 1手あたりの思考時間の上限（秒）
+CHUNK_CELLS = 1 << 15  # 一度に評価する「予想×候補」の組の数（1回の評価を短く保つ）
+SAMPLE = 256           # 候補以外から評価に加える数字列の数
+
+
+class HitAndBlowSolver:
+    """
+    Attributes:
+        digits (int): 桁数
+        remaining (numpy.ndarray): 残っている正解候補（all_codes の行番号）
+    """
+
+    def __init__(self, digits=3, time_budget=TIME_BUDGET, rng=None):
+        self.digits = digits
+        self.time_budget = time_budget
+        self.codes = all_codes(digits)
+        self.remaining = np.arange(len(self.codes))
+        self.observed = 0  # これまでに受け取った判定結果の数
+        self._rng = rng or random.Random()
+
+    def _scores(self, guess_rows, secret_rows):
+        # 4桁までは判定表を引き、それより大きい桁数はその場で計算する
+        if self.digits <= MAX_MATRIX_DIGITS:
+            return score_matrix(self.digits)[np.ix_(guess_rows, secret_rows)]
+        return score_codes(self.codes[guess_rows], self.codes[secret_rows])
+
+    def observe(self, guess, hit, blow):
+        """
+        予想と判定結果を受け取り、矛盾する候補を取り除く
+
+        Args:
+            guess (list): 予想した数字列
+            hit (int): ヒット数
+            blow (int): ブロー数
+        """
+        row = self._row_of(guess)
+        scores = self._scores([row], self.remaining)[0]
+        self.remaining = self.remaining[scores == encode_score(hit, blow)]
+        self.observed += 1
+
+    def next_guess(self):
+        """
+        次の予想を選ぶ
+
+        Returns:
+            list: 予想する数字列
+        """
+        n = len(self.remaining)
+        if n == 0:
+            raise ValueError("判定結果に矛盾があり、候補が残っていません")
+        if n <= 2 or n == len(self.codes):
+            # 初手はどれを選んでも同じ。候補が2つ以下なら候補から選ぶのが最善
+            return self.codes[self._rng.choice(self.remaining)].tolist()
+
+        deadline = time.perf_counter() + self.time_budget
+        # 候補そのもの（当たる可能性がある）を先に、その後に候補以外の数字列を評価する
+        pool = list(self.remaining)
+        self._rng.shuffle(pool)
+        others = self._rng.sample(range(len(self.codes)), min(len(self.codes), SAMPLE))
+        pool.extend(others)
+        is_candidate = np.zeros(len(self.codes), dtype=bool)
+        is_candidate[self.remaining] = True
+
+        chunk = max(1, CHUNK_CELLS // n)
+        best_row, best_cost = pool[0], None
+        for start in range(0, len(pool), chunk):
+            rows = np.array(pool[start:start + chunk])
+            scores = self._scores(rows, self.remaining).astype(np.int64)
+            # 予想ごとに判定結果の分布を数え、残る候補数の期待値（二乗和/n）を出す
+            offsets = scores + 256 * np.arange(len(rows))[:, None]
+            counts = np.bincount(offsets.ravel(), minlength=256 * len(rows)).reshape(len(rows), 256)
+            # 当たりの可能性がある候補をわずかに優先する
+            costs = (counts.astype(np.float64) ** 2).sum(axis=1) - 0.5 * is_candidate[rows]
+            i = int(np.argmin(costs))
+            if best_cost is None or costs[i] < best_cost:
+                best_row, best_cost = rows[i], costs[i]
+            if time.perf_counter() >= deadline:
+                break
+        return self.codes[best_row].tolist()
+
+    def _row_of(self, code):
+        matches = np.flatnonzero((self.codes == np.asarray(code, dtype=np.uint8)).all(axis=1))
+        if len(matches) == 0:
+            raise ValueError(f"無効な数字列です: {code}")
+        return int(matches[0])
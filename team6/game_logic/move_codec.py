@@ -0,0 +1,99 @@
+"""
+対局の手順を GameRecord.moves に保存するためのバイナリ形式
+
+三目並べ:   1手1バイト（マス番号 0-8）
+ヒット・アンド・ブロー:
+            先頭1バイトが桁数、続いて先攻・後攻の正解、その後に予想を先攻から交互に並べる。
+            数字列は1桁4ビットで詰める（奇数桁なら最後の4ビットは 0xF で埋める）
+Eカード:    1ラウンド1バイト（決着した手番 - 1 を上位、決着の組み合わせを下位2ビット）
+"""
+
+from .ecard import ECard
+
+# Eカードの決着の組み合わせ（皇帝側のカード, 奴隷側のカード）
+ECARD_OUTCOMES = (
+    (ECard.EMPEROR, ECard.SLAVE),
+    (ECard.EMPEROR, ECard.CITIZEN),
+    (ECard.CITIZEN, ECard.SLAVE),
+)
+_PAD = 0xF
+
+
+def encode_tictactoe(moves):
+    """着手したマスのリスト -> bytes"""
+    return bytes(moves)
+
+
+def decode_tictactoe(data):
+    """bytes -> 着手したマスのリスト"""
+    return list(data)
+
+
+def _pack_digits(digits):
+    values = list(digits)
+    if len(values) % 2:
+        values.append(_PAD)
+    return bytes((values[i] << 4) | values[i + 1] for i in range(0, len(values), 2))
+
+
+def _unpack_digits(data, count):
+    values = []
+    for byte in data:
+        values.extend((byte >> 4, byte & 0xF))
+    return values[:count]
+
+
+def encode_hitandblow(digits, secret_first, secret_second, guesses):
+    """
+    Args:
+        digits (int): 桁数
+        secret_first (list): 先攻の正解
+        secret_second (list): 後攻の正解
+        guesses (list): 予想のリスト（先攻から交互）
+
+    Returns:
+        bytes: 1 + (2 + 予想の数) * ceil(digits / 2) バイト
+    """
+    out = bytearray([digits])
+    for code in (secret_first, secret_second, *guesses):
+        out += _pack_digits(code)
+    return bytes(out)
+
+
+def decode_hitandblow(data):
+    """
+    Returns:
+        dict: {'digits', 'secret_first', 'secret_second', 'guesses'}
+    """
+    digits = data[0]
+    width = (digits + 1) // 2
+    codes = [_unpack_digits(data[i:i + width], digits) for i in range(1, len(data), width)]
+    return {
+        'digits': digits,
+        'secret_first': codes[0],
+        'secret_second': codes[1],
+        'guesses': codes[2:],
+    }
+
+
+def encode_ecard(rounds):
+    """
+    Args:
+        rounds (list): ラウンドごとの {'turn': 決着した手番(1から), 'emperor_card', 'slave_card'}
+
+    Returns:
+        bytes: 1ラウンド1バイト
+    """
+    return bytes(
+        ((r['turn'] - 1) << 2) | ECARD_OUTCOMES.index((r['emperor_card'], r['slave_card']))
+        for r in rounds
+    )
+
+
+def decode_ecard(data):
+    """bytes -> ラウンドごとの {'turn', 'emperor_card', 'slave_card'} のリスト"""
+    rounds = []
+    for byte in data:
+        emperor_card, slave_card = ECARD_OUTCOMES[byte & 0x3]
+        rounds.append({'turn': (byte >> 2) + 1, 'emperor_card': emperor_card, 'slave_card': slave_card})
+    return rounds
@@ -1,183 +1,207 @@
 """
 三目並べ（Tic Tac Toe）ゲームロジック
+
+盤面は X と O それぞれを 9 ビットの整数（ビットボード）で持つ。
+ビット i が盤面のインデックス i（0-8）に対応する。
+勝ちパターンはビットマスクとして事前に計算しておき、着手したマスを含む
+パターンだけを照合するので、1手ごとの判定でリストなどを新たに作らない。
 """
 
+# 勝ちパターン（行、列、対角線）
+WIN_LINES = (
+    (0, 1, 2), (3, 4, 5), (6, 7, 8),  # 行
+    (0, 3, 6), (1, 4, 7), (2, 5, 8),  # 列
+    (0, 4, 8), (2, 4, 6),             # 対角線
+)
+WIN_MASKS = tuple(sum(1 << i for i in line) for line in WIN_LINES)
+FULL_BOARD = 0x1FF
+
+CELL_BITS = tuple(1 << i for i in range(9))
+# マスごとに、そのマスを含む勝ちパターン ((マスク, ライン), ...)
+LINES_BY_CELL = tuple(
+    tuple((mask, line) for mask, line in zip(WIN_MASKS, WIN_LINES) if mask & CELL_BITS[cell])
+    for cell in range(9)
+)
+
+
 class TicTacToe:
     """
     3×3の三目並べゲーム
-    
+
     Attributes:
-        board (list): 3×3のゲームボード（0-8のインデックス）
+        x_bits (int): X が置かれたマスのビットボード
+        o_bits (int): O が置かれたマスのビットボード
         current_player (str): 現在のプレイヤー ('X' または 'O')
         game_over (bool): ゲーム終了フラグ
         winner (str): 勝者 ('X', 'O', 'draw', None)
+        winning_line (tuple): 勝利したラインのインデックス（なければ空）
+        move_history (list): 着手したマスの履歴（0-8）
     """
-    
+
     def __init__(self):
         """ゲームを初期化"""
-        self.board = [' ' for _ in range(9)]  # 空のボード
+        self.x_bits = 0
+        self.o_bits = 0
         self.current_player = 'X'  # Xから開始
         self.game_over = False
         self.winner = None
-        self.move_history = []  # ゲーム進行の履歴
-    
+        self.winning_line = ()
+        self.move_history = []
+
+    @classmethod
+    def from_board(cls, board, current_player='X'):
+        """
+        リスト形式のボードからゲームを復元する
+
+        Args:
+            board (list): 9要素のボード（' ', 'X', 'O'）
+            current_player (str): 次に打つプレイヤー
+
+        Returns:
+            TicTacToe: 復元したゲーム（勝敗がついていれば終了状態）
+        """
+        game = cls()
+        for i, mark in enumerate(board):
+            if mark == 'X':
+                game.x_bits |= CELL_BITS[i]
+            elif mark == 'O':
+                game.o_bits |= CELL_BITS[i]
+        game.current_player = current_player
+
+        winner, line = game.check_winner()
+        if winner:
+            game.game_over = True
+            game.winner = winner
+            game.winning_line = line
+        elif (game.x_bits | game.o_bits) == FULL_BOARD:
+            game.game_over = True
+            game.winner = 'draw'
+        return game
+
+    def to_board(self):
+        """
+        リスト形式のボードに変換する
+
+        Returns:
+            list: 9要素のボード（' ', 'X', 'O'）
+        """
+        x_bits, o_bits = self.x_bits, self.o_bits
+        return ['X' if x_bits & bit else 'O' if o_bits & bit else ' ' for bit in CELL_BITS]
+
+    @property
+    def board(self):
+        return self.to_board()
+
     def is_valid_move(self, position):
         """
         指定位置に移動可能かチェック
-        
+
         Args:
             position (int): 0-8のボード位置
-            
+
         Returns:
             bool: 有効な移動ならTrue
         """
         if not isinstance(position, int) or position < 0 or position > 8:
             return False
-        return self.board[position] == ' '
-    
-    def make_move(self, position):
+        return not (self.x_bits | self.o_bits) & CELL_BITS[position]
+
+    def play(self, position):
         """
-        プレイヤーが移動を実行
-        
+        着手する（勝敗判定と手番の交代まで行う）
+
         Args:
             position (int): 0-8のボード位置
-            
+
         Returns:
-            dict: {
-                'success': bool,
-                'message': str,
-                'board': list,
-                'current_player': str,
-                'game_over': bool,
-                'winner': str or None
-            }
-        """
-        if self.game_over:
-            return {
-                'success': False,
-                'message': 'ゲームは終了しています',
-                'board': self.board,
-                'game_over': True,
-                'winner': self.winner
-            }
-        
-        if not self.is_valid_move(position):
-            return {
-                'success': False,
-                'message': '無効な移動です',
-                'board': self.board,
-                'current_player': self.current_player,
-                'game_over': False,
-                'winner': None
-            }
-        
-        # ボードに配置
-        self.board[position] = self.current_player
-        self.move_history.append({
-            'player': self.current_player,
-            'position': position
-        })
-        
-        # 勝敗判定
-        winner = self._check_winner()
-        
-        if winner:
-            self.game_over = True
-            self.winner = winner
-            return {
-                'success': True,
-                'message': f'プレイヤー {winner} が勝ちました！',
-                'board': self.board,
-                'game_over': True,
-                'winner': winner
-            }
-        
+            bool: 着手できたらTrue
+        """
+        if self.game_over or not self.is_valid_move(position):
+            return False
+
+        bit = CELL_BITS[position]
+        if self.current_player == 'X':
+            self.x_bits |= bit
+            mine = self.x_bits
+        else:
+            self.o_bits |= bit
+            mine = self.o_bits
+        self.move_history.append(position)
+
+        # 勝敗判定（着手したマスを含むラインだけ見ればよい）
+        for mask, line in LINES_BY_CELL[position]:
+            if mine & mask == mask:
+                self.game_over = True
+                self.winner = self.current_player
+                self.winning_line = line
+                return True
+
         # 引き分け判定
-        if self._is_board_full():
+        if (self.x_bits | self.o_bits) == FULL_BOARD:
             self.game_over = True
             self.winner = 'draw'
-            return {
-                'success': True,
-                'message': '引き分けです',
-                'board': self.board,
-                'game_over': True,
-                'winner': 'draw'
-            }
-        
-        # プレイヤーを切り替え
-        self.current_player = 'O' if self.current_player == 'X' else 'X'
-        
-        return {
-            'success': True,
-            'message': f'プレイヤー {self.current_player} のターン',
-            'board': self.board,
-            'current_player': self.current_player,
-            'game_over': False,
-            'winner': None
-        }
-    
-    def _check_winner(self):
+        else:
+            self.switch_player()
+        return True
+
+    def make_move(self, position):
+        """
+        プレイヤーが移動を実行
+
+        Args:
+            position (int): 0-8のボード位置
+
+        Returns:
+            dict: {'success': bool, 'message': str}
+        """
+        if not self.play(position):
+            return {'success': False, 'message': 'Invalid move'}
+        return {'success': True, 'message': ''}
+
+    def check_winner(self):
         """
-        勝者をチェック
-        
+        盤面全体から勝者をチェック
+
         Returns:
-            str: 'X', 'O', またはNone
-        """
-        # 勝ちパターン（行、列、対角線）
-        winning_positions = [
-            # 行
-            [0, 1, 2],
-            [3, 4, 5],
-            [6, 7, 8],
-            # 列
-            [0, 3, 6],
-            [1, 4, 7],
-            [2, 5, 8],
-            # 対角線
-            [0, 4, 8],
-            [2, 4, 6]
-        ]
-        
-        for positions in winning_positions:
-            a, b, c = positions
-            if (self.board[a] != ' ' and 
-                self.board[a] == self.board[b] == self.board[c]):
-                return self.board[a]
-        
-        return None
-    
-    def _is_board_full(self):
-        """ボードが満杯かチェック"""
-        return ' ' not in self.board
-    
+            tuple: (勝者 'X' / 'O' / None, 勝利ライン)
+        """
+        for mask, line in zip(WIN_MASKS, WIN_LINES):
+            if self.x_bits & mask == mask:
+                return 'X', line
+            if self.o_bits & mask == mask:
+                return 'O', line
+        return None, ()
+
+    def switch_player(self):
+        self.current_player = 'O' if self.current_player == 'X' else 'X'
+
     def get_state(self):
         """
         現在のゲーム状態を辞書で返す
-        
+
         Returns:
-            dict: ゲーム状態
+            dict: ゲーム状態（board はリスト形式）
         """
         return {
-            'board': self.board,
+            'board': self.to_board(),
             'current_player': self.current_player,
             'game_over': self.game_over,
             'winner': self.winner,
-            'board_full': self._is_board_full(),
-            'move_history': self.move_history
+            'winning_line': list(self.winning_line)
         }
-    
+
     def reset(self):
         """ゲームをリセット"""
         self.__init__()
-    
+
     @staticmethod
     def board_to_display(board):
         """
         ボード状態を表示用フォーマットに変換
-        
+
         Args:
             board (list): 9要素のボード
-            
+
         Returns:
             str: 表示用文字列
         """
@@ -188,57 +212,3 @@ class TicTacToe:
             if i < 2:
                 display += "-----------\n"
         return display
-class TicTacToe:
-    def __init__(self):
-        self.board = [' ' for _ in range(9)]
-        self.current_player = 'X'
-        self.game_over = False
-        self.winner = None
-        self.winning_line = []  # 追加: 勝利したラインのインデックスを保持
-
-    def make_move(self, position):
-        if self.game_over or self.board[position] != ' ':
-            return {'success': False, 'message': 'Invalid move'}
-
-        self.board[position] = self.current_player
-
-        # 勝敗判定
-        winner, winning_line = self.check_winner()
-        if winner:
-            self.game_over = True
-            self.winner = winner
-            self.winning_line = winning_line  # 勝利ラインを保存
-        elif ' ' not in self.board:
-            self.game_over = True
-            self.winner = 'draw'
-        else:
-            self.switch_player()
-
-        return {'success': True}
-
-    def check_winner(self):
-        # 勝利パターン (横、縦、斜めのインデックスの組み合わせ)
-        win_combinations = [
-            [0, 1, 2], [3, 4, 5], [6, 7, 8],  # Rows
-            [0, 3, 6], [1, 4, 7], [2, 5, 8],  # Columns
-            [0, 4, 8], [2, 4, 6]              # Diagonals
-        ]
-
-        for combo in win_combinations:
-            # 3つのマスが同じマークで、かつ空白でない場合
-            if self.board[combo[0]] == self.board[combo[1]] == self.board[combo[2]] != ' ':
-                # 勝者のマークと、そのラインを返す
-                return self.board[combo[0]], combo
-        return None, []  # 勝者なし
-
-    def switch_player(self):
-        self.current_player = 'O' if self.current_player == 'X' else 'X'
-
-    def get_state(self):
-        return {
-            'board': self.board,
-            'current_player': self.current_player,
-            'game_over': self.game_over,
-            'winner': self.winner,
-            'winning_line': self.winning_line  # 状態に含める
-        }
\ No newline at end of file
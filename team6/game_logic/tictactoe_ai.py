@@ -0,0 +1,144 @@
+"""
+三目並べの CPU（完全読み）
+
+到達可能な全局面を起動時に1度だけ解き、最善手を表にしておく。
+盤面の8通りの対称（回転・反転）で同じになる局面は正規形にまとめて1回だけ評価する。
+表は (x_bits << 9) | o_bits を添字にした bytearray なので、CPU の手は表を1回引くだけで決まる。
+"""
+
+from .tictactoe import CELL_BITS, FULL_BOARD, WIN_MASKS
+
+# 盤面の対称変換: 変換後のマス i には変換前のマス perm[i] が入る
+_ROTATE = (6, 3, 0, 7, 4, 1, 8, 5, 2)
+_MIRROR = (2, 1, 0, 5, 4, 3, 8, 7, 6)
+
+
+def _compose(a, b):
+    return tuple(a[b[i]] for i in range(9))
+
+
+def _symmetries():
+    perms = []
+    perm = tuple(range(9))
+    for _ in range(4):
+        perms.append(perm)
+        perms.append(_compose(perm, _MIRROR))
+        perm = _compose(perm, _ROTATE)
+    return perms
+
+
+# 対称変換ごとの 9 ビット値 -> 変換後の 9 ビット値 の表
+_TRANSFORMS = tuple(
+    tuple(sum(CELL_BITS[i] for i in range(9) if bits & CELL_BITS[perm[i]]) for bits in range(512))
+    for perm in _symmetries()
+)
+
+NO_MOVE = 0xFF
+
+
+def _is_win(bits):
+    for mask in WIN_MASKS:
+        if bits & mask == mask:
+            return True
+    return False
+
+
+def _canonical(x_bits, o_bits):
+    return min((t[x_bits] << 9) | t[o_bits] for t in _TRANSFORMS)
+
+
+def _build_table():
+    """
+    全局面を解いて最善手の表を作る
+
+    Returns:
+        tuple: (最善手の表, 評価値の表)。評価値は手番側から見て
+               勝ち = 残りマス数+1（早く勝つほど大きい）、引き分け = 0、負け = 負の値
+    """
+    scores = {}  # 正規形 -> 手番側から見た評価値
+
+    def solve(x_bits, o_bits):
+        key = _canonical(x_bits, o_bits)
+        score = scores.get(key)
+        if score is not None:
+            return score
+        occupied = x_bits | o_bits
+        x_to_move = bin(x_bits).count('1') == bin(o_bits).count('1')
+        best = -100
+        for bit in CELL_BITS:
+            if occupied & bit:
+                continue
+            if x_to_move:
+                nx, no = x_bits | bit, o_bits
+                won = _is_win(nx)
+            else:
+                nx, no = x_bits, o_bits | bit
+                won = _is_win(no)
+            if won:
+                value = 9 - bin(occupied).count('1')
+            elif (occupied | bit) == FULL_BOARD:
+                value = 0
+            else:
+                value = -solve(nx, no)
+            if value > best:
+                best = value
+        scores[key] = best
+        return best
+
+    moves = bytearray([NO_MOVE]) * (1 << 18)
+    values = bytearray(1 << 18)
+    # 初期局面から到達できる局面をすべてたどり、実際の向きでの最善手を記録する
+    stack = [(0, 0)]
+    seen = {0}
+    while stack:
+        x_bits, o_bits = stack.pop()
+        if _is_win(x_bits) or _is_win(o_bits) or (x_bits | o_bits) == FULL_BOARD:
+            continue
+        index = (x_bits << 9) | o_bits
+        values[index] = solve(x_bits, o_bits) & 0xFF
+        occupied = x_bits | o_bits
+        x_to_move = bin(x_bits).count('1') == bin(o_bits).count('1')
+        best = -100
+        for position, bit in enumerate(CELL_BITS):
+            if occupied & bit:
+                continue
+            nx, no = (x_bits | bit, o_bits) if x_to_move else (x_bits, o_bits | bit)
+            if _is_win(nx if x_to_move else no):
+                value = 9 - bin(occupied).count('1')
+            elif (occupied | bit) == FULL_BOARD:
+                value = 0
+            else:
+                value = -solve(nx, no)
+            if value > best:
+                best = value
+                moves[index] = position
+            child = (nx << 9) | no
+            if child not in seen:
+                seen.add(child)
+                stack.append((nx, no))
+    return moves, values
+
+
+_MOVES, _VALUES = _build_table()
+
+
+def best_move(game):
+    """
+    最善手を返す
+
+    Args:
+        game (TicTacToe): 対象のゲーム（手番は盤面の石数から決まる）
+
+    Returns:
+        int: 0-8のボード位置（終局・到達不能な局面ならNone）
+    """
+    move = _MOVES[(game.x_bits << 9) | game.o_bits]
+    return None if move == NO_MOVE else move
+
+
+def evaluate(game):
+    """
+    手番側から見た評価値を返す（正: 勝ち、0: 引き分け、負: 負け）
+    """
+    value = _VALUES[(game.x_bits << 9) | game.o_bits]
+    return value - 256 if value > 127 else value
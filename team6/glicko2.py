@@ -0,0 +1,129 @@
+"""
+Glicko-2 レーティング（一括計算用）
+
+全プレイヤーのレート・RD・ボラティリティを NumPy の配列で持ち、
+1レーティング期間の対局をまとめて更新する（プレイヤーごとのループを書かない）。
+計算式は Glickman "Example of the Glicko-2 system" に従う。
+"""
+
+import math
+
+import numpy as np
+
+SCALE = 173.7178         # Glicko と Glicko-2 の尺度の変換係数
+DEFAULT_RATING = 1500
+DEFAULT_RD = 350
+DEFAULT_VOLATILITY = 0.06
+TAU = 0.5                # ボラティリティの変化のしやすさ
+EPSILON = 1e-6           # ボラティリティの反復計算の収束判定
+MAX_ITERATIONS = 100
+
+
+class Glicko2:
+    """
+    Attributes:
+        mu (numpy.ndarray): Glicko-2 尺度のレート
+        phi (numpy.ndarray): Glicko-2 尺度の RD
+        sigma (numpy.ndarray): ボラティリティ
+    """
+
+    def __init__(self, size=0, tau=TAU):
+        self.tau = tau
+        self.mu = np.zeros(size)
+        self.phi = np.full(size, DEFAULT_RD / SCALE)
+        self.sigma = np.full(size, DEFAULT_VOLATILITY)
+
+    def __len__(self):
+        return len(self.mu)
+
+    def grow(self, size):
+        """プレイヤー数を size まで増やす（新しいプレイヤーは初期値）"""
+        extra = size - len(self.mu)
+        if extra <= 0:
+            return
+        self.mu = np.concatenate([self.mu, np.zeros(extra)])
+        self.phi = np.concatenate([self.phi, np.full(extra, DEFAULT_RD / SCALE)])
+        self.sigma = np.concatenate([self.sigma, np.full(extra, DEFAULT_VOLATILITY)])
+
+    @property
+    def ratings(self):
+        return self.mu * SCALE + DEFAULT_RATING
+
+    @property
+    def deviations(self):
+        return self.phi * SCALE
+
+    def rate_period(self, players, opponents, scores):
+        """
+        1レーティング期間の対局をまとめて反映する
+
+        Args:
+            players (numpy.ndarray): 各対局の一方のプレイヤー番号
+            opponents (numpy.ndarray): もう一方のプレイヤー番号
+            scores (numpy.ndarray): players 側の結果（勝ち 1、引き分け 0.5、負け 0）
+        """
+        size = len(self.mu)
+        # 1局を両者の視点の2行にする
+        me = np.concatenate([players, opponents])
+        other = np.concatenate([opponents, players])
+        s = np.concatenate([scores, 1.0 - scores])
+
+        mu, phi, sigma = self.mu, self.phi, self.sigma
+        g = 1.0 / np.sqrt(1.0 + 3.0 * phi[other] ** 2 / math.pi ** 2)
+        expected = 1.0 / (1.0 + np.exp(-g * (mu[me] - mu[other])))
+        v_inv = np.bincount(me, weights=g * g * expected * (1.0 - expected), minlength=size)
+        improvement = np.bincount(me, weights=g * (s - expected), minlength=size)
+
+        active = v_inv > 0
+        v = 1.0 / v_inv[active]
+        delta = v * improvement[active]
+        new_sigma = self._volatility(phi[active], sigma[active], v, delta)
+
+        # 対局のなかったプレイヤーは RD だけ広がる
+        phi_star = np.sqrt(phi ** 2 + sigma ** 2)
+        new_phi = phi_star.copy()
+        new_phi[active] = 1.0 / np.sqrt(1.0 / (phi[active] ** 2 + new_sigma ** 2) + v_inv[active])
+        self.mu = mu.copy()
+        self.mu[active] = mu[active] + new_phi[active] ** 2 * improvement[active]
+        self.phi = new_phi
+        self.sigma = sigma.copy()
+        self.sigma[active] = new_sigma
+
+    def _volatility(self, phi, sigma, v, delta):
+        """新しいボラティリティを Illinois 法で全員分同時に求める"""
+        tau2 = self.tau ** 2
+        a = np.log(sigma ** 2)
+        d2, p2 = delta ** 2, phi ** 2
+
+        def f(x):
+            ex = np.exp(x)
+            return ex * (d2 - p2 - v - ex) / (2.0 * (p2 + v + ex) ** 2) - (x - a) / tau2
+
+        big = d2 > p2 + v
+        b = np.where(big, np.log(np.maximum(d2 - p2 - v, 1e-300)), a - self.tau)
+        fb = f(b)
+        k = 1
+        # f(a - kτ) >= 0 になるまで下げる（big でない行だけ）
+        while True:
+            need = ~big & (fb < 0)
+            if not need.any() or k > MAX_ITERATIONS:
+                break
+            k += 1
+            b = np.where(need, a - k * self.tau, b)
+            fb = np.where(need, f(b), fb)
+
+        lo, flo = a, f(a)
+        hi, fhi = b, fb
+        for _ in range(MAX_ITERATIONS):
+            running = np.abs(hi - lo) > EPSILON
+            if not running.any():
+                break
+            # 収束した行はそのまま残す
+            c = np.where(running, lo + (lo - hi) * flo / np.where(running, fhi - flo, 1.0), hi)
+            fc = f(c)
+            swap = running & (fc * fhi <= 0)
+            lo = np.where(swap, hi, lo)
+            flo = np.where(swap, fhi, np.where(running, flo / 2.0, flo))
+            hi = np.where(running, c, hi)
+            fhi = np.where(running, fc, fhi)
+        return np.exp(lo / 2.0)
@@ -0,0 +1,269 @@
+"""
+ランキング
+
+全ユーザーのレートをメモリ上に持ち、レート値ごとの人数をフェニック木（BIT）で数える。
+「自分より高いレートの人数」が O(log R) で求まるので、順位の表示で COUNT クエリを発行しない。
+上位 N 人は、存在するレート値の昇順リストを上からたどって返す。
+
+レートが変わったときは ratings.apply_results のコミット後に update_many で差分だけ反映する。
+新しく登録したユーザーも UserProfile の作成のコミット後に加える（読み込み後に登録した人も上位に出る）。
+起動直後は最初のアクセスで1回だけ全件を読み込み、読み込み中に来た問い合わせは
+rating の索引を使うクエリで答える。
+
+複数プロセス構成（settings.TEAM6_BROKER_SOCKET。run_workers も含む）では、対局結果を書き込んだプロセスが
+コミットしたレートをブローカーのトピック（RATINGS_TOPIC）へ送り、各プロセスは読み込みの前にそれを購読しておく。
+どのプロセスのランキングにも同じ変更が届くので、どのプロセスに問い合わせても同じ順位になる。
+"""
+
+import bisect
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .broker import cast_now, get_client
+from .models import UserProfile
+
+logger = logging.getLogger(__name__)
+
+MAX_RATING = 4000  # これより高いレートは同じ値として数える
+TOP_LIMIT = 100    # 上位ランキングで返す最大人数
+RATINGS_TOPIC = 'leaderboard.ratings'  # コミットしたレートの変更を全プロセスへ送るトピック
+
+# 他のプロセスから届いた変更を反映するスレッド（読み込み中のロックでイベントループを止めないため。1本なので届いた順に反映する）
+_updater = ThreadPoolExecutor(max_workers=1, thread_name_prefix='leaderboard')
+
+
+class _Fenwick:
+    """0..size-1 の値ごとの人数を数えるフェニック木"""
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, index, delta):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """0..index の人数の合計"""
+        total = 0
+        index += 1
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+def _bucket(rating):
+    return min(max(rating, 0), MAX_RATING)
+
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._ratings = {}   # ユーザー名 -> レート
+        self._members = {}   # レート値 -> そのレートのユーザー名の集合
+        self._values = []    # 人がいるレート値（昇順）
+        self._counts = _Fenwick(MAX_RATING + 1)
+
+    def __len__(self):
+        return len(self._ratings)
+
+    # --- 更新 ---
+
+    def _remove(self, username):
+        rating = self._ratings.pop(username, None)
+        if rating is None:
+            return
+        members = self._members[rating]
+        members.discard(username)
+        if not members:
+            del self._members[rating]
+            del self._values[bisect.bisect_left(self._values, rating)]
+        self._counts.add(_bucket(rating), -1)
+
+    def _insert(self, username, rating):
+        self._ratings[username] = rating
+        members = self._members.get(rating)
+        if members is None:
+            members = self._members[rating] = set()
+            bisect.insort(self._values, rating)
+        members.add(username)
+        self._counts.add(_bucket(rating), 1)
+
+    def update_many(self, ratings):
+        """
+        レートの変更を反映する（読み込み前なら何もしない。読み込み時に最新の値を読むため）
+
+        Args:
+            ratings (dict): ユーザー名 -> 新しいレート
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            for username, rating in ratings.items():
+                if self._ratings.get(username) == rating:
+                    continue
+                self._remove(username)
+                self._insert(username, rating)
+
+    def publish(self, ratings):
+        """
+        コミットしたレートの変更を反映する。複数プロセス構成では他のプロセスのランキングにも送る
+
+        Args:
+            ratings (dict): ユーザー名 -> 新しいレート
+        """
+        self.update_many(ratings)
+        path = getattr(settings, 'TEAM6_BROKER_SOCKET', None)
+        if not path:
+            return
+        try:
+            cast_now(path, [('publish', RATINGS_TOPIC, ratings)])
+        except OSError:
+            logger.exception("レートの変更を他のプロセスへ送れませんでした（%d人）", len(ratings))
+
+    def discard(self, username):
+        with self._lock:
+            self._remove(username)
+
+    def reset(self):
+        """全件を読み直すようにする（レートを一括で再計算したあとなど）"""
+        with self._lock:
+            self.__init__()
+
+    # --- 読み込み ---
+
+    def _load(self):
+        rows = UserProfile.objects.values_list('user__username', 'rating').iterator(chunk_size=2000)
+        for username, rating in rows:
+            self._insert(username, rating)
+        self._loaded = True
+
+    def _ready(self):
+        """
+        読み込み済みなら True。未読み込みならこのスレッドで読み込む。
+        別のスレッドが読み込み中なら待たずに False を返す（呼び出し側は DB に問い合わせる）。
+        複数プロセス構成で他のプロセスの変更を購読できなければ、読み込まずに False を返す
+        """
+        if self._loaded:
+            return True
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if not self._loaded:
+                if getattr(settings, 'TEAM6_BROKER_SOCKET', None) and not self._subscribe():
+                    return False
+                self._load()
+            return True
+        finally:
+            self._lock.release()
+
+    def _subscribe(self):
+        """
+        他のプロセスがコミットしたレートの変更を購読する（読み込みの前に呼び、読み込み後の変更を取りこぼさない）
+
+        ビューのスレッドから、サーバーのイベントループ上のブローカーのクライアントで購読する
+
+        Returns:
+            bool: 購読できたら True
+        """
+        try:
+            async_to_sync(self._listen)()
+        except Exception:
+            logger.exception("ランキングの変更を購読できませんでした")
+            return False
+        return True
+
+    async def _listen(self):
+        await get_client(settings.TEAM6_BROKER_SOCKET).subscribe(RATINGS_TOPIC, self._received)
+
+    def _received(self, ratings):
+        # イベントループ上で呼ばれる。読み込み中はロックを待つことになるので別のスレッドで反映する
+        _updater.submit(self.update_many, ratings)
+
+    # --- 参照 ---
+
+    def top(self, n=10):
+        """
+        上位 n 人
+
+        Returns:
+            list: [{'rank', 'username', 'rating'}, ...]（同じレートは同順位）
+        """
+        n = max(0, min(n, TOP_LIMIT))
+        if not self._ready():
+            return self._db_top(n)
+        result = []
+        with self._lock:
+            rank = 1
+            for rating in reversed(self._values):
+                members = self._members[rating]
+                for username in heapq.nsmallest(n - len(result), members):
+                    result.append({'rank': rank, 'username': username, 'rating': rating})
+                rank += len(members)
+                if len(result) >= n:
+                    break
+        return result
+
+    def rank(self, username):
+        """
+        ユーザーの順位（自分よりレートが高い人数 + 1）
+
+        Returns:
+            dict: {'rank', 'rating', 'total'}。プロフィールがなければ None
+        """
+        if not self._ready():
+            return self._db_rank(username)
+        with self._lock:
+            rating = self._ratings.get(username)
+        if rating is None:
+            # 読み込み後に登録したユーザー: 1回だけ DB から読んで加える
+            rating = UserProfile.objects.filter(user__username=username).values_list('rating', flat=True).first()
+            if rating is None:
+                return None
+            self.update_many({username: rating})
+        with self._lock:
+            bucket = _bucket(rating)
+            higher = len(self._ratings) - self._counts.prefix(bucket)
+            return {'rank': higher + 1, 'rating': rating, 'total': len(self._ratings)}
+
+    # --- 読み込み中の代わり（rating の索引を使う） ---
+
+    @staticmethod
+    def _db_top(n):
+        rows = UserProfile.objects.order_by('-rating', 'user__username').values_list('user__username', 'rating')[:n]
+        result = []
+        for i, (username, rating) in enumerate(rows):
+            rank = result[-1]['rank'] if result and result[-1]['rating'] == rating else i + 1
+            result.append({'rank': rank, 'username': username, 'rating': rating})
+        return result
+
+    @staticmethod
+    def _db_rank(username):
+        rating = UserProfile.objects.filter(user__username=username).values_list('rating', flat=True).first()
+        if rating is None:
+            return None
+        higher = UserProfile.objects.filter(rating__gt=rating).count()
+        return {'rank': higher + 1, 'rating': rating, 'total': UserProfile.objects.count()}
+
+
+leaderboard = Leaderboard()
+
+
+@receiver(post_save, sender=UserProfile)
+def _add_new_profile(sender, instance, created, **kwargs):
+    """登録したユーザーをランキングに加える（複数プロセス構成では全プロセスのランキングへ送る）"""
+    if created:
+        ratings = {instance.user.username: instance.rating}
+        transaction.on_commit(lambda: leaderboard.publish(ratings))
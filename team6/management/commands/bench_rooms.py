@@ -0,0 +1,162 @@
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from channels.layers import DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from team6.broker import BrokerChannelLayer
+from team6.metrics import MeasuredInMemoryChannelLayer
+from team6.rooms import rooms
+from team6.routing import websocket_urlpatterns
+
+# 決着しない手順（X: 0, 3 / O: 1, 2）。打ち終えたら2人ともリセットして繰り返す
+MOVES = (0, 1, 3, 2)
+
+
+class _User:
+    is_authenticated = True
+
+    def __init__(self, username):
+        self.username = username
+
+
+class _AsUser:
+    """認証ミドルウェアの代わりに scope['user'] を入れる"""
+
+    def __init__(self, app, user):
+        self.app = app
+        self.user = user
+
+    async def __call__(self, scope, receive, send):
+        return await self.app(dict(scope, user=self.user), receive, send)
+
+
+async def _next_state(communicator):
+    while True:
+        message = await communicator.receive_json_from(timeout=10)
+        if message.get('type') == 'game_state':
+            return message
+
+
+class Command(BaseCommand):
+    help = 'ルームのイベントをプレイヤーへ直接送る場合と group_send の場合で、1手の遅延と処理量を比べる'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50, help='同時に対局するルーム数')
+        parser.add_argument('--moves', type=int, default=40, help='ルームごとの手数')
+        parser.add_argument('--layer', choices=['memory', 'broker', 'all'], default='all',
+                            help='チャネルレイヤー（broker はブローカーを別プロセスで起動し、共有モードで動かす）')
+        parser.add_argument('--send', choices=['direct', 'group', 'all'], default='all', help='ルームのイベントの送り方')
+
+    def handle(self, *args, **options):
+        layers = ['memory', 'broker'] if options['layer'] == 'all' else [options['layer']]
+        modes = ['direct', 'group'] if options['send'] == 'all' else [options['send']]
+        asyncio.run(self.run(layers, modes, options['rooms'], options['moves']))
+
+    async def run(self, layers, modes, n_rooms, moves):
+        saved = (settings.TEAM6_DIRECT_ROOM_SEND, settings.TEAM6_BROKER_SOCKET,
+                 channel_layers.backends.get(DEFAULT_CHANNEL_LAYER))
+        self.stdout.write(f"{n_rooms} ルーム × {moves} 手")
+        self.stdout.write(f"{'layer':8}{'send':8}{'moves/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        try:
+            for layer in layers:
+                broker = None
+                if layer == 'broker':
+                    broker, path = await self.start_broker()
+                    channel_layers.backends[DEFAULT_CHANNEL_LAYER] = BrokerChannelLayer(path)
+                    settings.TEAM6_BROKER_SOCKET = path
+                else:
+                    channel_layers.backends[DEFAULT_CHANNEL_LAYER] = MeasuredInMemoryChannelLayer()
+                    settings.TEAM6_BROKER_SOCKET = None
+                try:
+                    for mode in modes:
+                        settings.TEAM6_DIRECT_ROOM_SEND = mode == 'direct'
+                        rate, latencies = await self.bench(f'bench-{layer}-{mode}', n_rooms, moves)
+                        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+                        self.stdout.write(f"{layer:8}{mode:8}{rate:10.0f}"
+                                          f"{statistics.median(latencies) * 1000:10.2f}{p99 * 1000:10.2f}")
+                finally:
+                    if broker is not None:
+                        broker.terminate()
+                        await broker.wait()
+        finally:
+            settings.TEAM6_DIRECT_ROOM_SEND, settings.TEAM6_BROKER_SOCKET, layer = saved
+            channel_layers.backends[DEFAULT_CHANNEL_LAYER] = layer
+
+    async def start_broker(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='team6-bench-'), 'broker.sock')
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'django', 'run_broker', '--socket', path,
+            cwd=str(settings.BASE_DIR), env=dict(os.environ, TEAM6_SNAPSHOT_PATH=''),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        while not os.path.exists(path):
+            if process.returncode is not None:
+                raise CommandError('ブローカーを起動できませんでした')
+            await asyncio.sleep(0.05)
+        return process, path
+
+    async def bench(self, prefix, n_rooms, moves):
+        """
+        n_rooms 個のルームで同時に対局し、着手から相手に盤面が届くまでの時間を測る
+
+        Returns:
+            tuple: (1秒あたりの手数, 遅延（秒）の昇順のリスト)
+        """
+        app = URLRouter(websocket_urlpatterns)
+        players = []
+        for i in range(n_rooms):
+            pair = {}
+            for name in ('a', 'b'):
+                username = f'{prefix}-{i}-{name}'
+                communicator = WebsocketCommunicator(_AsUser(app, _User(username)), f'/ws/game/{prefix}-{i}/')
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise CommandError('接続できませんでした')
+                pair[username] = communicator
+            players.append(pair)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self.play(pair, moves) for pair in players))
+        elapsed = time.perf_counter() - started
+
+        for pair in players:
+            for communicator in pair.values():
+                await communicator.disconnect()
+        for i in range(n_rooms):
+            await rooms.evict(f'game_state_{prefix}-{i}')
+        latencies = sorted(latency for result in results for latency in result)
+        return len(latencies) / elapsed, latencies
+
+    async def play(self, pair, moves):
+        # 2人目の入室で両者に対局開始の盤面が届く（1人目にはその前に待機中の盤面も届く）
+        for communicator in pair.values():
+            state = await _next_state(communicator)
+            while state['player_o'] is None:
+                state = await _next_state(communicator)
+        first, second = pair.values()
+        marks = {'X': pair[state['player_x']], 'O': pair[state['player_o']]}
+
+        latencies = []
+        for i in range(moves):
+            mover = marks['X' if i % 2 == 0 else 'O']
+            other = marks['O' if i % 2 == 0 else 'X']
+            sent = time.perf_counter()
+            await mover.send_json_to({'type': 'move', 'position': MOVES[i % len(MOVES)]})
+            await _next_state(other)
+            latencies.append(time.perf_counter() - sent)
+            await _next_state(mover)
+            if i % len(MOVES) == len(MOVES) - 1:
+                for communicator in (first, second):
+                    await communicator.send_json_to({'type': 'reset'})
+                    await _next_state(first)
+                    await _next_state(second)
+        return latencies
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from team6.glicko2 import DEFAULT_RATING, Glicko2
+from team6.leaderboard import leaderboard
+from team6.models import GameRecord, UserProfile
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Command(BaseCommand):
+    help = ('保存済みの対局記録から全員のレートを Glicko-2 で計算し直す'
+            '（--game を指定したときはそのゲームを対局したユーザーのレートだけを書き換える。'
+            '起動中のサーバーのランキングは再起動するまで古いレートのまま）')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period-days', type=float, default=1.0, help='1レーティング期間の長さ（日）')
+        parser.add_argument('--game', choices=[c for c, _ in GameRecord.GAME_TYPE_CHOICES],
+                            help='対象のゲーム（省略時は全ゲーム。そのゲームを対局していないユーザーのレートは変えない）')
+        parser.add_argument('--chunk-size', type=int, default=20000, help='DB から一度に読む件数')
+        parser.add_argument('--dry-run', action='store_true', help='計算だけして書き込まない')
+
+    def handle(self, *args, **options):
+        period = timedelta(days=options['period_days'])
+        chunk_size = options['chunk_size']
+
+        # CPU 対戦（player2 が空）は数えない
+        games = GameRecord.objects.filter(player2__isnull=False)
+        if options['game']:
+            games = games.filter(game_type=options['game'])
+        rows = (games.order_by('created_at', 'id')
+                .values_list('created_at', 'player1_id', 'player2_id', 'winner_id', 'is_draw')
+                .iterator(chunk_size=chunk_size))
+
+        system = Glicko2()
+        index = {}  # ユーザーID -> 配列の添字
+        players, opponents, scores = [], [], []
+        current = None
+        periods = total = 0
+
+        def flush():
+            system.grow(len(index))
+            system.rate_period(np.array(players, dtype=np.int64), np.array(opponents, dtype=np.int64),
+                               np.array(scores, dtype=np.float64))
+            players.clear()
+            opponents.clear()
+            scores.clear()
+
+        # 対局を時刻順に流し読みし、レーティング期間ごとにまとめて計算する（メモリは1期間分だけ）
+        for created_at, p1, p2, winner, is_draw in rows:
+            key = (created_at - _EPOCH) // period
+            if key != current:
+                if players:
+                    flush()
+                    periods += 1
+                current = key
+            players.append(index.setdefault(p1, len(index)))
+            opponents.append(index.setdefault(p2, len(index)))
+            scores.append(0.5 if is_draw else 1.0 if winner == p1 else 0.0)
+            total += 1
+        if players:
+            flush()
+            periods += 1
+
+        ratings = np.maximum(np.rint(system.ratings), 0).astype(int) if len(system) else np.array([])
+        self.stdout.write(f"対局 {total:,} 件、{periods:,} 期間、{len(index):,} 人を計算しました")
+        if options['dry_run']:
+            top = sorted(index.items(), key=lambda item: -ratings[item[1]])[:10]
+            for user_id, i in top:
+                self.stdout.write(f"  user {user_id}: {ratings[i]} (RD {system.deviations[i]:.0f})")
+            return
+
+        # 対局のないユーザーは初期レートに戻す（ゲームを指定したときは、そのゲームを対局したユーザーだけを書き換える）
+        updated = 0
+        with transaction.atomic():
+            batch = []
+            for profile in UserProfile.objects.only('id', 'user_id', 'rating').iterator(chunk_size=chunk_size):
+                i = index.get(profile.user_id)
+                if i is None and options['game']:
+                    continue
+                profile.rating = int(ratings[i]) if i is not None else DEFAULT_RATING
+                batch.append(profile)
+                if len(batch) >= chunk_size:
+                    UserProfile.objects.bulk_update(batch, ['rating'])
+                    updated += len(batch)
+                    batch = []
+            if batch:
+                UserProfile.objects.bulk_update(batch, ['rating'])
+                updated += len(batch)
+        # 同じプロセスのランキング（call_command から呼んだ場合）は次に使うときに読み直す
+        leaderboard.reset()
+        self.stdout.write(f"{updated:,} 人のレートを書き込みました（起動中のサーバーのランキングは再起動後に読み直されます）")
@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from team6.broker import BrokerServer
+
+
+class Command(BaseCommand):
+    help = '複数プロセス構成用のブローカー（ルーム状態・ロック・チャネルレイヤー）を起動する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=None,
+                            help='Unix ソケットのパス（省略時は settings.TEAM6_BROKER_SOCKET）')
+        parser.add_argument('--snapshot', default=None,
+                            help='スナップショットファイルのパス（省略時は settings.TEAM6_SNAPSHOT_PATH）')
+
+    def handle(self, *args, **options):
+        path = options['socket'] or settings.TEAM6_BROKER_SOCKET
+        if not path:
+            raise CommandError('--socket か環境変数 TEAM6_BROKER_SOCKET でソケットのパスを指定してください')
+        logging.basicConfig(level=logging.INFO)
+        self.stdout.write(f"ブローカーを起動します: {path}")
+        server = BrokerServer(path, options['snapshot'] or settings.TEAM6_SNAPSHOT_PATH)
+        asyncio.run(self.serve(server))
+
+    async def serve(self, server):
+        task = asyncio.ensure_future(server.serve_forever())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            # 止めるときはスナップショットを書き出してから終わる
+            loop.add_signal_handler(sig, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import os
+import secrets
+import signal
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from team6.broker import BrokerServer
+from team6.router import MAX_HEADER, RoutingProxy, WorkerPool
+
+
+class Command(BaseCommand):
+    help = 'daphne のワーカーを複数起動し、ルームごとに担当ワーカーへ振り分けるプロキシを立てる'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='ワーカー数（省略時は CPU 数）')
+        parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス')
+        parser.add_argument('--port', type=int, default=8000, help='待ち受けるポート')
+        parser.add_argument('--socket-dir', default=None,
+                            help='ワーカーとブローカーの Unix ソケットを置くディレクトリ（省略時は一時ディレクトリ）')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO)
+        socket_dir = options['socket_dir'] or tempfile.mkdtemp(prefix='team6-')
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        broker_path = os.path.join(socket_dir, 'broker.sock')
+        sockets = {f'worker-{i}': os.path.join(socket_dir, f'worker-{i}.sock') for i in range(options['workers'])}
+
+        # ワーカーは Unix ソケットで待ち受けるので、/metrics を読むプロキシは接続元のアドレスでなく合言葉で見分ける
+        metrics_token = secrets.token_hex(16)
+        env = dict(os.environ, TEAM6_BROKER_SOCKET=broker_path, TEAM6_ROUTED_WORKER='1',
+                   TEAM6_METRICS_PROXY_TOKEN=metrics_token)
+        command = [sys.executable, '-m', 'daphne', '-u', '{socket}', 'config.asgi:application']
+        self.stdout.write(
+            f"http://{options['host']}:{options['port']}/ で待ち受けます"
+            f"（ワーカー {len(sockets)} 個、ソケット {socket_dir}）"
+        )
+        try:
+            asyncio.run(self.serve(options['host'], options['port'], broker_path, sockets, command, env, metrics_token))
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self, host, port, broker_path, sockets, command, env, metrics_token):
+        # ブローカーは同じイベントループで動かす（ワーカーからはルーム状態の書き出しにしか使われない）
+        broker = asyncio.ensure_future(BrokerServer(broker_path, settings.TEAM6_SNAPSHOT_PATH).serve_forever())
+        while not os.path.exists(broker_path):
+            await asyncio.sleep(0.05)
+
+        proxy = RoutingProxy(sockets, settings.TEAM6_METRICS_ALLOWED_IPS, metrics_token)
+        pool = WorkerPool(proxy, command, env)
+        server = await asyncio.start_server(proxy.handle, host, port, limit=MAX_HEADER)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        # SIGUSR2 は全ワーカーへ送り、プロファイラー（team6.profiling）をまとめて切り替える
+        loop.add_signal_handler(signal.SIGUSR2, pool.send_signal, signal.SIGUSR2)
+        workers = asyncio.ensure_future(pool.run())
+        try:
+            await stop.wait()
+        finally:
+            workers.cancel()
+            await pool.shutdown()
+            server.close()
+            # ブローカーはスナップショットを書き出してから止まる
+            broker.cancel()
+            await asyncio.gather(broker, return_exceptions=True)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from team6.game_logic.ecard import ROUNDS, SWITCH_EVERY
+from team6.game_logic.ecard_sim import simulate
+
+
+class Command(BaseCommand):
+    help = 'Eカードの CPU 同士を大量に対戦させ、陣営ごとの勝率と期待得点を表示する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=10_000_000, help='対戦させるラウンド数')
+        parser.add_argument('--workers', type=int, default=None, help='プロセス数（省略時は CPU 数）')
+        parser.add_argument('--seed', type=int, default=None, help='乱数のシード')
+
+    def handle(self, *args, **options):
+        result = simulate(options['rounds'], workers=options['workers'], seed=options['seed'])
+
+        self.stdout.write(f"ラウンド数: {result['rounds']:,}")
+        self.stdout.write(f"皇帝側の勝率: {result['emperor_win_rate']:.4f}")
+        self.stdout.write(f"奴隷側の勝率: {result['slave_win_rate']:.4f}")
+        self.stdout.write(
+            f"皇帝側の1ラウンドあたりの得点差: {result['emperor_edge']:+.4f}"
+            f"（均衡での理論値 {result['expected_edge']:+.4f}）"
+        )
+        for turn, count in enumerate(result['turns'], start=1):
+            self.stdout.write(f"  {turn}手目で決着: {count / max(1, result['rounds']):.4f}")
+        # 陣営は SWITCH_EVERY ラウンドごとに入れ替わるので、1試合では両者が同じ回数ずつ皇帝側になる
+        self.stdout.write(f"（1試合 {ROUNDS} ラウンド、{SWITCH_EVERY} ラウンドごとに陣営交代）")
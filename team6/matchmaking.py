@@ -0,0 +1,299 @@
+"""
+ランダムマッチング
+
+ゲーム種別ごとに待機列を持ち、レートの近いプレイヤー同士を組み合わせる。
+待機列はレートごとのバケット（待機順の deque）で、空でないレートをソート済みリストで管理するので、
+近いレートの検索は二分探索の位置から外側へたどるだけで済む。同じバケットの中ではレート差が同じで、
+先頭（最も長く待っている人）の許容レート差が最も広いので、先頭を見れば足りる。
+列から外すときは Ticket の印を消すだけで deque からは取り除かない（O(1)）。
+外れた Ticket はバケットの先頭に来たとき、または外れた分が多くなったときにまとめて捨てる。
+許容するレート差は待ち時間に応じて広がり、定期的な見直しで長く待っている人から組み合わせる。
+CPU に対応したゲームでは、BOT_TIMEOUT 秒待っても相手が見つからなければ CPU 用のルームに案内する。
+"""
+
+import asyncio
+import bisect
+import time
+import uuid
+from collections import deque
+
+from channels.layers import get_channel_layer
+
+from .metrics import Gauge
+
+GAME_TYPES = ('tictactoe', 'hitandblow', 'ecard')
+
+BASE_WINDOW = 100        # 待ち始めの許容レート差
+WIDEN_PER_SECOND = 25    # 1秒ごとに広げる許容レート差
+MAX_WINDOW = 1000        # 許容レート差の上限
+SWEEP_INTERVAL = 1.0     # 待機列を見直す間隔（秒）
+
+BOT_TIMEOUT = 20.0          # この秒数待っても相手がいなければ CPU と対戦させる
+BOT_GAMES = {'tictactoe', 'hitandblow', 'ecard'}  # CPU と対戦できるゲーム
+BOT_ROOM_PREFIX = 'bot_'    # CPU 対戦ルームの名前の接頭辞
+BOT_NAME = 'CPU (bot)'      # CPU のプレイヤー名（通常のユーザー名には使えない文字を含む）
+
+
+class Ticket:
+    """待機中のプレイヤー1人分"""
+
+    __slots__ = ('username', 'channel_name', 'rating', 'enqueued_at', 'queued')
+
+    def __init__(self, username, channel_name, rating, enqueued_at):
+        self.username = username
+        self.channel_name = channel_name
+        self.rating = rating
+        self.enqueued_at = enqueued_at
+        self.queued = False  # 待機列に入っている間だけ True（外すときはこれを消すだけ）
+
+    def window(self, now):
+        """現在の許容レート差"""
+        return min(MAX_WINDOW, BASE_WINDOW + WIDEN_PER_SECOND * (now - self.enqueued_at))
+
+
+class MatchQueue:
+    """
+    1つのゲーム種別の待機列
+
+    Attributes:
+        game (str): ゲーム種別
+        matches (int): 成立したマッチ数
+        total_wait (float): マッチ成立までの待ち時間の合計（秒）
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self._buckets = {}     # レート -> 待機順の deque（外れた Ticket が残っていることがある。先頭は必ず待機中）
+        self._live = {}        # レート -> そのバケットで待機中の人数
+        self._keys = []        # 空でないバケットのレート（昇順）
+        self._by_channel = {}  # channel_name -> Ticket
+        self._by_user = {}     # username -> Ticket
+        self.matches = 0
+        self.bot_matches = 0
+        self.total_wait = 0.0
+
+    def __len__(self):
+        return len(self._by_channel)
+
+    def add(self, ticket, now):
+        """
+        待機列に入れる。すぐに相手が見つかればその相手を列から外して返す
+
+        Returns:
+            Ticket: 対戦相手（見つからなければNone）
+        """
+        # 同じユーザーが別タブから並び直した場合は古い方を外す
+        old = self._by_user.get(ticket.username)
+        if old is not None:
+            self.remove(old.channel_name)
+
+        opponent = self._find(ticket, now)
+        if opponent is not None:
+            self.remove(opponent.channel_name)
+            self._record(now, opponent, ticket)
+            return opponent
+
+        bucket = self._buckets.get(ticket.rating)
+        if bucket is None:
+            bucket = self._buckets[ticket.rating] = deque()
+            self._live[ticket.rating] = 0
+            bisect.insort(self._keys, ticket.rating)
+        bucket.append(ticket)
+        self._live[ticket.rating] += 1
+        ticket.queued = True
+        self._by_channel[ticket.channel_name] = ticket
+        self._by_user[ticket.username] = ticket
+        return None
+
+    def remove(self, channel_name):
+        """待機列から外す（いなければ何もしない）"""
+        ticket = self._by_channel.pop(channel_name, None)
+        if ticket is None:
+            return None
+        del self._by_user[ticket.username]
+        ticket.queued = False
+        key = ticket.rating
+        self._live[key] -= 1
+        if not self._live[key]:
+            del self._buckets[key], self._live[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            return ticket
+        bucket = self._buckets[key]
+        if len(bucket) > 2 * self._live[key]:
+            # 外れた Ticket の方が多くなったら詰め直す（詰め直しの手間は外した回数で割ると O(1)）
+            self._buckets[key] = deque(t for t in bucket if t.queued)
+        else:
+            while not bucket[0].queued:
+                bucket.popleft()
+        return ticket
+
+    def sweep(self, now):
+        """
+        許容レート差が広がった待機者同士を組み合わせる
+
+        Returns:
+            list: 成立したペア [(Ticket, Ticket), ...]
+        """
+        pairs = []
+        # 各バケットの先頭（最も長く待っている人）から順に相手を探す
+        heads = sorted((self._buckets[k][0] for k in self._keys), key=lambda t: t.enqueued_at)
+        for ticket in heads:
+            if not ticket.queued:
+                continue
+            opponent = self._find(ticket, now)
+            if opponent is None:
+                continue
+            self.remove(ticket.channel_name)
+            self.remove(opponent.channel_name)
+            self._record(now, ticket, opponent)
+            pairs.append((ticket, opponent))
+        return pairs
+
+    def pop_expired(self, now, timeout):
+        """
+        timeout 秒以上待っている待機者を列から外して返す
+
+        Returns:
+            list: 外した Ticket のリスト
+        """
+        expired = []
+        for key in list(self._keys):
+            # 各バケットは待機順なので、先頭から期限切れの間だけ取り出せばよい
+            while key in self._buckets and now - self._buckets[key][0].enqueued_at >= timeout:
+                expired.append(self.remove(self._buckets[key][0].channel_name))
+        for ticket in expired:
+            self.bot_matches += 1
+            self.total_wait += now - ticket.enqueued_at
+        return expired
+
+    def oldest_wait(self, now):
+        if not self._keys:
+            return 0.0
+        return max(now - self._buckets[k][0].enqueued_at for k in self._keys)
+
+    def _find(self, ticket, now):
+        """
+        レート差が許容範囲に収まる相手のうち、レートが最も近い人を探す（同じ差なら長く待っている人）
+
+        待機中の ticket 自身は相手にしない（sweep から呼ぶ場合）
+        """
+        own_window = ticket.window(now)
+        # 自分のレートから近い順に、上下のバケットを交互に見ていく
+        right = bisect.bisect_left(self._keys, ticket.rating)
+        left = right - 1
+        while left >= 0 or right < len(self._keys):
+            go_left = right >= len(self._keys) or (
+                left >= 0 and ticket.rating - self._keys[left] <= self._keys[right] - ticket.rating
+            )
+            key = self._keys[left] if go_left else self._keys[right]
+            gap = abs(key - ticket.rating)
+            # これより遠いバケットはレート差が上限を超える
+            if gap > MAX_WINDOW:
+                break
+            for candidate in self._buckets[key]:
+                if not candidate.queued or candidate.username == ticket.username:
+                    continue
+                if gap <= max(own_window, candidate.window(now)):
+                    return candidate
+                # 同じバケットでは最も長く待っている人が最も許容差が広いので、その人で駄目なら次のバケットへ
+                break
+            if go_left:
+                left -= 1
+            else:
+                right += 1
+        return None
+
+    def _record(self, now, *tickets):
+        self.matches += 1
+        self.total_wait += sum(now - t.enqueued_at for t in tickets)
+
+
+class MatchmakingService:
+    """ゲーム種別ごとの待機列をまとめ、成立したマッチを双方に通知する"""
+
+    def __init__(self):
+        self.queues = {game: MatchQueue(game) for game in GAME_TYPES}
+        self._sweeper = None
+
+    async def join(self, game, username, channel_name, rating):
+        """
+        待機列に入る。相手が見つかれば双方に match_found_event を送る
+
+        Returns:
+            bool: すぐにマッチが成立したらTrue
+        """
+        now = time.monotonic()
+        ticket = Ticket(username, channel_name, rating, now)
+        opponent = self.queues[game].add(ticket, now)
+        if opponent is not None:
+            await self._notify(game, opponent, ticket)
+            return True
+        self._ensure_sweeper()
+        return False
+
+    def leave(self, game, channel_name):
+        self.queues[game].remove(channel_name)
+
+    def stats(self):
+        """
+        待機列の統計
+
+        Returns:
+            dict: {ゲーム種別: {'depth', 'oldest_wait', 'matches', 'avg_wait'}}
+        """
+        now = time.monotonic()
+        return {
+            game: {
+                'depth': len(queue),
+                'oldest_wait': queue.oldest_wait(now),
+                'matches': queue.matches,
+                'bot_matches': queue.bot_matches,
+                'avg_wait': (queue.total_wait / (2 * queue.matches + queue.bot_matches)
+                             if queue.matches or queue.bot_matches else 0.0),
+            }
+            for game, queue in self.queues.items()
+        }
+
+    async def _notify(self, game, *tickets, prefix='match_'):
+        room_name = f"{prefix}{uuid.uuid4().hex[:8]}"
+        channel_layer = get_channel_layer()
+        for ticket in tickets:
+            await channel_layer.send(
+                ticket.channel_name,
+                {'type': 'match_found_event', 'room_name': room_name, 'game': game}
+            )
+
+    def _ensure_sweeper(self):
+        loop = asyncio.get_running_loop()
+        if self._sweeper is None or self._sweeper.done() or self._sweeper.get_loop() is not loop:
+            self._sweeper = loop.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while any(len(queue) for queue in self.queues.values()):
+            await asyncio.sleep(SWEEP_INTERVAL)
+            now = time.monotonic()
+            for game, queue in self.queues.items():
+                for pair in queue.sweep(now):
+                    await self._notify(game, *pair)
+                if game in BOT_GAMES:
+                    for ticket in queue.pop_expired(now, BOT_TIMEOUT):
+                        await self._notify(game, ticket, prefix=BOT_ROOM_PREFIX)
+
+
+matchmaking = MatchmakingService()
+
+Gauge('team6_matchmaking_queue_depth', 'Players waiting in matchmaking', ['game'],
+      collect=lambda: {(game,): s['depth'] for game, s in matchmaking.stats().items()})
+Gauge('team6_matchmaking_oldest_wait_seconds', 'Longest current wait in matchmaking', ['game'],
+      collect=lambda: {(game,): s['oldest_wait'] for game, s in matchmaking.stats().items()})
+
+
+def _match_counts():
+    counts = {}
+    for game, s in matchmaking.stats().items():
+        counts[(game, 'player')] = s['matches']
+        counts[(game, 'bot')] = s['bot_matches']
+    return counts
+
+
+Gauge('team6_matchmaking_matches', 'Matches made since start', ['game', 'kind'], collect=_match_counts)
@@ -0,0 +1,243 @@
+"""
+メトリクス（Prometheus のテキスト形式で /metrics に出す）
+
+記録はプロセス内の dict の加算だけで、文字列にするのは /metrics が読まれたときだけ。
+ゲージ（ルーム数やマッチングの待機人数など）は記録せず、読まれたときに関数で集める。
+値はイベントループ上で更新・出力する（/metrics のビューも async にしている）。
+"""
+
+import asyncio
+import bisect
+import logging
+import re
+import time
+
+from .channel_layers import ThrottledInMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# 秒単位の遅延用（0.1ms 〜 10s）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+# group_send の配信先の数用
+FANOUT_BUCKETS = (0, 1, 2, 3, 4, 8, 16, 32, 64, 128)
+# メッセージの type はクライアントが決めるので、形と種類数を制限してラベルが増え続けないようにする
+MAX_MESSAGE_TYPES = 100
+_MESSAGE_TYPE = re.compile(r'^[A-Za-z0-9_]{1,32}$')
+LAG_INTERVAL = 0.25  # イベントループの遅れを測る間隔（秒）
+LAG_WARNING = 0.1    # これ以上遅れたらログに出す（秒）
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _samples(self):
+        return [f'{self.name}{_labels(self.label_names, k)} {_number(v)}' for k, v in self.values.items()]
+
+
+class Gauge(_Metric):
+    """
+    読まれたときに collect() で値を集めるゲージ
+
+    Args:
+        collect: 引数なしで {ラベル値のタプル: 値} を返す関数
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def _samples(self):
+        return [f'{self.name}{_labels(self.label_names, k)} {_number(v)}' for k, v in self.collect().items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # ラベル値 -> [バケットごとの件数..., 上限超えの件数, 合計]
+
+    def observe(self, *labels, value):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def time(self, *labels):
+        """with metric.time(ラベル...): の中の経過時間を記録する"""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        lines = []
+        for labels, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, [le])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {_number(entry[-1])}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('metric', 'labels', 'start')
+
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metric.observe(*self.labels, value=time.perf_counter() - self.start)
+
+
+def render():
+    """登録済みの全メトリクスを Prometheus のテキスト形式にする"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# --- WebSocket ---
+
+ws_connects = Counter('team6_ws_connects_total', 'WebSocket connections opened', ['game'])
+ws_disconnects = Counter('team6_ws_disconnects_total', 'WebSocket connections closed', ['game'])
+ws_messages = Counter('team6_ws_messages_total', 'WebSocket messages received', ['game', 'type'])
+ws_handler_seconds = Histogram('team6_ws_handler_seconds', 'Time spent in consumer handlers', ['game', 'handler'])
+room_handler_seconds = Histogram('team6_room_handler_seconds', 'Time spent in room actor handlers', ['game', 'handler'])
+room_queue_seconds = Histogram('team6_room_queue_seconds', 'Time events wait in a room actor inbox', ['game'])
+group_sends = Counter('team6_group_send_total', 'group_send calls', ['layer'])
+room_sends = Counter('team6_room_send_total', 'Room messages sent to members', ['path'])
+group_send_fanout = Histogram('team6_group_send_fanout', 'Channels reached per group_send', buckets=FANOUT_BUCKETS)
+
+# --- ルーム状態ストア ---
+
+store_ops = Counter('team6_store_ops_total', 'Room state store operations', ['op'])
+store_backing_seconds = Histogram('team6_store_backing_seconds', 'Room state backing store latency', ['op'])
+
+# --- イベントループ ---
+
+event_loop_lag = Histogram('team6_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task')
+
+
+class LagMonitor:
+    """
+    LAG_INTERVAL ごとに眠って、予定よりどれだけ遅れて起きたかを記録する
+    （同期処理でイベントループが止まっていると遅れとして表れる）
+
+    Attributes:
+        max_lag (float): これまでの最大の遅れ（秒）
+    """
+
+    def __init__(self):
+        self._task = None
+        self.max_lag = 0.0
+
+    def ensure(self):
+        """実行中のイベントループで計測を始める（始まっていれば何もしない）"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(0.0, loop.time() - start - LAG_INTERVAL)
+            event_loop_lag.observe(value=lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= LAG_WARNING:
+                logger.warning("event loop was blocked for %.0f ms", lag * 1000)
+
+
+lag_monitor = LagMonitor()
+
+
+class MetricsMixin:
+    """
+    コンシューマーの接続・切断・受信メッセージ・ハンドラーの処理時間を記録する
+
+    Attributes:
+        metrics_game (str): メトリクスのラベルにするゲーム名
+    """
+
+    metrics_game = 'other'
+
+    async def dispatch(self, message):
+        # websocket.connect / websocket.receive / websocket.disconnect と、グループから届く *_event を
+        # すべてここを通して計る（ハンドラー名は type の '.' を '_' にしたもの）
+        kind = message['type']
+        if kind == 'websocket.connect':
+            ws_connects.inc(self.metrics_game)
+        elif kind == 'websocket.disconnect':
+            ws_disconnects.inc(self.metrics_game)
+        lag_monitor.ensure()
+        with ws_handler_seconds.time(self.metrics_game, kind.replace('.', '_')):
+            await super().dispatch(message)
+
+    def count_message(self, data):
+        """受信した JSON メッセージを種類ごとに数える（data をそのまま返す）"""
+        kind = data.get('type') if isinstance(data, dict) else None
+        if not isinstance(kind, str) or not _MESSAGE_TYPE.match(kind):
+            kind = 'invalid'
+        elif (self.metrics_game, kind) not in ws_messages.values and len(ws_messages.values) >= MAX_MESSAGE_TYPES:
+            kind = 'other'
+        ws_messages.inc(self.metrics_game, kind)
+        return data
+
+
+class MeasuredInMemoryChannelLayer(ThrottledInMemoryChannelLayer):
+    """group_send の配信先の数を記録する ThrottledInMemoryChannelLayer"""
+
+    async def group_send(self, group, message):
+        group_sends.inc('memory')
+        group_send_fanout.observe(value=len(self.groups.get(group, ())))
+        await super().group_send(group, message)
@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team6', '0002_userprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamerecord',
+            name='end_reason',
+            field=models.CharField(choices=[('normal', '決着'), ('retired', 'リタイア・切断')], default='normal', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='gamerecord',
+            name='game_type',
+            field=models.CharField(choices=[('tictactoe', '三目並べ'), ('hitandblow', 'ヒット・アンド・ブロー'), ('ecard', 'Eカード')], default='tictactoe', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='gamerecord',
+            name='is_draw',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='gamerecord',
+            name='moves',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.AddField(
+            model_name='gamerecord',
+            name='player1_first',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 6.0 on 2026-10-18 11:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team6', '0003_gamerecord_moves'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserGameStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game_type', models.CharField(choices=[('tictactoe', '三目並べ'), ('hitandblow', 'ヒット・アンド・ブロー'), ('ecard', 'Eカード')], max_length=16)),
+                ('wins', models.IntegerField(default=0)),
+                ('losses', models.IntegerField(default=0)),
+                ('draws', models.IntegerField(default=0)),
+                ('streak', models.IntegerField(default=0)),
+                ('best_streak', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gamerecord',
+            index=models.Index(fields=['player1', '-created_at', '-id'], name='gamerecord_p1_created'),
+        ),
+        migrations.AddIndex(
+            model_name='gamerecord',
+            index=models.Index(fields=['player2', '-created_at', '-id'], name='gamerecord_p2_created'),
+        ),
+        migrations.AddField(
+            model_name='usergamestats',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='game_stats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='usergamestats',
+            constraint=models.UniqueConstraint(fields=('user', 'game_type'), name='usergamestats_user_game'),
+        ),
+    ]
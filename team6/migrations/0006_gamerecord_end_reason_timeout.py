@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team6', '0005_userprofile_rating_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='gamerecord',
+            name='end_reason',
+            field=models.CharField(choices=[('normal', '決着'), ('retired', 'リタイア・切断'), ('timeout', '時間切れ')], default='normal', max_length=16),
+        ),
+    ]
@@ -3,23 +3,92 @@ from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-# --- 既存のGameRecordはそのまま ---
+# 対局記録（team6/records.py がまとめて書き込む）
 class GameRecord(models.Model):
+    GAME_TYPE_CHOICES = [
+        ('tictactoe', '三目並べ'),
+        ('hitandblow', 'ヒット・アンド・ブロー'),
+        ('ecard', 'Eカード'),
+    ]
+    END_REASON_CHOICES = [
+        ('normal', '決着'),
+        ('retired', 'リタイア・切断'),
+        ('timeout', '時間切れ'),
+    ]
+
     player1 = models.ForeignKey(User, related_name='games_as_p1', on_delete=models.CASCADE)
+    # CPU 対戦では player2 が空
     player2 = models.ForeignKey(User, related_name='games_as_p2', on_delete=models.CASCADE, null=True, blank=True)
+    # 引き分け、または CPU の勝ちなら空（is_draw で区別する）
     winner = models.ForeignKey(User, related_name='games_won', on_delete=models.SET_NULL, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    game_type = models.CharField(max_length=16, choices=GAME_TYPE_CHOICES, default='tictactoe')
+    is_draw = models.BooleanField(default=False)
+    end_reason = models.CharField(max_length=16, choices=END_REASON_CHOICES, default='normal')
+    # player1 が先攻（三目並べの X、ヒット・アンド・ブローの先攻、Eカードの最初の皇帝側）か
+    player1_first = models.BooleanField(default=True)
+    # 手順（形式は team6/game_logic/move_codec.py）
+    moves = models.BinaryField(default=b'', blank=True)
+
+    class Meta:
+        # ユーザーごとの対戦履歴を新しい順にたどるための索引（キーセット・ページネーション用）
+        indexes = [
+            models.Index(fields=['player1', '-created_at', '-id'], name='gamerecord_p1_created'),
+            models.Index(fields=['player2', '-created_at', '-id'], name='gamerecord_p2_created'),
+        ]
+
     def __str__(self):
         return f"Match: {self.player1} vs {self.player2} ({self.created_at})"
 
 # ユーザープロフィール (レート管理)
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
-    rating = models.IntegerField(default=1500)  # 初期レート 1500
+    rating = models.IntegerField(default=1500, db_index=True)  # 初期レート 1500（ランキング用に索引を張る）
 
     def __str__(self):
         return f"{self.user.username} (Rate: {self.rating})"
 
+# ユーザー・ゲームごとの通算成績（対局記録の書き込み時にまとめて更新する）
+class UserGameStats(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='game_stats')
+    game_type = models.CharField(max_length=16, choices=GameRecord.GAME_TYPE_CHOICES)
+    wins = models.IntegerField(default=0)
+    losses = models.IntegerField(default=0)
+    draws = models.IntegerField(default=0)
+    streak = models.IntegerField(default=0)       # 正なら連勝数、負なら連敗数
+    best_streak = models.IntegerField(default=0)  # 最長連勝
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'game_type'], name='usergamestats_user_game'),
+        ]
+
+    @property
+    def games(self):
+        return self.wins + self.losses + self.draws
+
+    def add_result(self, result):
+        """
+        1局分の結果を反映する
+
+        Args:
+            result (str): 'win' / 'loss' / 'draw'
+        """
+        if result == 'win':
+            self.wins += 1
+            self.streak = self.streak + 1 if self.streak > 0 else 1
+            self.best_streak = max(self.best_streak, self.streak)
+        elif result == 'loss':
+            self.losses += 1
+            self.streak = self.streak - 1 if self.streak < 0 else -1
+        else:
+            self.draws += 1
+            self.streak = 0
+
+    def __str__(self):
+        return f"{self.user.username} {self.game_type}: {self.wins}W {self.losses}L {self.draws}D"
+
 # ユーザー作成時に自動的にプロフィールも作る設定
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -0,0 +1,207 @@
+"""
+サンプリング・プロファイラー（イベントループを止めているハンドラーを探すため）
+
+有効にすると別スレッドが SAMPLE_INTERVAL ごとにイベントループのスレッド（メインスレッド）の
+スタックを覗き、実行中だったハンドラーごとに数える。ハンドラーのコードには手を入れないので、
+止めている間は負荷がなく、動かしている間もスタックを辿る分だけで済む。
+ハンドラーはスタックを根元から見て決める:
+    - コンシューマーの dispatch より先の最初のこのプロジェクトのフレーム（connect / receive / disconnect / *_event）
+    - ルームのアクターが実行しているハンドラー（room:join_room など）
+イベントループが待機中（selectors）のサンプルは (idle) として数えるだけにする。
+
+有効にする方法:
+    - settings.TEAM6_PROFILE（環境変数 TEAM6_PROFILE=1）で起動時から
+    - 実行中のプロセスに SIGUSR2 を送るたびに開始・停止（停止時とプロセス終了時にファイルへ書き出す）
+結果は settings.TEAM6_PROFILE_DIR に profile-<pid>-<時刻>.txt として書き出すほか、
+スタッフユーザーは /profile で今の集計を見られる。
+"""
+
+import atexit
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.01  # サンプリング間隔（秒）
+MAX_DEPTH = 128         # 辿るフレームの上限
+MAX_STACKS = 500        # 集計結果に出すスタックの数
+
+IDLE = '(idle)'
+OTHER = '(other)'
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _frame_name(code):
+    filename = code.co_filename
+    if filename.startswith(_PROJECT_DIR):
+        filename = os.path.relpath(filename, _PROJECT_DIR)
+    else:
+        filename = os.path.basename(filename)
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({filename})"
+
+
+def _anchors():
+    from .rooms import RoomActor
+    return metrics.MetricsMixin.dispatch.__code__, RoomActor._run.__code__, RoomActor._handle_shared.__code__
+
+
+def _classify(frame, anchors):
+    """
+    Returns:
+        tuple: (ハンドラー名, スタック（根元から）または None)
+    """
+    codes = []
+    while frame is not None and len(codes) < MAX_DEPTH:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    if not codes:
+        return OTHER, None
+    codes.reverse()
+    if os.path.basename(codes[-1].co_filename) == 'selectors.py':
+        return IDLE, None
+
+    dispatch, actor_run, handle_shared = anchors
+    for i, code in enumerate(codes):
+        if code is dispatch or code is actor_run:
+            rest = [c for c in codes[i + 1:] if c is not handle_shared]
+            # ライブラリのフレーム（channels の websocket_receive など）は飛ばしてこのプロジェクトのフレームで名付ける
+            own = next((c for c in rest if c.co_filename.startswith(_PROJECT_DIR)), rest[0] if rest else code)
+            label = getattr(own, 'co_qualname', own.co_name)
+            if code is actor_run:
+                label = f'room:{label}'
+            return label, tuple(_frame_name(c) for c in codes[i:])
+    return OTHER, tuple(_frame_name(c) for c in codes[-20:])
+
+
+class Sampler:
+    """
+    Attributes:
+        samples (int): サンプル数
+        handlers (dict): ハンドラー -> サンプル数
+        stacks (dict): (ハンドラー, スタック) -> サンプル数
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+        self.reset()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def reset(self):
+        with self._lock:
+            self.samples = 0
+            self.handlers = {}
+            self.stacks = {}
+            self.started_at = time.time()
+
+    def start(self, thread_id=None):
+        """thread_id のスレッド（省略時はメインスレッド＝イベントループ）のサンプリングを始める"""
+        if self.running:
+            return
+        self._target = thread_id or threading.main_thread().ident
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='team6-sampler', daemon=True)
+        self._thread.start()
+        logger.info("profiler started (every %.0f ms)", self.interval * 1000)
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        anchors = _anchors()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            label, stack = _classify(frame, anchors)
+            del frame
+            with self._lock:
+                self.samples += 1
+                self.handlers[label] = self.handlers.get(label, 0) + 1
+                if stack is not None:
+                    key = (label, stack)
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def report(self):
+        """
+        集計結果をテキストにする
+
+        Returns:
+            str: ハンドラーごとの割合と、折りたたみ形式のスタック（flamegraph.pl や speedscope で読める）
+        """
+        with self._lock:
+            samples = self.samples
+            handlers = dict(self.handlers)
+            stacks = dict(self.stacks)
+        busy = samples - handlers.get(IDLE, 0)
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at))
+        lines = [
+            f"# {samples} samples every {self.interval * 1000:.0f} ms since {started} (pid {os.getpid()})",
+            f"# event loop lag: max {metrics.lag_monitor.max_lag * 1000:.1f} ms",
+            "# handler\tsamples\tof all\tof busy",
+        ]
+        for label, count in sorted(handlers.items(), key=lambda item: -item[1]):
+            of_busy = f"{count / busy:.1%}" if busy and label != IDLE else '-'
+            lines.append(f"{label}\t{count}\t{count / max(1, samples):.1%}\t{of_busy}")
+        lines += ['', '# folded stacks: handler;frame;...;frame samples']
+        for (label, stack), count in sorted(stacks.items(), key=lambda item: -item[1])[:MAX_STACKS]:
+            lines.append(';'.join((label,) + stack) + f' {count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, directory):
+        """集計結果をファイルに書き出し、そのパスを返す"""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.report())
+        return path
+
+
+sampler = Sampler()
+
+
+def _dump():
+    path = sampler.dump(settings.TEAM6_PROFILE_DIR)
+    logger.warning("profile written to %s", path)
+
+
+def _toggle(signum, frame):
+    if sampler.running:
+        sampler.stop()
+        _dump()
+    else:
+        sampler.reset()
+        sampler.start()
+
+
+@atexit.register
+def _dump_on_exit():
+    if sampler.running:
+        sampler.stop()
+        _dump()
+
+
+def install():
+    """SIGUSR2 での切り替えを登録し、設定で有効なら開始する（AppConfig.ready から呼ぶ）"""
+    if hasattr(signal, 'SIGUSR2') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, _toggle)
+    if getattr(settings, 'TEAM6_PROFILE', False):
+        sampler.start()
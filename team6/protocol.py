@@ -0,0 +1,220 @@
+"""
+差分配信プロトコル
+
+ルーム状態を毎回まるごと送る代わりに、前回からの差分（op のリスト）に連番を付けて送る。
+クライアントは接続URLに ?proto=delta を付けたときだけ差分を受け取り、
+参加直後や連番が飛んだときはスナップショット（状態全体）を受け取る。
+付けない古いクライアントにはこれまで通り状態全体を送る。
+グループへの配信では送りうるフレームを送信側で1回だけ JSON 文字列にし（encode_state_frames）、
+受け取った各接続はそれをそのまま送る（send_frames）。
+ルームは直近 REPLAY_SIZE 件の差分を残しておき、再接続したクライアントには見逃した差分だけを送り直せる
+（team6.resume）。
+
+op の形式（JSONの配列）:
+    ['s', key, value]         キーの値を置き換える
+    ['d', key]                キーを削除する
+    ['c', key, index, value]  リストの1要素を置き換える（盤面のマスなど）
+    ['a', key, [items...]]    リストの末尾に追加する（履歴など）
+"""
+
+import json
+import secrets
+from collections import deque
+from urllib.parse import parse_qs
+
+REPLAY_SIZE = 64  # ルームごとに残しておく差分の件数（再接続時の送り直し用）
+
+
+def wants_delta(scope):
+    """接続URLのクエリで差分モードが指定されているか"""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('proto', [''])[0] == 'delta'
+
+
+def _copy(value):
+    # リスト・辞書は1段だけコピーする（履歴の各要素は追加後に変更しない前提）
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def diff_state(old, new):
+    """
+    2つの状態の差分を op のリストで返す
+
+    Args:
+        old (dict): 前回送った状態
+        new (dict): 新しい状態
+
+    Returns:
+        list: op のリスト
+    """
+    ops = []
+    for key, value in new.items():
+        if key not in old:
+            ops.append(['s', key, value])
+            continue
+        before = old[key]
+        if before == value:
+            continue
+        if isinstance(before, list) and isinstance(value, list):
+            if len(value) > len(before) and value[:len(before)] == before:
+                ops.append(['a', key, value[len(before):]])
+                continue
+            if len(value) == len(before):
+                cells = [['c', key, i, v] for i, (b, v) in enumerate(zip(before, value)) if b != v]
+                if len(cells) * 2 < len(value):
+                    ops.extend(cells)
+                    continue
+        ops.append(['s', key, value])
+    for key in old:
+        if key not in new:
+            ops.append(['d', key])
+    return ops
+
+
+def apply_ops(state, ops):
+    """差分を状態に適用する（クライアント側の処理と同じ。検証用）"""
+    for op in ops:
+        kind, key = op[0], op[1]
+        if kind == 's':
+            state[key] = op[2]
+        elif kind == 'd':
+            state.pop(key, None)
+        elif kind == 'c':
+            state[key][op[2]] = op[3]
+        elif kind == 'a':
+            state[key].extend(op[2])
+    return state
+
+
+def encode_frame(message):
+    """メッセージを WebSocket に送るテキストにする"""
+    return json.dumps(message, separators=(',', ':'))
+
+
+def _with_seq(text, seq):
+    # スナップショットの JSON の末尾に連番を足す（状態を JSON 化し直さない）
+    return f'{text[:-1]}{"," if len(text) > 2 else ""}"seq":{seq}}}'
+
+
+def encode_state_frames(state, seq, ops, snapshot_type='game_state'):
+    """
+    1回の配信で送りうるフレームを先に JSON 文字列にしておく
+
+    接続の数だけ状態を JSON 化する代わりに、送信側で1回だけ行う。
+    文字列は変更されないので、チャネルレイヤーが受信者ごとにメッセージをコピーしても安い。
+
+    Args:
+        state (dict): 配信する状態
+        seq (int): StateStream.advance の連番
+        ops (list): StateStream.advance の差分（None なら差分は送れない）
+        snapshot_type (str): スナップショットに付ける 'type'
+
+    Returns:
+        dict: {'seq': 連番, 'full': スナップショット, 'delta': 差分（なければ None）}
+    """
+    message = {'type': snapshot_type} if snapshot_type else {}
+    message.update(state)
+    return {
+        'seq': seq,
+        'full': encode_frame(message),
+        'delta': encode_frame({'type': 'delta', 'seq': seq, 'ops': ops}) if ops is not None else None,
+    }
+
+
+class StateStream:
+    """
+    ルームごとの連番と、前回配信した状態
+
+    Attributes:
+        seq (int): 最後に配信した連番（0 は未配信）
+        last (dict): 最後に配信した状態
+        epoch (str): この連番の系列の識別子（アクターが作り直されて連番が振り直されたら変わる）
+        replay (deque): 直近の (連番, 差分のフレーム)
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.last = None
+        self.epoch = secrets.token_hex(4)
+        self.replay = deque(maxlen=REPLAY_SIZE)
+
+    def advance(self, state):
+        """
+        新しい状態を記録し、連番と差分を返す
+
+        Returns:
+            tuple: (連番, op のリスト。前回の状態がなければNone)
+        """
+        ops = diff_state(self.last, state) if self.last is not None else None
+        self.seq += 1
+        self.last = {key: _copy(value) for key, value in state.items()}
+        return self.seq, ops
+
+    def publish(self, state, snapshot_type='game_state'):
+        """
+        advance して配信用のフレームを作り、差分を送り直し用に残す
+
+        Returns:
+            dict: encode_state_frames のフレーム
+        """
+        seq, ops = self.advance(state)
+        frames = encode_state_frames(state, seq, ops, snapshot_type)
+        if frames['delta'] is None:
+            # 差分でつなげない（この前の連番からは送り直せない）
+            self.replay.clear()
+        else:
+            self.replay.append((seq, frames['delta']))
+        return frames
+
+    def replay_since(self, seq):
+        """
+        seq より後の差分のフレームを返す
+
+        Returns:
+            list: 連番の順のフレーム。残っていない連番があれば None
+        """
+        if seq == self.seq:
+            return []
+        missed = [text for s, text in self.replay if s > seq]
+        # 共有モードでは別のプロセスが配信した連番が抜けている
+        if not missed or len(missed) != self.seq - seq or self.replay[-1][0] != self.seq:
+            return None
+        return missed
+
+
+class DeltaStateMixin:
+    """
+    コンシューマー用: 接続ごとに差分モードかどうかと、最後に送った連番を管理する
+
+    snapshot_type はスナップショットに付ける 'type'（None なら付けない）
+    """
+
+    snapshot_type = 'game_state'
+
+    def setup_state_sync(self):
+        self.delta_mode = wants_delta(self.scope)
+        self.last_seq = None
+
+    async def send_frames(self, frames):
+        """encode_state_frames で用意したフレームから、この接続に送るものを選んでそのまま送る"""
+        seq = frames['seq']
+        if self.last_seq is not None and 0 < seq <= self.last_seq:
+            return
+        if self.delta_mode and frames['delta'] is not None and self.last_seq == seq - 1:
+            text = frames['delta']
+        elif self.delta_mode:
+            text = _with_seq(frames['full'], seq)
+        else:
+            text = frames['full']
+        self.last_seq = seq
+        await self.send(text_data=text)
+
+    async def send_snapshot(self, room):
+        """最後に配信した状態をこの接続にだけ送り直す（クライアントからの resync 要求）"""
+        if room.stream.last is not None:
+            self.last_seq = None
+            await self.send_frames(encode_state_frames(room.stream.last, room.stream.seq, None, self.snapshot_type))
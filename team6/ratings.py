@@ -0,0 +1,93 @@
+"""
+レーティング（イロレーティング）
+
+対局結果は rating_queue に積み、ライトビハインドでまとめて反映する。
+1回の書き込みでは、バッチに出てくる全ユーザーの現在のレートを1回の SELECT で読み、
+結果を古い順に適用してから、1回の UPDATE ... CASE で書き戻す（全体を1トランザクションで行う）。
+コミット後に新しいレートをランキング（leaderboard）にも反映する（複数プロセス構成では全プロセスのランキングへ送る）。
+"""
+
+import atexit
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from .leaderboard import leaderboard
+from .models import UserProfile
+from .write_behind import WriteBehindQueue
+
+DEFAULT_RATING = 1500
+K_FACTOR = 32
+MIN_RATING = 0
+
+
+def expected_score(rating, opponent_rating):
+    """rating の側が勝つ期待値（0〜1）"""
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def elo_delta(rating, opponent_rating, score):
+    """
+    イロレーティングの変動量
+
+    Args:
+        rating (int): 自分のレート
+        opponent_rating (int): 相手のレート
+        score (float): 自分の結果（勝ち 1、引き分け 0.5、負け 0）
+
+    Returns:
+        int: 自分のレートの変動量（相手はこの符号を反転した値）
+    """
+    return round(K_FACTOR * (score - expected_score(rating, opponent_rating)))
+
+
+def apply_results(results):
+    """
+    対局結果をまとめてレートに反映する（同期関数。WriteBehindQueue から呼ばれる）
+
+    Args:
+        results (list): (プレイヤー名, 相手の名前, プレイヤーの結果) のリスト（古い順）
+    """
+    names = {name for a, b, _ in results for name in (a, b)}
+    with transaction.atomic():
+        rows = (UserProfile.objects.select_for_update()
+                .filter(user__username__in=names)
+                .values_list('user__username', 'id', 'rating'))
+        ids = {}
+        ratings = {}
+        for username, profile_id, rating in rows:
+            ids[username] = profile_id
+            ratings[username] = rating
+
+        for a, b, score in results:
+            if a not in ratings or b not in ratings:
+                # 退会したユーザーなど
+                continue
+            delta = elo_delta(ratings[a], ratings[b], score)
+            ratings[a] = max(MIN_RATING, ratings[a] + delta)
+            ratings[b] = max(MIN_RATING, ratings[b] - delta)
+
+        if ratings:
+            UserProfile.objects.filter(id__in=ids.values()).update(rating=Case(
+                *[When(id=ids[name], then=Value(rating)) for name, rating in ratings.items()],
+                output_field=IntegerField(),
+            ))
+            # ランキングにはコミットできた値だけを反映する（複数プロセス構成では全プロセスへ送る）
+            transaction.on_commit(lambda: leaderboard.publish(ratings))
+
+
+rating_queue = WriteBehindQueue(apply_results)
+# 終了時（SIGTERM やワーカーの再起動）にまだ書き込んでいない対局結果を失わないようにする
+atexit.register(rating_queue.drain)
+
+
+def record_result(player, opponent, score):
+    """
+    対局結果をレート更新キューに積む（DB は待たない）
+
+    Args:
+        player (str): プレイヤー名
+        opponent (str): 相手の名前
+        score (float): player の結果（勝ち 1、引き分け 0.5、負け 0）
+    """
+    rating_queue.put((player, opponent, score))
@@ -0,0 +1,192 @@
+"""
+対局記録の保存と参照
+
+終了した対局は record_game でキューに積むだけで、DB への書き込みは
+ライトビハインドでまとめて行う（ユーザー名 -> ID の変換を1回の SELECT、
+GameRecord の作成を1回の bulk_create で済ませる）。対局の終了処理が DB を待つことはない。
+プロセスの終了時にキューに残っている分は同期的に書き込む。
+同じトランザクションで UserGameStats（通算成績）も差分だけ更新するので、
+成績の表示で GameRecord を数え直す必要はない。
+
+対戦履歴は (created_at, id) のカーソルで新しい順にたどる（OFFSET を使わない）。
+"""
+
+import atexit
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+
+from .models import GameRecord, UserGameStats
+from .write_behind import WriteBehindQueue
+
+HISTORY_LIMIT = 20       # 履歴の1ページの件数（デフォルト）
+MAX_HISTORY_LIMIT = 100  # 履歴の1ページの件数の上限
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def save_records(batch):
+    """
+    対局記録をまとめて書き込む（同期関数。WriteBehindQueue から呼ばれる）
+
+    Args:
+        batch (list): record_game に渡された内容のタプルのリスト
+    """
+    names = {name for item in batch for name in item[1:4] if name}
+    ids = dict(User.objects.filter(username__in=names).values_list('username', 'id'))
+
+    rows = []
+    for game_type, first, second, winner, moves, end_reason in batch:
+        first_id, second_id = ids.get(first), ids.get(second)
+        if first_id is None and second_id is None:
+            continue
+        # player1 には必ず人を入れる（CPU は ID を持たない）
+        player1_first = first_id is not None
+        rows.append(GameRecord(
+            player1_id=first_id if player1_first else second_id,
+            player2_id=second_id if player1_first else None,
+            winner_id=ids.get(winner),
+            is_draw=(winner == 'draw'),
+            game_type=game_type,
+            end_reason=end_reason,
+            player1_first=player1_first,
+            moves=moves,
+        ))
+    with transaction.atomic():
+        GameRecord.objects.bulk_create(rows)
+        update_stats(rows)
+
+
+def _results(record):
+    """GameRecord から (ユーザーID, 'win' / 'loss' / 'draw') を列挙する"""
+    for user_id in (record.player1_id, record.player2_id):
+        if user_id is None:
+            continue
+        if record.is_draw:
+            yield user_id, 'draw'
+        elif record.winner_id == user_id:
+            yield user_id, 'win'
+        else:
+            yield user_id, 'loss'
+
+
+def update_stats(records):
+    """
+    対局記録の分だけ通算成績を更新する（呼び出し側のトランザクション内で実行する）
+
+    対象ユーザーの成績を1回の SELECT で読み、新しい行は bulk_create、既存の行は bulk_update でまとめて書く。
+    """
+    results = [(user_id, record.game_type, result)
+               for record in records for user_id, result in _results(record)]
+    if not results:
+        return
+    user_ids = {user_id for user_id, _, _ in results}
+    stats = {(row.user_id, row.game_type): row
+             for row in UserGameStats.objects.select_for_update().filter(user_id__in=user_ids)}
+    created = {}
+    for user_id, game_type, result in results:
+        key = (user_id, game_type)
+        row = stats.get(key)
+        if row is None:
+            row = stats[key] = created[key] = UserGameStats(user_id=user_id, game_type=game_type)
+        row.add_result(result)
+
+    UserGameStats.objects.bulk_create(created.values())
+    updated = [row for key, row in stats.items() if key not in created]
+    if updated:
+        UserGameStats.objects.bulk_update(
+            updated, ['wins', 'losses', 'draws', 'streak', 'best_streak', 'updated_at'])
+
+
+record_queue = WriteBehindQueue(save_records)
+# 終了時（SIGTERM やワーカーの再起動）にまだ書き込んでいない対局記録を失わないようにする
+atexit.register(record_queue.drain)
+
+
+def record_game(game_type, first, second, winner, moves, end_reason='normal'):
+    """
+    終了した対局をキューに積む（DB は待たない）
+
+    Args:
+        game_type (str): 'tictactoe' / 'hitandblow' / 'ecard'
+        first (str): 先攻のプレイヤー名（CPU なら BOT_NAME）
+        second (str): 後攻のプレイヤー名
+        winner (str): 勝者のプレイヤー名、引き分けなら 'draw'
+        moves (bytes): move_codec で符号化した手順
+        end_reason (str): 'normal' / 'retired' / 'timeout'
+    """
+    record_queue.put((game_type, first, second, winner, bytes(moves), end_reason))
+
+
+def encode_cursor(created_at, record_id):
+    """履歴のカーソル（URL にそのまま載せられる文字列）"""
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{record_id}"
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        tuple: (created_at, id)
+
+    Raises:
+        ValueError: 不正なカーソル
+    """
+    micros, record_id = cursor.split('-')
+    return _EPOCH + timedelta(microseconds=int(micros)), int(record_id)
+
+
+def user_history(user, cursor=None, limit=HISTORY_LIMIT, game_type=None):
+    """
+    ユーザーの対戦履歴を新しい順に1ページ分返す
+
+    player1 側と player2 側をそれぞれ索引 (player, -created_at, -id) で limit 件だけ読み、
+    マージして limit 件にする。何ページ目でも読む行数は最大 2 * limit 件。
+
+    Args:
+        user (User): 対象ユーザー
+        cursor (str): 前のページの next_cursor（最初のページなら None）
+        limit (int): 件数
+        game_type (str): ゲームの種類で絞り込む（None なら全部）
+
+    Returns:
+        tuple: (履歴の辞書のリスト, 次のページのカーソル。最後のページなら None)
+    """
+    limit = max(1, min(limit, MAX_HISTORY_LIMIT))
+    filters = Q()
+    if cursor:
+        created_at, record_id = decode_cursor(cursor)
+        filters = Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=record_id)
+    if game_type:
+        filters &= Q(game_type=game_type)
+
+    fields = ('id', 'created_at', 'game_type', 'player1_id', 'player1__username',
+              'player2__username', 'winner_id', 'is_draw', 'end_reason', 'player1_first')
+    rows = []
+    for side in ('player1', 'player2'):
+        rows.extend(GameRecord.objects.filter(filters, **{side: user})
+                    .order_by('-created_at', '-id').values(*fields)[:limit + 1])
+    rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    games = []
+    for row in rows:
+        is_player1 = row['player1_id'] == user.id
+        if row['is_draw']:
+            result = 'draw'
+        else:
+            result = 'win' if row['winner_id'] == user.id else 'loss'
+        games.append({
+            'id': row['id'],
+            'game_type': row['game_type'],
+            'created_at': row['created_at'].isoformat(),
+            # 相手が CPU なら None
+            'opponent': row['player2__username'] if is_player1 else row['player1__username'],
+            'result': result,
+            'end_reason': row['end_reason'],
+            'first': row['player1_first'] == is_player1,
+        })
+    next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_next else None
+    return games, next_cursor
@@ -0,0 +1,138 @@
+"""
+再接続と再開
+
+ページの再読み込みや通信の途切れで接続が切れても、対局をすぐには負けにしない:
+    1. 入室したプレイヤーには {'type': 'session', 'token', 'epoch', 'grace'} を送る。
+       token はルームとユーザーから作る署名（どのプロセスでも同じ値になる）、epoch はルームの連番の系列
+    2. 対局中に切断したら状態の away に {ユーザー名: 猶予の期限（UNIX 時刻）} を書き、
+       ルームのアクターに猶予の期限を設ける。期限までに戻らなければ forfeit_away（切断負け）を実行する
+    3. クライアントは ?resume=<token>&epoch=<epoch>&seq=<最後に受け取った連番> を付けて接続し直す。
+       ルームに残っている差分（StateStream.replay）で足りれば見逃した差分だけを送り、足りなければ
+       （古すぎる、アクターが作り直された、共有モードで別のプロセスの系列）次の配信でスナップショットを送る
+"""
+
+import time
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from .metrics import Counter
+from .protocol import encode_frame
+from .timers import TICK
+
+RESUME_GRACE = 30.0  # 切断してから負けにするまでの猶予（秒。settings.TEAM6_RESUME_GRACE で変更できる）
+
+resumes = Counter('team6_resumes_total', 'Reconnects by how the missed state was sent', ['game', 'result'])
+
+
+def resume_token(key, username):
+    """ルームとユーザーに対する再開用のトークン"""
+    return salted_hmac('team6.resume', f'{key}:{username}').hexdigest()[:32]
+
+
+def resume_cursor(scope):
+    """
+    接続URLのクエリから再開の位置を読む
+
+    Returns:
+        tuple: (トークン, 系列, 連番)。指定がなければ None
+    """
+    query = parse_qs(scope.get('query_string', b'').decode())
+    token = query.get('resume', [''])[0]
+    try:
+        seq = int(query.get('seq', [''])[0])
+    except ValueError:
+        return None
+    if not token:
+        return None
+    return token, query.get('epoch', [''])[0], seq
+
+
+def resume_grace():
+    return getattr(settings, 'TEAM6_RESUME_GRACE', RESUME_GRACE)
+
+
+def _away_timer(username):
+    return f'away:{username}'
+
+
+class ResumeMixin:
+    """
+    コンシューマー用: 再接続の受け付けと、切断後の猶予
+
+    DeltaStateMixin と使う。使う側は join_room の最初（状態を配信する前）に resume_session を呼び、
+    対局中の切断では leave_room から mark_away を呼ぶ。
+    猶予が切れたときの処理は async forfeit_away(room, state, username) に実装する。ルームのアクター内で、
+    state の away から username を消した後に呼ばれる。対局が終わっていれば何もしない。終わらせるときは
+    game_over、winner、end_reason（'retired'）を書き、対局を記録してから broadcast すること。
+    forfeit_away を定義していないクラスは定義した時点で TypeError になる（猶予が切れてから気づかないように）。
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not callable(getattr(cls, 'forfeit_away', None)):
+            raise TypeError(f"{cls.__name__} は forfeit_away を実装してください")
+
+    def setup_resume(self):
+        self.resume_cursor = resume_cursor(self.scope)
+
+    def mark_away(self, room, state):
+        """対局中の切断: すぐには負けにせず、猶予の期限を設ける"""
+        username = self.user.username
+        grace = resume_grace()
+        state.setdefault('away', {})[username] = round(time.time() + grace, 3)
+        room.set_deadline(grace, self._away_expired, username, timer=_away_timer(username))
+
+    async def resume_session(self, room):
+        """
+        猶予中なら切断の印を消し、セッションを送る。再接続なら見逃した差分だけをこの接続に送る
+
+        Args:
+            room (RoomActor): ルームのアクター
+        """
+        username = self.user.username
+        state = room.state
+        if state and username in state.get('away', {}):
+            del state['away'][username]
+            if not state['away']:
+                del state['away']
+            room.clear_deadline(timer=_away_timer(username))
+
+        await self.send(text_data=encode_frame({
+            'type': 'session',
+            'token': resume_token(room.key, username),
+            'epoch': room.stream.epoch,
+            'grace': resume_grace(),
+        }))
+
+        if self.resume_cursor is None or not self.delta_mode:
+            return
+        token, epoch, seq = self.resume_cursor
+        missed = None
+        if constant_time_compare(token, resume_token(room.key, username)) and epoch == room.stream.epoch:
+            missed = room.stream.replay_since(seq)
+        if missed is None:
+            # 送り直せないので、次の配信でスナップショットを送る
+            resumes.inc(self.metrics_game, 'snapshot')
+            return
+        for text in missed:
+            await self.send(text_data=text)
+        self.last_seq = room.stream.seq
+        resumes.inc(self.metrics_game, 'replayed')
+
+    async def _away_expired(self, room, username):
+        state = room.state
+        deadline = state.get('away', {}).get(username) if state else None
+        if deadline is None:
+            # 戻ってきた
+            return
+        remaining = deadline - time.time()
+        if remaining > TICK:
+            # 共有モードで一度戻ってから別のプロセスで切断し直した
+            room.set_deadline(remaining, self._away_expired, username, timer=_away_timer(username))
+            return
+        del state['away'][username]
+        if not state['away']:
+            del state['away']
+        await self.forfeit_away(room, state, username)
@@ -0,0 +1,441 @@
+"""
+ルームランタイム
+
+アクティブなルームごとに1つの asyncio タスク（アクター）が状態を所有する。
+コンシューマーは受信箱にイベントを積むだけで、状態の読み書きはアクターの中で
+1件ずつ直列に実行されるため、同じルームへの同時メッセージで更新が失われない。
+状態はアクターのメモリ上に保持し、一定間隔でルーム状態ストアへチェックポイントする。
+
+settings.TEAM6_BROKER_SOCKET を設定した複数プロセス構成（共有モード）では、同じルームのアクターが
+複数のプロセスにできうるので、イベントごとにブローカーでルームのロックを取り、
+状態と配信の連番を読み込んでから処理し、書き戻してからロックを外す。
+run_workers でルームごとに担当プロセスを決める構成（settings.TEAM6_ROUTED_WORKER）では
+同じルームのアクターは1プロセスにしかできないので、共有モードにはしない。
+
+ルームのイベント（盤面の更新など）は group_send ではなく、アクターが覚えているメンバー（プレイヤーの接続の
+チャネル名）へ直接送る。共有モードではメンバーも状態と一緒にブローカーに置き、どのプロセスからも送れるようにする。
+メンバーのチャネルが詰まっていたら（ChannelFull）、メンバーが変わるまでは group_send に戻す。
+
+手番の期限や切断後の猶予は set_deadline でプロセスに1つのタイマーホイール（team6.timers）に載せ、
+切れたらアクターの受信箱にイベントとして積む（ルームごとのタスクは作らない）。
+期限が残っている間はアクターを停止しない。
+
+RoomRegistry は定期的にストアを見回り、接続のないまま ROOM_GRACE 秒たったルームの状態を捨てる。
+ルーム数が上限を超えたら、接続のないルームを終局したものから古い順に捨てる。
+"""
+
+import asyncio
+import atexit
+import logging
+import time
+
+from channels.exceptions import ChannelFull
+from django.conf import settings
+
+from .broker import get_client
+from .metrics import Gauge, room_handler_seconds, room_queue_seconds, room_sends
+from .protocol import StateStream
+from .snapshot import encode_value
+from .state_store import STATE_TTL, room_store
+from .timers import wheel
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_INTERVAL = 1.0  # 変更があったルームをストアへ書き出す間隔（秒）
+IDLE_TIMEOUT = 30.0        # 接続が0になってからアクターを停止するまでの猶予（秒）
+ROOM_GRACE = 60.0          # 接続が0になってからルーム状態を捨てるまでの猶予（秒）
+MAX_ROOMS = 10000          # プロセスが保持するルーム数の上限（settings.TEAM6_MAX_ROOMS で変更できる）
+SWEEP_INTERVAL = 5.0       # ストアを見回る間隔（秒）
+REPORT_INTERVAL = 60.0     # ゲームごとのルーム数・使用量をログに出す間隔（秒）
+
+# ストアのキーの接頭辞 -> ゲーム
+GAME_KEY_PREFIXES = (
+    ('game_state_', 'tictactoe'),
+    ('hb_state_', 'hitandblow'),
+    ('ecard_state_', 'ecard'),
+)
+
+
+def game_type_of(key):
+    for prefix, game_type in GAME_KEY_PREFIXES:
+        if key.startswith(prefix):
+            return game_type
+    return 'other'
+
+
+class RoomActor:
+    """
+    1つのルームの状態を所有するアクター
+
+    Attributes:
+        key (str): ストアのキー（例：'game_state_<room_name>'）
+        state (dict): ルーム状態（未作成ならNone）
+        connections (int): このルームに接続中のコンシューマー数
+        stream (StateStream): 配信の連番と前回配信した状態
+        members (set): ルームに接続中のプレイヤー（コンシューマー）のチャネル名
+        direct (bool): メンバーへ直接送るか（チャネルが詰まったら、メンバーが変わるまで group_send に戻す）
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.state = None
+        self.connections = 0
+        self.stream = StateStream()
+        self.members = set()
+        self.direct = True
+        self._inbox = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._dirty = False
+        self._last_checkpoint = time.monotonic()
+        self._idle_since = time.monotonic()
+        self._task = None
+        self._deadlines = set()  # このアクターが設けた期限の名前
+        path = getattr(settings, 'TEAM6_BROKER_SOCKET', None)
+        shared = path and not getattr(settings, 'TEAM6_ROUTED_WORKER', False)
+        self._broker = get_client(path) if shared else None
+        self._game = game_type_of(key)
+
+    def start(self, on_stop):
+        self._task = self._loop.create_task(self._run(on_stop))
+
+    async def submit(self, handler, *args):
+        """
+        handler(room, *args) をアクターのタスク内で実行し、戻り値を返す
+
+        handler の中から同じルームの submit を await するとデッドロックするので注意
+        """
+        future = self._loop.create_future()
+        self._inbox.put_nowait((handler, args, future, time.perf_counter()))
+        return await future
+
+    def post(self, handler, *args):
+        """handler(room, *args) を受信箱に積むだけで結果は待たない（例外はログに出す）"""
+        future = self._loop.create_future()
+        future.add_done_callback(_log_failure)
+        self._inbox.put_nowait((handler, args, future, time.perf_counter()))
+
+    def set_deadline(self, delay, handler, *args, timer='turn'):
+        """
+        delay 秒後に handler(room, *args) をアクターで実行する（プロセスのタイマーホイールに載せる）
+
+        期限はルームと timer（名前）ごとに1つで、設け直すと前の期限は取り消される
+        """
+        self._deadlines.add(timer)
+        wheel.schedule((self.key, timer), delay, self._deadline_passed, timer, handler, args)
+
+    def clear_deadline(self, timer='turn'):
+        self._deadlines.discard(timer)
+        wheel.cancel((self.key, timer))
+
+    def has_deadline(self, timer='turn'):
+        return (self.key, timer) in wheel
+
+    def _deadline_passed(self, timer, handler, args):
+        self._deadlines.discard(timer)
+        if self._task is not None and not self._task.done():
+            self.post(handler, *args)
+
+    async def join(self, channel):
+        """接続のチャネル名をメンバーに加える（共有モードではブローカーの状態にも書き込む）"""
+        await self.submit(_add_member, channel)
+
+    async def leave(self, channel):
+        await self.submit(_discard_member, channel)
+
+    async def send_members(self, layer, group, message):
+        """
+        メンバー全員へメッセージを送る
+
+        メンバーは2人程度なので、group_send（グループの検索と期限切れの掃除）を通さず
+        各チャネルへ直接送る。settings.TEAM6_DIRECT_ROOM_SEND が False なら group_send で送る（比較用）
+
+        メンバーのチャネルが詰まっていたら（ChannelFull）、そのメッセージはそのチャネルにだけ届けず
+        （group_send と同じ扱い）、メンバーが変わるまでは group_send で送る。受け取られていないチャネルは
+        グループの有効期限で外れるが、メンバーからは外れないため
+
+        Args:
+            layer: チャネルレイヤー
+            group (str): 直接送らない場合に使うグループ名
+            message (dict): メッセージ
+        """
+        if not (self.direct and getattr(settings, 'TEAM6_DIRECT_ROOM_SEND', True)):
+            room_sends.inc('group')
+            await layer.group_send(group, message)
+            return
+        room_sends.inc('direct')
+        for channel in list(self.members):
+            try:
+                await layer.send(channel, message)
+            except ChannelFull:
+                logger.warning("チャネル %s が詰まっているため、メンバーが変わるまで %s へ group_send で送ります", channel, group)
+                self.direct = False
+
+    async def _run(self, on_stop):
+        # 最初のイベントより先にストアから状態を復元する（共有モードではイベントごとに読む）
+        if self._broker is None:
+            self.state = await room_store.get(self.key)
+
+        while True:
+            try:
+                handler, args, future, queued_at = await asyncio.wait_for(
+                    self._inbox.get(), timeout=CHECKPOINT_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                await self._checkpoint()
+                if self._is_idle():
+                    on_stop(self)
+                    return
+                continue
+
+            started = time.perf_counter()
+            room_queue_seconds.observe(self._game, value=started - queued_at)
+            try:
+                if self._broker is None:
+                    result = await handler(self, *args)
+                else:
+                    result = await self._handle_shared(handler, args)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            room_handler_seconds.observe(self._game, handler.__name__, value=time.perf_counter() - started)
+            self._dirty = self._broker is None
+
+            if time.monotonic() - self._last_checkpoint >= CHECKPOINT_INTERVAL:
+                await self._checkpoint()
+
+    async def _handle_shared(self, handler, args):
+        """共有モード: ロックを取って最新の状態を読み、処理してから書き戻す"""
+        async with self._broker.lock(self.key):
+            value, _ = await self._broker.get_versioned(self.key)
+            # メンバーのない3要素の値はメンバーを置く前のバージョンが書いたもの
+            self.state, self.stream.seq, self.stream.last, *members = value or (None, 0, None)
+            self.members = set(members[0] if members else ())
+            try:
+                return await handler(self, *args)
+            finally:
+                value = None
+                if self.state is not None or self.members:
+                    value = [self.state, self.stream.seq, self.stream.last, sorted(self.members)]
+                await self._broker.set(self.key, value, STATE_TTL)
+
+    def _is_idle(self):
+        return (self.connections == 0 and self._inbox.empty() and not self._deadlines
+                and time.monotonic() - self._idle_since >= IDLE_TIMEOUT)
+
+    async def _checkpoint(self):
+        """変更があればストアへ書き出す"""
+        self._last_checkpoint = time.monotonic()
+        if not self._dirty:
+            return
+        self._dirty = False
+        if self.state is None:
+            await room_store.delete(self.key)
+        else:
+            await room_store.set(self.key, self.state)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("ルームのイベントの処理に失敗しました", exc_info=future.exception())
+
+
+async def _add_member(room, channel):
+    room.members.add(channel)
+    room.direct = True
+
+
+async def _discard_member(room, channel):
+    room.members.discard(channel)
+    room.direct = True
+
+
+class RoomRegistry:
+    """
+    プロセス内のルームアクターを管理し、接続のないルームの状態をストアから捨てる
+
+    Attributes:
+        stats (dict): 直近の見回りでのゲームごとの {'rooms', 'connected', 'bytes'}
+                      （bytes は状態を JSON にしたときの大きさ）
+    """
+
+    def __init__(self, grace=ROOM_GRACE, max_rooms=None):
+        self._actors = {}
+        self.grace = grace
+        self.max_rooms = max_rooms
+        self.stats = {}
+        self._idle_since = {}  # 接続のないルーム -> 最初にそう見えた時刻
+        self._sizes = {}       # キー -> (バージョン, バイト数)
+        self._sweeper = None
+        self._last_report = time.monotonic()
+
+    async def acquire(self, key):
+        """
+        ルームのアクターを取得し、接続数を1増やす（なければ起動する）
+
+        Args:
+            key (str): ルームのストアキー
+
+        Returns:
+            RoomActor: ルームのアクター
+        """
+        actor = self._actors.get(key)
+        if actor is None or actor._loop is not asyncio.get_running_loop():
+            actor = RoomActor(key)
+            self._actors[key] = actor
+            actor.start(self._remove)
+        actor.connections += 1
+        self._ensure_sweeper()
+        return actor
+
+    def release(self, actor):
+        """接続数を1減らす（0になったら猶予の後にアクターが停止する）"""
+        actor.connections -= 1
+        if actor.connections <= 0:
+            actor.connections = 0
+            actor._idle_since = time.monotonic()
+
+    def _remove(self, actor):
+        if self._actors.get(actor.key) is actor:
+            del self._actors[actor.key]
+
+    def _ensure_sweeper(self):
+        loop = asyncio.get_running_loop()
+        if self._sweeper is None or self._sweeper.done() or self._sweeper.get_loop() is not loop:
+            self._sweeper = loop.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("ルームの見回りに失敗しました")
+            if self.stats and time.monotonic() - self._last_report >= REPORT_INTERVAL:
+                self._last_report = time.monotonic()
+                logger.info("rooms: %s", ", ".join(
+                    f"{game} {s['rooms']} ({s['connected']} connected, {s['bytes']:,} bytes)"
+                    for game, s in sorted(self.stats.items())))
+
+    async def sweep(self):
+        """
+        接続のないルームを猶予の後に捨て、ルーム数を上限以下に保つ
+
+        Returns:
+            int: 捨てたルームの数
+        """
+        now = time.monotonic()
+        max_rooms = self.max_rooms or getattr(settings, 'TEAM6_MAX_ROOMS', MAX_ROOMS)
+        entries = room_store.live_entries()
+        connected = {key for key, actor in self._actors.items() if actor.connections > 0}
+
+        evict = []
+        idle = []
+        for key, version, value in entries:
+            if key in connected:
+                self._idle_since.pop(key, None)
+                continue
+            since = self._idle_since.setdefault(key, now)
+            if now - since >= self.grace:
+                evict.append(key)
+            else:
+                # 終局したもの、その中でも書き込みが古いもの（バージョンが小さいもの）から並べる
+                finished = isinstance(value, dict) and value.get('game_over', False)
+                idle.append((not finished, version, key))
+
+        over = len(entries) - len(evict) - max_rooms
+        if over > 0:
+            idle.sort()
+            evict.extend(key for _, _, key in idle[:over])
+            logger.warning("ルーム数が上限（%d）を超えたため %d 件を捨てます", max_rooms, min(over, len(idle)))
+
+        for key in evict:
+            await self.evict(key)
+
+        self._update_stats(entries, set(evict), connected)
+        return len(evict)
+
+    async def evict(self, key):
+        """
+        接続のないルームの状態をストアから捨てる
+
+        run_workers 構成では、ワーカーが落ちたり戻ったりしてルームの担当が別のワーカーに移っていることがある。
+        このワーカーのメモリ上の分だけを捨て、ブローカーの値は終局したルームでこのワーカーが書いた値のままの
+        ときだけ消す（対局中のルームの値は有効期限まで残し、担当のワーカーが続きから使えるようにする）
+        """
+        actor = self._actors.get(key)
+        if actor is not None and actor.connections == 0:
+            # 停止待ちのアクターが後からチェックポイントで書き戻さないようにする
+            actor.state = None
+            actor._dirty = False
+        self._idle_since.pop(key, None)
+        if getattr(settings, 'TEAM6_ROUTED_WORKER', False):
+            value = await room_store.get(key)
+            finished = isinstance(value, dict) and value.get('game_over', False)
+            await room_store.forget(key, delete_backing=finished)
+            return
+        await room_store.delete(key)
+
+    def _update_stats(self, entries, evicted, connected):
+        stats = {}
+        sizes = {}
+        for key, version, value in entries:
+            if key in evicted:
+                continue
+            cached = self._sizes.get(key)
+            size = cached[1] if cached is not None and cached[0] == version else len(encode_value(value))
+            sizes[key] = (version, size)
+            game = stats.setdefault(game_type_of(key), {'rooms': 0, 'connected': 0, 'bytes': 0})
+            game['rooms'] += 1
+            game['connected'] += key in connected
+            game['bytes'] += size
+        self._sizes = sizes
+        self.stats = stats
+        for key in [key for key in self._idle_since if key not in sizes]:
+            del self._idle_since[key]
+
+
+rooms = RoomRegistry()
+
+
+class RoomMemberMixin:
+    """
+    コンシューマー用: ルームのアクターへの参加・退出と、メンバーへの送信
+
+    使う側は channel_layer と room_group_name を持つ（AsyncWebsocketConsumer）
+    """
+
+    async def enter_room(self, key):
+        """
+        ルームのアクターを取得し、この接続をメンバーに加える
+
+        Args:
+            key (str): ルームのストアキー
+        """
+        self.room = await rooms.acquire(key)
+        await self.room.join(self.channel_name)
+
+    async def exit_room(self):
+        await self.room.leave(self.channel_name)
+        rooms.release(self.room)
+
+    async def send_room(self, message):
+        """ルームのメンバー全員（自分も含む）へ送る"""
+        await self.room.send_members(self.channel_layer, self.room_group_name, message)
+
+Gauge('team6_rooms', 'Rooms held in memory (as of the last sweep)', ['game'],
+      collect=lambda: {(game,): s['rooms'] for game, s in rooms.stats.items()})
+Gauge('team6_rooms_connected', 'Rooms with at least one connection (as of the last sweep)', ['game'],
+      collect=lambda: {(game,): s['connected'] for game, s in rooms.stats.items()})
+Gauge('team6_room_state_bytes', 'JSON size of room states (as of the last sweep)', ['game'],
+      collect=lambda: {(game,): s['bytes'] for game, s in rooms.stats.items()})
+Gauge('team6_room_actors', 'Running room actors', collect=lambda: {(): len(rooms._actors)})
+
+
+@atexit.register
+def _save_on_exit():
+    """プロセス終了時: アクターがまだチェックポイントしていない状態も含めて書き出す"""
+    overrides = {actor.key: actor.state for actor in rooms._actors.values() if actor._dirty}
+    room_store.save_on_exit(overrides)
@@ -0,0 +1,373 @@
+"""
+ルームのワーカー振り分け（複数プロセス構成用）
+
+python manage.py run_workers が daphne のワーカーを複数起動し、その前に立つプロキシが
+接続ごとに行き先のワーカーを選ぶ。ルームへの WebSocket 接続はルーム名の sha256 を
+コンシステント・ハッシュのリングに載せて担当ワーカーを決めるので、同じルームの接続は
+すべて同じプロセスに集まり、状態の読み書きも配信もプロセス内で完結する。
+マッチングの待機列も1つのワーカーに集める。
+
+ワーカーが落ちるとリングから外し、そのワーカーが担当していたルームだけが残りのワーカーへ移る。
+再起動したワーカーはリングに戻すが、接続中の対局があるルームは対局が終わる（接続が0になる）まで
+今のワーカーに留める。
+
+/metrics はプロキシ自身が答え、全ワーカーのメトリクスに worker ラベルを付けてまとめて返す。
+"""
+
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import os
+import re
+import time
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
+
+REPLICAS = 64              # 1ワーカーあたりのリング上の点の数
+MATCHMAKING_KEY = 'matchmaking'
+MAX_HEADER = 64 * 1024     # リクエストヘッダーの上限（バイト）
+BUFFER_SIZE = 64 * 1024
+READY_TIMEOUT = 30.0       # ワーカーの起動を待つ上限（秒）
+RESTART_DELAY = 1.0        # ワーカーを再起動するまでの待ち時間（秒。続けて落ちると倍にしていく）
+MAX_RESTART_DELAY = 30.0
+STABLE_UPTIME = 60.0       # この秒数動いていれば再起動の待ち時間を元に戻す
+
+_ROOM_PATH = re.compile(r'^/ws/(?:game|tictactoe|hitandblow|ecard)/([^/?]+)/')
+_MATCHMAKING_PATH = re.compile(r'^/ws/matchmaking/')
+_METRICS_PATH = re.compile(r'^/metrics(?:[/?]|$)')
+METRICS_TIMEOUT = 5.0      # ワーカーのメトリクスを待つ上限（秒）
+METRICS_PROXY_HEADER = 'X-Team6-Metrics-Token'  # ワーカーの /metrics を読むときに合言葉を付けるヘッダー
+
+
+def _hash(text):
+    # コンシューマーのグループ名と同じく sha256 を使う（先頭64ビットをリング上の位置にする）
+    return int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def route_key(path):
+    """
+    リクエストのパスから振り分けのキーを求める
+
+    Args:
+        path (str): リクエストのパス（クエリ文字列を含んでもよい）
+
+    Returns:
+        str: ルーム名（マッチングなら MATCHMAKING_KEY）。どのワーカーでもよいリクエストなら None
+    """
+    match = _ROOM_PATH.match(path)
+    if match:
+        return unquote(match.group(1))
+    if _MATCHMAKING_PATH.match(path):
+        return MATCHMAKING_KEY
+    return None
+
+
+class HashRing:
+    """
+    コンシステント・ハッシュのリング
+
+    各ワーカーをリング上の REPLICAS 個の点に置き、キーの位置から時計回りに最初の点のワーカーを選ぶ。
+    ワーカーを外しても、そのワーカーの点に当たっていたキーしか行き先が変わらない。
+    """
+
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self._points = []   # ソート済みの位置
+        self._owners = []   # 位置と同じ順のワーカー名
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in self._owners
+
+    @property
+    def nodes(self):
+        return sorted(set(self._owners))
+
+    def add(self, node):
+        if node in self:
+            return
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != node]
+        self._points = [p for p, _ in keep]
+        self._owners = [o for _, o in keep]
+
+    def lookup(self, key):
+        """キーを担当するワーカー名（ワーカーがいなければ None）"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+class RoutingProxy:
+    """
+    TCP で受けた接続を、リクエストのパスに応じてワーカーの Unix ソケットへ中継する
+
+    Args:
+        sockets (dict): ワーカー名 -> Unix ソケットのパス
+        metrics_allowed (iterable): /metrics を読めるアドレス
+        metrics_token (str): ワーカーの /metrics を読むときに付ける合言葉（settings.TEAM6_METRICS_PROXY_TOKEN）
+    """
+
+    def __init__(self, sockets, metrics_allowed=(), metrics_token=None):
+        self.sockets = dict(sockets)
+        self.metrics_allowed = set(metrics_allowed)
+        self.metrics_token = metrics_token
+        self.ring = HashRing()
+        self._sticky = {}   # 接続中のルーム -> [ワーカー名, 接続数]
+        self._round_robin = itertools.count()
+
+    def add_worker(self, name):
+        self.ring.add(name)
+        logger.info("worker %s is up", name)
+
+    def remove_worker(self, name):
+        self.ring.remove(name)
+        logger.warning("worker %s is down; its rooms move to the other workers", name)
+
+    def pick(self, key):
+        """
+        Args:
+            key (str): route_key の結果
+
+        Returns:
+            str: 行き先のワーカー名（動いているワーカーがなければ None）
+        """
+        if key is None:
+            live = self.ring.nodes
+            return live[next(self._round_robin) % len(live)] if live else None
+        sticky = self._sticky.get(key)
+        if sticky is not None and sticky[0] in self.ring:
+            return sticky[0]
+        return self.ring.lookup(key)
+
+    async def handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        try:
+            path = head.split(b' ', 2)[1].decode('latin-1')
+        except IndexError:
+            writer.close()
+            return
+        if _METRICS_PATH.match(path):
+            await self._serve_metrics(writer)
+            return
+        key = route_key(path)
+        worker = self.pick(key)
+        if worker is None:
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        if key is None:
+            # 次のリクエストは別のワーカーへ振り分けられるよう、1リクエストごとに接続を閉じてもらう
+            head = _close_after_response(head)
+
+        try:
+            up_reader, up_writer = await asyncio.open_unix_connection(self.sockets[worker])
+        except OSError:
+            writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+
+        if key is not None:
+            self._stick(key, worker)
+        try:
+            up_writer.write(head)
+            await asyncio.gather(_pipe(reader, up_writer), _pipe(up_reader, writer))
+        finally:
+            if key is not None:
+                self._unstick(key)
+
+    async def _serve_metrics(self, writer):
+        peer = writer.get_extra_info('peername')
+        if not peer or peer[0] not in self.metrics_allowed:
+            writer.write(b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        names = self.ring.nodes
+        results = await asyncio.gather(*(self._fetch_metrics(name) for name in names), return_exceptions=True)
+        texts = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.warning("metrics from %s failed: %r", name, result)
+            else:
+                texts[name] = result
+        body = merge_metrics(texts).encode('utf-8')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _fetch_metrics(self, name):
+        reader, writer = await asyncio.open_unix_connection(self.sockets[name])
+        try:
+            token = f'{METRICS_PROXY_HEADER}: {self.metrics_token}\r\n' if self.metrics_token else ''
+            writer.write(f'GET /metrics HTTP/1.1\r\nHost: localhost\r\n{token}Connection: close\r\n\r\n'.encode('latin-1'))
+            response = await asyncio.wait_for(reader.read(), METRICS_TIMEOUT)
+        finally:
+            writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise ValueError(head.split(b'\r\n', 1)[0].decode('latin-1'))
+        return body.decode('utf-8')
+
+    def _stick(self, key, worker):
+        sticky = self._sticky.get(key)
+        if sticky is None or sticky[0] != worker:
+            # 前のワーカーが落ちて移ってきた場合は数え直す
+            sticky = self._sticky[key] = [worker, 0]
+        sticky[1] += 1
+
+    def _unstick(self, key):
+        sticky = self._sticky.get(key)
+        if sticky is None:
+            return
+        sticky[1] -= 1
+        if sticky[1] <= 0:
+            del self._sticky[key]
+
+
+def merge_metrics(texts):
+    """
+    ワーカーごとのメトリクスを、サンプルに worker ラベルを付けて1つにまとめる
+
+    Args:
+        texts (dict): ワーカー名 -> Prometheus のテキスト形式
+
+    Returns:
+        str: メトリクスの種類ごとにまとめ直したテキスト
+    """
+    families = {}  # 名前 -> [HELP/TYPE の行, サンプルの行]
+    for worker, text in sorted(texts.items()):
+        label = f'worker="{worker}"'
+        current = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('#'):
+                parts = line.split(' ', 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    current = families.setdefault(parts[2], [[], []])
+                    if line not in current[0]:
+                        current[0].append(line)
+                continue
+            if current is None:
+                continue
+            name, _, rest = line.rpartition(' ')
+            if '{' in name:
+                name = name.replace('{', '{' + label + ',', 1)
+            else:
+                name = f'{name}{{{label}}}'
+            current[1].append(f'{name} {rest}')
+    lines = []
+    for meta, samples in families.values():
+        lines.extend(meta)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _close_after_response(head):
+    lines = [line for line in head[:-4].split(b'\r\n') if not line.lower().startswith(b'connection:')]
+    lines.append(b'Connection: close')
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class WorkerPool:
+    """
+    daphne のワーカーを起動し、落ちたら再起動する
+
+    Args:
+        proxy (RoutingProxy): 起動・停止を知らせるプロキシ
+        command (list): ワーカーの起動コマンド（'{socket}' はワーカーの Unix ソケットのパスに置き換える）
+        env (dict): ワーカーの環境変数
+    """
+
+    def __init__(self, proxy, command, env):
+        self.proxy = proxy
+        self.command = command
+        self.env = env
+        self._processes = {}
+
+    async def run(self):
+        await asyncio.gather(*(self._supervise(name) for name in self.proxy.sockets))
+
+    async def _supervise(self, name):
+        path = self.proxy.sockets[name]
+        delay = RESTART_DELAY
+        while True:
+            if os.path.exists(path):
+                os.unlink(path)
+            started = time.monotonic()
+            process = self._processes[name] = await asyncio.create_subprocess_exec(
+                *(arg.format(socket=path) for arg in self.command), env=self.env)
+            wait = asyncio.ensure_future(process.wait())
+            if await _wait_ready(path, wait):
+                self.proxy.add_worker(name)
+            elif process.returncode is None:
+                logger.warning("worker %s did not become ready; restarting", name)
+                process.terminate()
+            await wait
+            if name in self.proxy.ring:
+                self.proxy.remove_worker(name)
+            logger.warning("worker %s exited with %s", name, process.returncode)
+
+            delay = RESTART_DELAY if time.monotonic() - started >= STABLE_UPTIME else min(delay * 2, MAX_RESTART_DELAY)
+            await asyncio.sleep(delay)
+
+    def send_signal(self, sig):
+        """動いている全ワーカーにシグナルを送る"""
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.send_signal(sig)
+
+    async def shutdown(self, timeout=10.0):
+        """全ワーカーを止める（supervise のタスクは先にキャンセルしておく）"""
+        running = [p for p in self._processes.values() if p.returncode is None]
+        for process in running:
+            process.terminate()
+        if running:
+            await asyncio.wait([asyncio.ensure_future(p.wait()) for p in running], timeout=timeout)
+
+
+async def _wait_ready(path, exited):
+    """ワーカーのソケットに接続できるようになるまで待つ（先に終了したら False）"""
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline and not exited.done():
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return True
+    return False
@@ -4,6 +4,7 @@ from . import consumers
 websocket_urlpatterns = [
     # 1. ランダムマッチング用
     re_path(r'ws/matchmaking/$', consumers.MatchmakingConsumer.as_asgi()),
+    re_path(r'ws/matchmaking/(?P<game>tictactoe|hitandblow|ecard)/$', consumers.MatchmakingConsumer.as_asgi()),
 
     # 2. ゲーム対戦用 (tictactoe)
     re_path(r'ws/tictactoe/(?P<room_name>[^/]+)/$', consumers.TicTacToeConsumer.as_asgi()),
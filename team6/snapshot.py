@@ -0,0 +1,248 @@
+"""
+ルーム状態のスナップショットファイル（再起動をまたいで対局を続けるため）
+
+終了時と一定間隔で、メモリ上のルーム状態をまとめて1つのファイルに書き出す。
+起動時はファイルを mmap するだけで中身は読まず、ストアにないキーを引かれたときに
+索引を二分探索してそのルームの分だけ展開する（数万ルームあっても起動は一瞬で終わる）。
+
+形式（整数はすべてビッグエンディアン）:
+    ヘッダー   b'T6S1' | 件数 (uint32) | 索引の位置 (uint64)
+    レコード   キー長 (uint16) | キー (UTF-8) | 有効期限 (uint32, UNIX 秒) | 本体長 (uint32) | 本体
+    索引       件数 × [キーのハッシュ (uint64) | レコードの位置 (uint64)]（ハッシュ順）
+本体は値の JSON を zlib で圧縮したもの。
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'T6S1'
+_HEADER = struct.Struct('>4sIQ')
+_KEY_LEN = struct.Struct('>H')
+_BODY_HEAD = struct.Struct('>II')
+_INDEX = struct.Struct('>QQ')
+COMPRESS_LEVEL = 1
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def encode_value(value):
+    """値 -> 本体（圧縮前の JSON）。値はイベントループ上で読むので、ここまではループで行う"""
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def write_snapshot(path, fresh, carried=()):
+    """
+    スナップショットを書き出す（一時ファイルに書いてから置き換える）
+
+    Args:
+        path (str): 書き出し先
+        fresh (list): (キー, 有効期限のUNIX秒, encode_value の結果) のリスト
+        carried (iterable): (キー, 有効期限, 圧縮済みの本体) — 前のスナップショットから引き継ぐ分
+
+    Returns:
+        int: 書き出した件数
+    """
+    tmp = f"{path}.tmp"
+    index = []
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, 0, 0))
+        offset = _HEADER.size
+
+        def write(key, expires, body):
+            nonlocal offset
+            encoded = key.encode('utf-8')
+            record = _KEY_LEN.pack(len(encoded)) + encoded + _BODY_HEAD.pack(int(expires), len(body)) + body
+            f.write(record)
+            index.append((_key_hash(key), offset))
+            offset += len(record)
+
+        for key, expires, data in fresh:
+            write(key, expires, zlib.compress(data, COMPRESS_LEVEL))
+        for key, expires, body in carried:
+            write(key, expires, body)
+
+        index.sort()
+        f.write(b''.join(_INDEX.pack(h, o) for h, o in index))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, len(index), offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(index)
+
+
+class Snapshot:
+    """
+    mmap したスナップショット（読み取り専用）
+
+    Attributes:
+        count (int): 件数
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        magic, self.count, self._index = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or self._index + self.count * _INDEX.size > len(buffer):
+            raise ValueError("スナップショットの形式が正しくありません")
+
+    @classmethod
+    def open(cls, path):
+        """
+        Returns:
+            Snapshot: ファイルがない・壊れている場合は None
+        """
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < _HEADER.size:
+                    return None
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(buffer)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error):
+            logger.exception("snapshot %s could not be opened", path)
+            return None
+
+    def _record(self, offset):
+        (key_len,) = _KEY_LEN.unpack_from(self._buffer, offset)
+        start = offset + _KEY_LEN.size
+        key = self._buffer[start:start + key_len].decode('utf-8')
+        expires, body_len = _BODY_HEAD.unpack_from(self._buffer, start + key_len)
+        body_start = start + key_len + _BODY_HEAD.size
+        return key, expires, body_start, body_len
+
+    def _find(self, key):
+        target = _key_hash(key)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _INDEX.unpack_from(self._buffer, self._index + mid * _INDEX.size)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        # ハッシュが衝突していれば隣を順に確かめる
+        while lo < self.count:
+            hashed, offset = _INDEX.unpack_from(self._buffer, self._index + lo * _INDEX.size)
+            if hashed != target:
+                return None
+            record = self._record(offset)
+            if record[0] == key:
+                return record
+            lo += 1
+        return None
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (値, 有効期限のUNIX秒)。ない・期限切れなら None
+        """
+        record = self._find(key)
+        if record is None or record[1] <= time.time():
+            return None
+        _, expires, start, length = record
+        return json.loads(zlib.decompress(self._buffer[start:start + length])), expires
+
+    def raw_items(self):
+        """期限内の全レコードを展開せずに返す: (キー, 有効期限, 圧縮済みの本体)"""
+        now = time.time()
+        for i in range(self.count):
+            _, offset = _INDEX.unpack_from(self._buffer, self._index + i * _INDEX.size)
+            key, expires, start, length = self._record(offset)
+            if expires > now:
+                yield key, expires, self._buffer[start:start + length]
+
+    def close(self):
+        self._buffer.close()
+
+
+class SnapshotFile:
+    """
+    ストアから使うスナップショット（起動時のファイルからの復元と、書き出し）
+
+    起動後に書き込み・削除したキーはメモリ側が正しいので、スナップショットからは復元しない。
+    書き出すときは、まだ復元されていないルームを前のファイルから展開せずに引き継ぐ。
+
+    Args:
+        path (str): ファイルのパス
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.changed = False
+        self._snapshot = Snapshot.open(self.path)
+        self._touched = set()
+        self._encoded = {}  # キー -> (バージョン, encode_value の結果)。変わっていないルームは JSON 化し直さない
+        if self._snapshot is not None:
+            logger.info("snapshot %s: %d rooms can be restored", self.path, self._snapshot.count)
+
+    def lookup(self, key):
+        """
+        Returns:
+            tuple: (値, 残りの有効期限秒)。スナップショットになければ None
+        """
+        if self._snapshot is None or key in self._touched:
+            return None
+        self._touched.add(key)
+        found = self._snapshot.get(key)
+        if found is None:
+            return None
+        value, expires = found
+        return value, max(1, int(expires - time.time()))
+
+    def touch(self, key):
+        self._touched.add(key)
+        self.changed = True
+
+    def prepare(self, items):
+        """
+        書き出す内容を用意する（値を読むのでイベントループ上で呼ぶ）
+
+        Args:
+            items (iterable): (キー, バージョン, 値, 残りの有効期限秒)。バージョンが None なら毎回 JSON 化する
+
+        Returns:
+            tuple: write に渡す (今の値, 引き継がないキー)
+        """
+        now = time.time()
+        fresh = []
+        encoded = {}
+        for key, version, value, ttl in items:
+            cached = self._encoded.get(key)
+            if cached is not None and version is not None and cached[0] == version:
+                data = cached[1]
+            else:
+                data = encode_value(value)
+            if version is not None:
+                encoded[key] = (version, data)
+            fresh.append((key, now + ttl, data))
+        self._encoded = encoded
+        exclude = self._touched | {key for key, _, _ in fresh}
+        self._touched = set()
+        self.changed = False
+        return fresh, exclude
+
+    def write(self, prepared):
+        """prepare の結果を書き出して開き直す（別スレッドから呼んでよい）"""
+        fresh, exclude = prepared
+        old = self._snapshot
+        if old is None and not fresh:
+            return 0
+        carried = [] if old is None else [item for item in old.raw_items() if item[0] not in exclude]
+        count = write_snapshot(self.path, fresh, carried)
+        # 古い mmap はループ側で読んでいる途中かもしれないので閉じずに手放す
+        self._snapshot = Snapshot.open(self.path)
+        return count
+
+    def save(self, items):
+        return self.write(self.prepare(items))
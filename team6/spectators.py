@@ -0,0 +1,227 @@
+"""
+観戦（読み取り専用の接続）
+
+接続URLに ?spectate=1 を付けると観戦者として接続する。観戦者はプレイヤーのグループに入らず、
+ルームのアクターにもイベントを積まない（入室・退室・送ったメッセージで状態が変わることはない）。
+
+配信は2段にしている:
+    1. ルームのアクターは状態を配信するたびに、観戦用のフレーム（JSON 文字列）を relay.publish に渡すだけ
+       （観戦者が何人いてもプレイヤーへの配信にかかる時間は変わらない）
+    2. プロセスごとの SpectatorRelay が、ルームごとに最新のフレームだけを残し、
+       別のタスクから SPECTATOR_INTERVAL に1回まで観戦者へ送る（間の更新は最新のものにまとめる）
+共有モード（settings.TEAM6_BROKER_SOCKET を設定し run_workers を使わない構成）では同じルームの観戦者が
+別のプロセスにもいるので、チャネルレイヤーの watch_<グループ名> へ1件だけ送り、各プロセスのリレーが受け取る。
+"""
+
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .metrics import Counter, Gauge
+from .protocol import encode_state_frames
+from .rooms import rooms
+
+logger = logging.getLogger(__name__)
+
+SPECTATOR_INTERVAL = 0.5  # 観戦者へ送る最短の間隔（秒）
+SEND_BATCH = 200          # この件数を送るごとにイベントループへ処理を返す（プレイヤーのイベントを待たせない）
+
+spectator_frames = Counter('team6_spectator_frames_total', 'Frames sent to spectators')
+spectator_updates = Counter('team6_spectator_updates_total', 'Room updates published to the spectator relay',
+                            ['delivered'])
+
+
+def wants_spectate(scope):
+    """接続URLのクエリで観戦が指定されているか"""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('spectate', [''])[0] in ('1', 'true')
+
+
+def watch_group(group):
+    """他のプロセスのリレーへ観戦用のフレームを届けるグループ名"""
+    return f'watch_{group}'
+
+
+class SpectatorRelay:
+    """
+    プロセス内の観戦者へ、ルームごとに最新のフレームだけを間隔を空けて送る
+
+    Args:
+        interval (float): 同じルームの観戦者へ送る最短の間隔（秒）
+    """
+
+    def __init__(self, interval=SPECTATOR_INTERVAL):
+        self.interval = interval
+        self._watchers = {}   # グループ -> 観戦者のコンシューマーの集合
+        self._latest = {}     # グループ -> 最新のフレーム
+        self._pending = set() # まだ観戦者へ送っていないグループ
+        self._loading = {}    # グループ -> 最初のフレームを読み込んでいる Future
+        self._wake = None
+        self._flusher = None
+        self._channel = None  # 共有モードで他のプロセスからフレームを受け取るチャネル
+        self._receiver = None
+
+    @property
+    def shared(self):
+        return bool(getattr(settings, 'TEAM6_BROKER_SOCKET', None)
+                    and not getattr(settings, 'TEAM6_ROUTED_WORKER', False))
+
+    def count(self):
+        return sum(len(watchers) for watchers in self._watchers.values())
+
+    async def watch(self, group, consumer, load):
+        """
+        観戦者を登録し、今の状態を送る
+
+        Args:
+            group (str): ルームのグループ名
+            consumer: 観戦者のコンシューマー（send(text_data=...) で送る）
+            load: 引数なしで今の観戦用フレーム（なければ None）を返すコルーチン関数。
+                  このプロセスにまだフレームがないときだけ呼び、同時に来た観戦者で1回にまとめる
+        """
+        watchers = self._watchers.setdefault(group, set())
+        watchers.add(consumer)
+        if len(watchers) == 1 and self.shared:
+            await self._subscribe(group)
+
+        if group not in self._latest:
+            loading = self._loading.get(group)
+            if loading is None:
+                loading = self._loading[group] = asyncio.ensure_future(load())
+                loading.add_done_callback(lambda _: self._loading.pop(group, None))
+            try:
+                # 待っている観戦者が切断しても、他の観戦者の分の読み込みは止めない
+                text = await asyncio.shield(loading)
+            except Exception:
+                logger.exception("観戦用の状態を読み込めませんでした: %s", group)
+                text = None
+            if text is not None and group in self._watchers:
+                # 読み込み中に配信された新しいフレームがあればそちらを使う
+                self._latest.setdefault(group, text)
+
+        text = self._latest.get(group)
+        if text is not None and consumer in self._watchers.get(group, ()):
+            await consumer.send(text_data=text)
+
+    async def unwatch(self, group, consumer):
+        """観戦者の登録を外す（登録されていなければ何もしない）"""
+        watchers = self._watchers.get(group)
+        if watchers is None or consumer not in watchers:
+            return
+        watchers.discard(consumer)
+        if watchers:
+            return
+        del self._watchers[group]
+        self._latest.pop(group, None)
+        self._pending.discard(group)
+        if self._channel is not None:
+            await get_channel_layer().group_discard(watch_group(group), self._channel)
+
+    async def publish(self, group, text):
+        """
+        ルームの新しい観戦用フレームを渡す（ルームのアクターから呼ぶ）
+
+        観戦者へ送るのはリレーのタスクなので、ここでは最新のフレームを置き換えるだけ
+        """
+        delivered = group in self._watchers
+        if delivered:
+            self._update(group, text)
+        spectator_updates.inc('yes' if delivered else 'no')
+        if self.shared:
+            await get_channel_layer().group_send(
+                watch_group(group),
+                {'type': 'relay.frame', 'group': group, 'text': text, 'origin': self._channel},
+            )
+
+    def _update(self, group, text):
+        self._latest[group] = text
+        self._pending.add(group)
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._wake = asyncio.Event()
+            self._flusher = loop.create_task(self._flush_loop())
+        self._wake.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            pending, self._pending = self._pending, set()
+            sent = 0
+            for group in pending:
+                text = self._latest.get(group)
+                for consumer in list(self._watchers.get(group, ())):
+                    try:
+                        await consumer.send(text_data=text)
+                    except Exception:
+                        logger.debug("観戦者へ送れませんでした", exc_info=True)
+                    sent += 1
+                    if sent % SEND_BATCH == 0:
+                        await asyncio.sleep(0)
+            spectator_frames.inc(amount=sent)
+            # 次の更新はまとめて送る
+            await asyncio.sleep(self.interval)
+
+    async def _subscribe(self, group):
+        layer = get_channel_layer()
+        if self._channel is None:
+            self._channel = await layer.new_channel('relay.')
+            self._receiver = asyncio.ensure_future(self._receive_loop(layer, self._channel))
+        await layer.group_add(watch_group(group), self._channel)
+
+    async def _receive_loop(self, layer, channel):
+        while True:
+            message = await layer.receive(channel)
+            group = message.get('group')
+            if message.get('origin') != channel and group in self._watchers:
+                self._update(group, message['text'])
+
+
+relay = SpectatorRelay()
+
+Gauge('team6_spectators', 'Connected spectators', collect=lambda: {(): relay.count()})
+
+
+class SpectatorMixin:
+    """
+    コンシューマー用: ?spectate=1 の接続を観戦者として扱う
+
+    使う側は room_group_name を決めてから start_spectating を呼び、状態を配信するたびに
+    publish_spectators で観戦用のフレームを渡す。観戦者が接続したときの最初のフレームは
+    spectator_frame(room) をルームのアクター内で呼んで作る。
+    """
+
+    def setup_spectator(self):
+        self.spectating = wants_spectate(self.scope)
+
+    async def start_spectating(self, key):
+        """
+        観戦者として接続を受け付け、リレーに登録する
+
+        Args:
+            key (str): ルームのストアキー
+        """
+        await self.accept()
+        await relay.watch(self.room_group_name, self, lambda: self._load_spectator_frame(key))
+
+    async def _load_spectator_frame(self, key):
+        room = await rooms.acquire(key)
+        try:
+            return await room.submit(self.spectator_frame)
+        finally:
+            rooms.release(room)
+
+    async def stop_spectating(self):
+        await relay.unwatch(self.room_group_name, self)
+
+    async def publish_spectators(self, text):
+        await relay.publish(self.room_group_name, text)
+
+    async def spectator_frame(self, room):
+        """観戦用のフレーム（既定は最後に配信した状態のスナップショット。DeltaStateMixin と使う）"""
+        if room.stream.last is None:
+            return None
+        return encode_state_frames(room.stream.last, room.stream.seq, None, self.snapshot_type)['full']
@@ -0,0 +1,353 @@
+"""
+ルーム状態ストア
+
+コンシューマーとルームアクターが使う非同期のキー・バリューストア。
+値はプロセス内のメモリに保持するので get/set/compare_and_set はスレッドプールを経由せず、
+イベントループ上でそのまま完了する。
+Django のキャッシュは裏側の保存先（バッキングストア）としてだけ使い、
+変更は一定間隔でまとめて書き出す（ライトビハインド）。メモリにないキーだけバッキングストアから読む。
+settings.TEAM6_SNAPSHOT_PATH を設定すると、一定間隔と終了時に全ルームをスナップショットファイルへ書き出し、
+再起動後はメモリにもバッキングストアにもないキーをそこから復元する（team6.snapshot）。
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .broker import cast_now, get_client
+from .metrics import store_backing_seconds, store_ops
+from .snapshot import SnapshotFile
+
+logger = logging.getLogger(__name__)
+
+STATE_TTL = 3600      # デフォルトの有効期限（秒）
+FLUSH_INTERVAL = 1.0  # バッキングストアへ書き出す間隔（秒）
+SNAPSHOT_INTERVAL = 30.0  # スナップショットを書き出す間隔（秒）
+
+
+class CacheBackingStore:
+    """Django のキャッシュをバッキングストアとして使う"""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    async def get(self, key):
+        return await self.cache.aget(key)
+
+    async def set_many(self, items):
+        """items: {キー: (値, 有効期限秒)}"""
+        by_ttl = {}
+        for key, (value, ttl) in items.items():
+            by_ttl.setdefault(ttl, {})[key] = value
+        for ttl, values in by_ttl.items():
+            await self.cache.aset_many(values, ttl)
+
+    async def delete_many(self, keys):
+        await self.cache.adelete_many(keys)
+
+    async def delete_if_unchanged(self, key, value):
+        """値が value のままなら消す"""
+        if await self.cache.aget(key) == value:
+            await self.cache.adelete(key)
+
+    def write_now(self, updates, deletes):
+        """同期版の set_many + delete_many（プロセス終了時用）"""
+        by_ttl = {}
+        for key, (value, ttl) in updates.items():
+            by_ttl.setdefault(ttl, {})[key] = value
+        for ttl, values in by_ttl.items():
+            self.cache.set_many(values, ttl)
+        if deletes:
+            self.cache.delete_many(deletes)
+
+
+class BrokerBackingStore:
+    """ブローカー（team6.broker）をバッキングストアとして使う（ワーカー振り分け構成用）"""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def get(self, key):
+        value, _ = await get_client(self.path).get_versioned(key)
+        return value
+
+    async def set_many(self, items):
+        client = get_client(self.path)
+        for key, (value, ttl) in items.items():
+            await client.set(key, value, ttl)
+
+    async def delete_many(self, keys):
+        client = get_client(self.path)
+        for key in keys:
+            await client.set(key, None, 0)
+
+    async def delete_if_unchanged(self, key, value):
+        """値が value のままなら消す（読んでから消すまでに書き換えられたら消さない）"""
+        client = get_client(self.path)
+        current, version = await client.get_versioned(key)
+        # ブローカーには JSON で送っているので、比べる前に同じ形にそろえる
+        if current is not None and current == json.loads(json.dumps(value)):
+            await client.compare_and_set(key, version, None, 0)
+
+    def write_now(self, updates, deletes):
+        """同期版の set_many + delete_many（プロセス終了時用）"""
+        requests = [('set', key, value, ttl) for key, (value, ttl) in updates.items()]
+        requests += [('set', key, None, 0) for key in deletes]
+        cast_now(self.path, requests)
+
+
+class RoomStateStore:
+    """
+    バージョン付きのインメモリ・ストア
+
+    各エントリは [値, バージョン, 有効期限] を持つ。バージョンはストア全体で単調増加するので、
+    削除して作り直したキーが古いバージョンと一致することはない。
+    compare_and_set は読んだときのバージョンと一致した場合だけ書き込む。
+    """
+
+    def __init__(self, backing=None, ttl=STATE_TTL, snapshot=None):
+        self._entries = {}
+        self._backing = backing
+        self._ttl = ttl
+        self._dirty = set()
+        self._flusher = None
+        self._clock = 0
+        self._snapshot = snapshot
+        self._snapshotter = None
+
+    @classmethod
+    def from_settings(cls):
+        """
+        settings.TEAM6_ROOM_STATE_BACKING（キャッシュ名 / None）からストアを作る
+
+        run_workers から起動されたワーカー（settings.TEAM6_ROUTED_WORKER）では、ワーカーが落ちても
+        ルームを引き継いだプロセスが続きから始められるように、ブローカーへ書き出す。
+        """
+        if getattr(settings, 'TEAM6_ROUTED_WORKER', False):
+            # スナップショットはブローカー側で取る
+            return cls(backing=BrokerBackingStore(settings.TEAM6_BROKER_SOCKET))
+        alias = getattr(settings, 'TEAM6_ROOM_STATE_BACKING', 'default')
+        path = getattr(settings, 'TEAM6_SNAPSHOT_PATH', None)
+        return cls(backing=CacheBackingStore(alias) if alias else None,
+                   snapshot=SnapshotFile(path) if path else None)
+
+    async def get(self, key):
+        value, _ = await self.get_versioned(key)
+        return value
+
+    async def get_versioned(self, key):
+        """
+        値とバージョンを取得する
+
+        Returns:
+            tuple: (値, バージョン)。キーがなければ (None, 0)
+        """
+        store_ops.inc('get')
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[2] > time.monotonic():
+                return entry[0], entry[1]
+            del self._entries[key]
+            return None, 0
+
+        if key in self._dirty:
+            return None, 0
+
+        # メモリにないときだけバッキングストア、次にスナップショットから読み込む（起動直後など）
+        value, ttl = None, self._ttl
+        if self._backing is not None:
+            store_ops.inc('backing_get')
+            with store_backing_seconds.time('get'):
+                value = await self._backing.get(key)
+        if value is None and self._snapshot is not None:
+            store_ops.inc('snapshot_get')
+            restored = self._snapshot.lookup(key)
+            if restored is not None:
+                value, ttl = restored
+        entry = self._entries.get(key)
+        if entry is not None:
+            # 読み込み中に書き込まれた場合はそちらを優先する
+            return entry[0], entry[1]
+        if value is None:
+            return None, 0
+        self._clock += 1
+        self._entries[key] = [value, self._clock, time.monotonic() + ttl]
+        return value, self._clock
+
+    async def set(self, key, value, ttl=None):
+        self._write(key, value, ttl)
+
+    def live_entries(self):
+        """
+        期限切れのエントリを取り除き、メモリ上のエントリを返す
+
+        Returns:
+            list: (キー, バージョン, 値) のリスト
+        """
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[2] <= now]:
+            del self._entries[key]
+        return [(key, entry[1], entry[0]) for key, entry in self._entries.items()]
+
+    async def delete(self, key):
+        self._write(key, None, None)
+
+    async def forget(self, key, delete_backing=False):
+        """
+        メモリ上のエントリだけを捨てる（delete と違い、バッキングストアの値は消さない）
+
+        run_workers 構成で接続のないルームを手放すときに使う。ルームの担当が別のワーカーに移っていれば、
+        バッキングストア（ブローカー）の値はもうそのワーカーのものになっている。
+
+        Args:
+            key (str): キー
+            delete_backing (bool): バッキングストアの値がこのプロセスの書いた値のままなら、それも消す
+        """
+        store_ops.inc('forget')
+        if key in self._dirty:
+            # 書き出していない変更を先に書き出す
+            await self.flush()
+        entry = self._entries.pop(key, None)
+        if delete_backing and entry is not None and self._backing is not None:
+            await self._backing.delete_if_unchanged(key, entry[0])
+
+    async def compare_and_set(self, key, version, value, ttl=None):
+        """
+        バージョンが一致する場合だけ値を書き込む（value が None なら削除）
+
+        Args:
+            key (str): キー
+            version (int): get_versioned で読んだバージョン
+            value: 新しい値
+            ttl (int): 有効期限（秒）
+
+        Returns:
+            bool: 書き込めたらTrue
+        """
+        store_ops.inc('compare_and_set')
+        _, current = await self.get_versioned(key)
+        if current != version:
+            return False
+        self._write(key, value, ttl)
+        return True
+
+    def _write(self, key, value, ttl):
+        store_ops.inc('set' if value is not None else 'delete')
+        self._clock += 1
+        if value is None:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = [value, self._clock, time.monotonic() + (ttl or self._ttl)]
+        if self._backing is not None:
+            self._dirty.add(key)
+            self._ensure_flusher()
+        if self._snapshot is not None:
+            self._snapshot.touch(key)
+            self._ensure_snapshotter()
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_loop())
+
+    def _ensure_snapshotter(self):
+        loop = asyncio.get_running_loop()
+        if self._snapshotter is None or self._snapshotter.done() or self._snapshotter.get_loop() is not loop:
+            self._snapshotter = loop.create_task(self._snapshot_loop())
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            if self._snapshot.changed:
+                with store_backing_seconds.time('snapshot_prepare'):
+                    prepared = self._snapshot.prepare(self._snapshot_items())
+                # 値の読み出し（JSON 化）まではループ上、圧縮と書き込みは別スレッドで行う
+                with store_backing_seconds.time('snapshot_write'):
+                    await asyncio.get_running_loop().run_in_executor(None, self._snapshot.write, prepared)
+
+    def _snapshot_items(self):
+        now = time.monotonic()
+        return [(key, entry[1], entry[0], entry[2] - now) for key, entry in self._entries.items() if entry[2] > now]
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                # 書き出せなかったキーは flush が戻しているので、次の周期で書き直す
+                logger.exception("バッキングストアへの書き出しに失敗しました")
+
+    def _take_dirty(self):
+        keys, self._dirty = self._dirty, set()
+        now = time.monotonic()
+        updates = {}
+        deletes = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] <= now:
+                deletes.append(key)
+            else:
+                # バッキングストアは別スレッドで値を読むので、ループ上でコピーしておく
+                updates[key] = (copy.deepcopy(entry[0]), max(1, int(entry[2] - now)))
+        return updates, deletes
+
+    async def flush(self):
+        """
+        変更されたキーをまとめてバッキングストアへ書き出す
+
+        書き出しに失敗したら、キーを変更ありに戻してから例外を送出する（次の flush で最新の値を書き直す）
+        """
+        if self._backing is None or not self._dirty:
+            return
+        updates, deletes = self._take_dirty()
+        store_ops.inc('backing_flush')
+        try:
+            with store_backing_seconds.time('flush'):
+                if updates:
+                    await self._backing.set_many(updates)
+                if deletes:
+                    await self._backing.delete_many(deletes)
+        except BaseException:
+            self._dirty.update(updates)
+            self._dirty.update(deletes)
+            raise
+
+    def save_on_exit(self, overrides=None):
+        """
+        プロセス終了時（イベントループの外）に、まだ書き出していない変更を
+        バッキングストアとスナップショットへ同期的に書き出す
+
+        Args:
+            overrides (dict): ストアにまだ書かれていない最新の値 {キー: 値（削除なら None）}
+        """
+        for key, value in (overrides or {}).items():
+            self._clock += 1
+            if value is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = [value, self._clock, time.monotonic() + self._ttl]
+            if self._backing is not None:
+                self._dirty.add(key)
+            if self._snapshot is not None:
+                self._snapshot.touch(key)
+
+        if self._backing is not None and self._dirty:
+            try:
+                self._backing.write_now(*self._take_dirty())
+            except Exception:
+                logger.exception("終了時の書き出しに失敗しました")
+        if self._snapshot is not None and self._snapshot.changed:
+            self._snapshot.save(self._snapshot_items())
+
+
+room_store = RoomStateStore.from_settings()
@@ -1,3 +1,6 @@
+let turnCountdown = null; // 持ち時間の表示を更新するタイマー
+let turnDeadline = null;  // カードを出す期限（UNIX 時刻の秒）
+
 document.addEventListener('DOMContentLoaded', () => {
     const roomNameData = document.getElementById('room-name-data');
     const userEl = document.getElementById('my-username');
@@ -6,7 +9,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const roomName = roomNameData.textContent.trim();
     const socketPath = '/ws/ecard/' + roomName + '/';
     const gameSocket = new WebSocket(
-        (location.protocol === 'https:' ? 'wss:' : 'ws:') + window.location.host + socketPath
+        (location.protocol === 'https:' ? 'wss://' : 'ws://') + window.location.host + socketPath
     );
 
     gameSocket.onopen = () => console.log("WebSocket接続成功！ 部屋:", roomName);
@@ -21,20 +24,23 @@ document.addEventListener('DOMContentLoaded', () => {
             const statusMsg = document.getElementById('status-msg');
 
             // 陣営表示を更新
-            if (sideBadge && data.side) {
-                sideBadge.innerText = (data.side === 'emperor_side' ? "皇帝側" : "奴隷側");
-                sideBadge.className = `badge ${data.side === 'emperor_side' ? 'bg-primary' : 'bg-danger'} p-2`;
-            }
+            updateSideUI(data.side, data.round, data.rounds);
 
             // 2人揃っているかチェック
             // サーバー側から送られる data.is_ready を見て表示を切り替える
             if (data.is_ready) {
-                statusMsg.innerText = "カードを選べ‥‥！";
+                statusMsg.innerText = data.played ? "ざわ‥　ざわ‥‥（相手の選択待ち）" : "カードを選べ‥‥！";
                 statusMsg.className = "alert alert-warning text-dark fw-bold";
                 updateUI(data.hand, gameSocket); // 2人揃ったら手札を表示
+                if (data.played) {
+                    document.querySelectorAll('#my-cards button').forEach(b => b.disabled = true);
+                }
+                turnDeadline = data.turn_deadline;
+                updateTimer(!data.played, turnDeadline);
             } else {
                 statusMsg.innerText = "相手の接続を待機中‥‥ざわ‥‥";
                 statusMsg.className = "alert alert-secondary";
+                updateTimer(false, null);
             }
 
             // ポイント表示を更新
@@ -43,17 +49,28 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         }
 
+        // 出せないカードなど
+        if (data.type === 'error') {
+            alert(data.message);
+        }
+
         // 2. 判定結果
         if (data.type === 'round_result') {
             document.getElementById('status-msg').innerText = "開門‥‥‥‥！";
+            turnDeadline = data.is_over ? null : data.turn_deadline;
+            updateTimer(!data.is_over, turnDeadline);
             setTimeout(() => {
                 updatePointsUI(data.points, data.opp_points);
                 alert(data.message);
                 if (data.is_over) {
-                    location.reload(); // シンプルにリロードしてリセット
+                    // 全ラウンド終了。リロードすると同じ相手と次の試合が始まる
+                    const result = data.winner === 'draw' ? "引き分け" : (data.winner === userEl.value ? "あなたの勝ち" : "あなたの負け");
+                    alert(`試合終了: ${result}（${data.points} pt 対 ${data.opp_points} pt）`);
+                    location.reload();
                 } else {
+                    updateSideUI(data.side, data.round, data.rounds);
                     updateUI(data.new_hand, gameSocket);
-                    document.getElementById('status-msg').innerText = "続行だ‥‥！";
+                    document.getElementById('status-msg').innerText = data.round_over ? "次のラウンドだ‥‥！" : "続行だ‥‥！";
                 }
             }, 1000);
         }
@@ -75,6 +92,7 @@ function updateUI(hand, socket) {
             socket.send(JSON.stringify({'type': 'play_card', 'card': card}));
             document.getElementById('status-msg').innerText = "ざわ‥　ざわ‥‥（相手の選択待ち）";
             document.querySelectorAll('#my-cards button').forEach(b => b.disabled = true);
+            updateTimer(false, turnDeadline);
         };
         container.appendChild(btn);
     });
@@ -89,4 +107,44 @@ function updatePointsUI(mine, opp) {
             <div class="text-danger">ENEMY: ${opp || 0} pt</div>
         </div>
     `;
-}
\ No newline at end of file
+}
+
+function updateSideUI(side, round, rounds) {
+    const sideBadge = document.getElementById('side-badge');
+    if (!sideBadge || !side) return;
+    const label = (side === 'emperor_side' ? "皇帝側" : "奴隷側");
+    sideBadge.innerText = round ? `${label}（ラウンド ${round} / ${rounds}）` : label;
+    sideBadge.className = `badge ${side === 'emperor_side' ? 'bg-primary' : 'bg-danger'} p-2`;
+}
+
+/**
+ * 持ち時間タイマーを更新・開始する関数
+ * 期限はサーバーが決める（turn_deadline: UNIX 時刻の秒）。時間切れの判定もサーバーが行うので、
+ * ここでは残り時間を表示するだけ（deadline がなければ隠す）
+ */
+function updateTimer(isMyTurn, deadline) {
+    clearInterval(turnCountdown); // 既存のタイマーをクリア
+
+    const timerBox = document.getElementById('timer-box');
+    const timerCount = document.getElementById('timer-count');
+    if (!timerBox || !timerCount) return;
+    if (!deadline) {
+        timerBox.style.display = 'none';
+        return;
+    }
+
+    const render = () => {
+        const timeLeft = Math.max(0, Math.ceil(deadline - Date.now() / 1000));
+        timerCount.innerText = timeLeft;
+        if (timeLeft <= 0) clearInterval(turnCountdown);
+    };
+    timerBox.style.display = 'block';
+    render();
+
+    // 自分が操作する番なら赤(bg-danger)、相手を待っている間はグレー(bg-secondary)
+    timerBox.firstElementChild.className = isMyTurn
+        ? "badge rounded-pill bg-danger p-2 px-4"
+        : "badge rounded-pill bg-secondary p-2 px-4";
+
+    turnCountdown = setInterval(render, 1000);
+}
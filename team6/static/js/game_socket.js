@@ -5,8 +5,11 @@ const roomName = mainEl ? mainEl.getAttribute('data-room-name') : "test";
 const myUsername = document.getElementById('my-username').value;
 const gameType = 'tictactoe';
 
-const gameSocket = new WebSocket(
-    `${location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}/ws/${gameType}/${roomName}/`
+const socketPath = `/ws/${gameType}/${roomName}/`;
+// ページを読み込み直したり接続が切れたりしても、続きから差分を受け取る
+const stateSync = new StateSync(`team6:${socketPath}`);
+const gameSocket = new ResumableSocket(
+    `${location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}${socketPath}?proto=delta`, stateSync
 );
 
 gameSocket.onopen = function(e) {
@@ -14,7 +17,10 @@ gameSocket.onopen = function(e) {
 };
 
 gameSocket.onmessage = function(e) {
-    const data = JSON.parse(e.data);
+    // 差分を適用した結果は e.resolved に残し、テンプレート側のフックでも使う
+    const data = stateSync.resolve(JSON.parse(e.data));
+    e.resolved = data;
+    if (data === null) return;
 
     if (data.type === 'opponent_retired') {
         // 1. モーダルの要素を取得して表示
@@ -58,13 +64,16 @@ gameSocket.onmessage = function(e) {
                 // 裏で表示が変わっていてもモーダルが被さるのでそのままでも大丈夫です。
             }
 
+            // 手番の時間切れ（サーバー側で判定）
+            const timeoutNote = data.end_reason === 'timeout' ? "時間切れ — " : "";
+
             if (data.winner === 'draw') {
                 updateStatus("引き分け！");
             } else {
                 const winnerName = data.winner === 'X' ? data.player_x : data.player_o;
                 const displayMark = data.winner === 'X' ? '✖' : '〇';
                 const colorClass = data.winner === 'X' ? 'text-x' : 'text-o';
-                updateStatus(`勝者: <span class="${colorClass} fw-bold">${winnerName} (${displayMark})</span>`);
+                updateStatus(`${timeoutNote}勝者: <span class="${colorClass} fw-bold">${winnerName} (${displayMark})</span>`);
             }
 
             const resetBtn = document.getElementById('reset-btn');
@@ -95,6 +104,10 @@ gameSocket.onmessage = function(e) {
                 
                 let statusMsg = `現在のターン: <span class="${colorClass} fw-bold">${displayMark} (${currentName})</span>`;
                 if (isMyTurn) statusMsg += " <span class='text-dark ms-2'>✨ あなたの番です</span>";
+                // 相手の接続が切れて、再接続の猶予中
+                if (data.away && Object.keys(data.away).some(name => name !== myUsername)) {
+                    statusMsg += " <span class='text-secondary ms-2'>（相手の再接続を待っています）</span>";
+                }
                 
                 updateStatus(statusMsg);
                 
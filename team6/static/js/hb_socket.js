@@ -4,21 +4,25 @@ const mainEl = document.querySelector('[data-room-name]');
 const roomName = mainEl.getAttribute('data-room-name');
 const myUsernameRaw = document.getElementById('my-username').value;
 const myUsername = myUsernameRaw.trim().toLowerCase();
-const gameSocket = new WebSocket(`${location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}/ws/hitandblow/${roomName}/`);
+const socketPath = `/ws/hitandblow/${roomName}/`;
+const stateSync = new StateSync(`team6:${socketPath}`);
+const gameSocket = new ResumableSocket(`${location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}${socketPath}?proto=delta`, stateSync);
 
 let currentInput = [];
 let gamePhase = 'waiting';
+let turnCountdown = null; // 持ち時間の表示を更新するタイマー
 window.isGameOver = false; // グローバル変数にしてHTMLから見えるようにする
 
 // ブラウザを閉じる時の警告
 window.onbeforeunload = function() {
     if (gamePhase !== 'waiting' && !window.isGameOver) {
-        return "試合を離脱すると敗北となります。本当によろしいですか？";
+        return "試合を離脱して戻らないと敗北となります。本当によろしいですか？";
     }
 };
 
 gameSocket.onmessage = function(e) {
-    const data = JSON.parse(e.data);
+    const data = stateSync.resolve(JSON.parse(e.data));
+    if (data === null) return;
     console.log("HB Message Received:", data);
 
     if (data.type === 'game_start') {
@@ -73,10 +77,14 @@ function updateUI(data) {
 
     // ゲーム終了時の処理
     if (data.game_over) {
-        statusText.innerHTML = `🏆 BATTLE END! 勝者: <span class='text-primary'>${data.winner}</span>`;
+        const timeoutNote = data.end_reason === 'timeout' ? "（時間切れ）" : "";
+        statusText.innerHTML = data.winner === 'draw'
+            ? `🏆 BATTLE END! 引き分け${timeoutNote}`
+            : `🏆 BATTLE END! 勝者: <span class='text-primary'>${data.winner}</span>${timeoutNote}`;
         inputSection.style.display = 'none';
         resetBtn.style.display = 'inline-block'; // ボタンを表示
         window.isGameOver = true;
+        updateTimer(false, null);
         updateHistory(data.history || []);
         return;
     }
@@ -90,6 +98,8 @@ function updateUI(data) {
         const isSet = (myUsername === (data.player_x || "").toLowerCase() ? data.secret_x_set : data.secret_o_set);
         statusText.textContent = isSet ? "相手の入力を待っています..." : "自分の秘密の3桁をセットしてください";
         submitBtn.disabled = (currentInput.length !== 3 || isSet);
+        // 数字決めの期限は2人共通
+        updateTimer(!isSet, data.turn_deadline);
     } 
     else if (gamePhase === 'playing') {
         inputSection.style.display = 'block';
@@ -97,11 +107,44 @@ function updateUI(data) {
         const isMyTurn = (currentTurnUser.toLowerCase() === myUsername);
         statusText.innerHTML = isMyTurn ? "<span class='text-success fw-bold'>あなたの番です！予想を入力</span>" : `<span class='text-muted'>${currentTurnUser} が考え中...</span>`;
         submitBtn.disabled = (currentInput.length !== 3 || !isMyTurn);
+        updateTimer(isMyTurn, data.turn_deadline);
     }
 
     updateHistory(data.history || []);
 }
 
+/**
+ * 持ち時間タイマーを更新・開始する関数
+ * 期限はサーバーが決める（turn_deadline: UNIX 時刻の秒）。時間切れの判定もサーバーが行うので、
+ * ここでは残り時間を表示するだけ（deadline がなければ隠す）
+ */
+function updateTimer(isMyTurn, deadline) {
+    clearInterval(turnCountdown); // 既存のタイマーをクリア
+
+    const timerBox = document.getElementById('timer-box');
+    const timerCount = document.getElementById('timer-count');
+    if (!timerBox || !timerCount) return;
+    if (!deadline) {
+        timerBox.style.display = 'none';
+        return;
+    }
+
+    const render = () => {
+        const timeLeft = Math.max(0, Math.ceil(deadline - Date.now() / 1000));
+        timerCount.innerText = timeLeft;
+        if (timeLeft <= 0) clearInterval(turnCountdown);
+    };
+    timerBox.style.display = 'block';
+    render();
+
+    // 自分が操作する番なら赤(bg-danger)、相手を待っている間はグレー(bg-secondary)
+    timerBox.firstElementChild.className = isMyTurn
+        ? "badge rounded-pill bg-danger p-2 px-4"
+        : "badge rounded-pill bg-secondary p-2 px-4";
+
+    turnCountdown = setInterval(render, 1000);
+}
+
 // 追加: リセット信号の送信
 function sendReset() {
     if (gameSocket.readyState === WebSocket.OPEN) {
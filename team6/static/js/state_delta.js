@@ -0,0 +1,133 @@
+// team6/static/js/state_delta.js
+// 差分配信 (?proto=delta) の受信処理と、切れたときの再接続。game_socket.js と hb_socket.js で共用する
+
+function applyDelta(state, ops) {
+    ops.forEach(op => {
+        const [kind, key] = op;
+        if (kind === 's') state[key] = op[2];
+        else if (kind === 'd') delete state[key];
+        else if (kind === 'c') state[key][op[2]] = op[3];
+        else if (kind === 'a') state[key].push(...op[2]);
+    });
+}
+
+class StateSync {
+    // storageKey を渡すと、受け取った状態と再開用のセッションを sessionStorage に残す。
+    // ページを読み込み直しても、続きから差分を受け取れる
+    constructor(storageKey) {
+        this.socket = null; // ResumableSocket が設定する
+        this.state = null;
+        this.seq = null;
+        this.session = null;
+        this.resyncing = false;
+        this.storageKey = storageKey || null;
+        this.load();
+    }
+
+    load() {
+        if (!this.storageKey) return;
+        try {
+            const saved = JSON.parse(sessionStorage.getItem(this.storageKey));
+            if (saved) {
+                this.state = saved.state;
+                this.seq = saved.seq;
+                this.session = saved.session;
+            }
+        } catch (e) {
+            // 保存できない環境では再開せずにスナップショットから始める
+        }
+    }
+
+    save() {
+        if (!this.storageKey) return;
+        try {
+            sessionStorage.setItem(this.storageKey, JSON.stringify({state: this.state, seq: this.seq, session: this.session}));
+        } catch (e) {}
+    }
+
+    // 接続し直すときに URL に付けるクエリ（続きから受け取れないときは空）
+    resumeQuery() {
+        if (!this.session || this.state === null || this.seq === null) return '';
+        return `resume=${encodeURIComponent(this.session.token)}&epoch=${encodeURIComponent(this.session.epoch)}&seq=${this.seq}`;
+    }
+
+    // 受信データを状態全体に戻して返す。差分を適用できないときは再同期を要求して null を返す
+    resolve(data) {
+        if (data.type === 'session') {
+            // 再開用のセッション（画面には関係しない）
+            this.session = {token: data.token, epoch: data.epoch};
+            this.save();
+            return null;
+        }
+        if (data.type === 'delta') {
+            if (this.state === null || data.seq !== this.seq + 1) {
+                this.state = null;
+                if (!this.resyncing) {
+                    this.resyncing = true;
+                    this.socket.send(JSON.stringify({'type': 'resync'}));
+                }
+                return null;
+            }
+            applyDelta(this.state, data.ops);
+            this.seq = data.seq;
+            this.save();
+            return JSON.parse(JSON.stringify(this.state));
+        }
+        if (data.seq !== undefined) {
+            // スナップショット
+            this.state = JSON.parse(JSON.stringify(data));
+            this.seq = data.seq;
+            this.resyncing = false;
+            this.save();
+        }
+        return data;
+    }
+}
+
+// 切れたら接続し直す WebSocket の代わり（onopen / onmessage / onclose / send / readyState は WebSocket と同じ）。
+// 接続し直すときは StateSync.resumeQuery を付け、サーバーは見逃した差分だけを送る
+class ResumableSocket {
+    constructor(url, sync) {
+        this.url = url;
+        this.sync = sync;
+        sync.socket = this;
+        this.onopen = null;
+        this.onmessage = null;
+        this.onclose = null;
+        this.opened = false;
+        this.leaving = false;
+        this.retries = 0;
+        window.addEventListener('pagehide', () => { this.leaving = true; });
+        this.connect();
+    }
+
+    connect() {
+        const query = this.sync.resumeQuery();
+        const ws = new WebSocket(query ? `${this.url}${this.url.includes('?') ? '&' : '?'}${query}` : this.url);
+        ws.onopen = e => {
+            this.opened = true;
+            this.retries = 0;
+            if (this.onopen) this.onopen(e);
+        };
+        ws.onmessage = e => {
+            if (this.onmessage) this.onmessage(e);
+        };
+        ws.onclose = e => {
+            if (this.onclose) this.onclose(e);
+            // 一度もつながらなかった（認証エラーなど）ときと、ページを離れるときはつなぎ直さない
+            if (!this.opened || this.leaving) return;
+            const delay = Math.min(10000, 500 * 2 ** this.retries++);
+            setTimeout(() => this.connect(), delay);
+        };
+        this.ws = ws;
+    }
+
+    send(data) {
+        // つなぎ直している間の操作は捨てる（つながると最新の状態が届く）
+        if (this.ws.readyState === WebSocket.OPEN) this.ws.send(data);
+    }
+
+    get readyState() {
+        return this.ws.readyState;
+    }
+}
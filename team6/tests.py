@@ -1,3 +1,1384 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase
+
+from .broker import BrokerChannelLayer, BrokerClient, BrokerServer, get_client
+from .game_logic.ecard import (
+    CITIZENS, EMPEROR_WIN_POINTS, ROUNDS, SLAVE_WIN_POINTS, ECardMatch, bot_card, initial_hand, solve_round,
+)
+from .game_logic.hitandblow import HitAndBlow, all_codes, code_indices, decode_score, score_matrix
+from .game_logic.hitandblow_bot import HitAndBlowSolver
+from .game_logic.move_codec import (
+    ECARD_OUTCOMES, decode_ecard, decode_hitandblow, decode_tictactoe, encode_ecard, encode_hitandblow,
+    encode_tictactoe,
+)
+from .game_logic.tictactoe import WIN_LINES, TicTacToe
+from .game_logic.tictactoe_ai import best_move, evaluate
+from .leaderboard import MAX_RATING, Leaderboard, leaderboard
+from .glicko2 import DEFAULT_RATING, DEFAULT_RD, DEFAULT_VOLATILITY, SCALE, Glicko2
+from .matchmaking import BASE_WINDOW, BOT_NAME, MAX_WINDOW, WIDEN_PER_SECOND, MatchQueue, Ticket
+from .models import GameRecord, UserGameStats, UserProfile
+from .protocol import REPLAY_SIZE, StateStream, apply_ops, diff_state, encode_state_frames
+from .ratings import apply_results
+from .records import record_game, record_queue, save_records, user_history
+from .resume import ResumeMixin, resume_cursor, resume_grace, resume_token
+from .rooms import RoomActor, rooms
+from .routing import websocket_urlpatterns
+from .snapshot import SnapshotFile, encode_value, write_snapshot
+from .spectators import SpectatorRelay
+from .state_store import RoomStateStore, room_store
+from .timers import TimerWheel, TurnTimerMixin
+from .write_behind import WriteBehindQueue
+
+
+class MatchQueueTests(SimpleTestCase):
+    def ticket(self, name, rating, at=0.0):
+        return Ticket(name, f'channel-{name}', rating, at)
+
+    def test_matches_closest_rating_within_window(self):
+        queue = MatchQueue('tictactoe')
+        self.assertIsNone(queue.add(self.ticket('older', 1300, 0.0), 0.0))
+        self.assertIsNone(queue.add(self.ticket('closer', 1420, 0.5), 0.5))
+        # どちらも許容範囲だが、長く待っている人よりレートの近い人を選ぶ
+        opponent = queue.add(self.ticket('me', 1380, 1.0), 1.0)
+        self.assertEqual(opponent.username, 'closer')
+        self.assertEqual(len(queue), 1)
+
+    def test_same_rating_matches_oldest_first(self):
+        queue = MatchQueue('tictactoe')
+        queue.add(self.ticket('a', 1500, 0.0), 0.0)
+        queue.remove('channel-a')
+        queue.add(self.ticket('b', 1500, 1.0), 1.0)
+        queue.add(self.ticket('b2', 1600 + BASE_WINDOW * 2, 1.5), 1.5)
+        opponent = queue.add(self.ticket('c', 1500, 2.0), 2.0)
+        self.assertEqual(opponent.username, 'b')
+
+    def test_no_match_outside_window_until_sweep_widens_it(self):
+        queue = MatchQueue('tictactoe')
+        gap = BASE_WINDOW + 2 * WIDEN_PER_SECOND
+        queue.add(self.ticket('a', 1500), 0.0)
+        self.assertIsNone(queue.add(self.ticket('b', 1500 + gap), 0.0))
+        self.assertEqual(queue.sweep(1.0), [])
+        pairs = queue.sweep(2.0)
+        self.assertEqual([{t.username for t in pair} for pair in pairs], [{'a', 'b'}])
+        self.assertEqual(len(queue), 0)
+
+    def test_never_matches_beyond_max_window(self):
+        queue = MatchQueue('tictactoe')
+        queue.add(self.ticket('a', 1000), 0.0)
+        queue.add(self.ticket('b', 1000 + MAX_WINDOW + 1), 0.0)
+        self.assertEqual(queue.sweep(3600.0), [])
+
+    def test_remove_and_requeue(self):
+        queue = MatchQueue('tictactoe')
+        for i in range(5):
+            queue.add(self.ticket(f'u{i}', 1000 + i * (MAX_WINDOW + 1)), 0.0)
+        self.assertEqual(queue.remove('channel-u2').username, 'u2')
+        self.assertIsNone(queue.remove('channel-u2'))
+        # 同じユーザーが並び直すと古い方は外れる
+        queue.add(Ticket('u0', 'channel-u0-new', 1000, 1.0), 1.0)
+        self.assertEqual(len(queue), 4)
+        self.assertIsNone(queue.remove('channel-u0'))
+        self.assertEqual([t.username for t in queue.pop_expired(10.0, 9.5)], ['u1', 'u3', 'u4'])
+        self.assertEqual(len(queue), 1)
+
+
+class DiffStateTests(SimpleTestCase):
+    def assertReproduces(self, old, new):
+        ops = diff_state(old, new)
+        # JSON を通した後の状態に適用して、新しい状態がそのまま再現できること
+        state = json.loads(json.dumps(old))
+        self.assertEqual(apply_ops(state, json.loads(json.dumps(ops))), new)
+        return ops
+
+    def test_unchanged_state_has_no_ops(self):
+        state = {'board': [''] * 9, 'current_turn': 'X'}
+        self.assertEqual(self.assertReproduces(state, dict(state)), [])
+
+    def test_cell_change_and_append(self):
+        old = {'board': [''] * 9, 'history': [{'guess': [1, 2, 3]}], 'current_turn': 'X'}
+        new = {'board': ['X'] + [''] * 8, 'history': [{'guess': [1, 2, 3]}, {'guess': [4, 5, 6]}],
+               'current_turn': 'O'}
+        ops = self.assertReproduces(old, new)
+        self.assertIn(['c', 'board', 0, 'X'], ops)
+        self.assertIn(['a', 'history', [{'guess': [4, 5, 6]}]], ops)
+
+    def test_added_and_removed_keys(self):
+        old = {'board': ['X', 'O', ''], 'turn_deadline': 100.0}
+        new = {'board': ['', '', ''], 'winner': 'draw', 'game_over': True}
+        ops = self.assertReproduces(old, new)
+        self.assertIn(['d', 'turn_deadline'], ops)
+
+    def test_stream_chains_deltas(self):
+        stream = StateStream()
+        states = [
+            {'board': [''] * 9, 'players': {'X': 'alice'}},
+            {'board': [''] * 9, 'players': {'X': 'alice', 'O': 'bob'}},
+            {'board': ['X'] + [''] * 8, 'players': {'X': 'alice', 'O': 'bob'}},
+        ]
+        seq, ops = stream.advance(states[0])
+        self.assertEqual((seq, ops), (1, None))
+        client = json.loads(json.dumps(states[0]))
+        for state in states[1:]:
+            seq, ops = stream.advance(state)
+            apply_ops(client, ops)
+            self.assertEqual(client, state)
+        self.assertEqual(seq, 3)
+
+
+class TicTacToeTests(SimpleTestCase):
+    def play_all(self, moves):
+        game = TicTacToe()
+        for position in moves:
+            self.assertTrue(game.play(position))
+        return game
+
+    def test_every_line_wins(self):
+        for line in WIN_LINES:
+            others = [p for p in range(9) if p not in line]
+            # X がラインを埋める間に O はライン外へ2手だけ打つ
+            game = self.play_all([line[0], others[0], line[1], others[1], line[2]])
+            self.assertTrue(game.game_over)
+            self.assertEqual(game.winner, 'X')
+            self.assertEqual(game.winning_line, line)
+            self.assertEqual(game.check_winner(), ('X', line))
+
+    def test_draw_and_moves_after_game_over(self):
+        game = self.play_all([0, 1, 2, 4, 3, 5, 7, 6, 8])
+        self.assertTrue(game.game_over)
+        self.assertEqual(game.winner, 'draw')
+        self.assertEqual(game.winning_line, ())
+        self.assertFalse(game.play(0))
+
+    def test_invalid_moves(self):
+        game = self.play_all([4])
+        for position in (4, -1, 9, '4', None):
+            self.assertFalse(game.play(position))
+        self.assertEqual(game.current_player, 'O')
+
+    def test_from_board_round_trip(self):
+        game = self.play_all([0, 4, 1, 8, 2])
+        restored = TicTacToe.from_board(game.to_board(), game.current_player)
+        self.assertEqual(restored.get_state(), game.get_state())
+        self.assertEqual(restored.get_state()['winning_line'], [0, 1, 2])
+
+
+class TicTacToeAITests(SimpleTestCase):
+    def test_self_play_is_a_draw(self):
+        game = TicTacToe()
+        self.assertEqual(evaluate(game), 0)
+        while not game.game_over:
+            self.assertTrue(game.play(best_move(game)))
+        self.assertEqual(game.winner, 'draw')
+
+    def test_never_loses(self):
+        # 相手のあらゆる手に対して、CPU（X でも O でも）が負けないこと
+        def explore(game, cpu):
+            if game.game_over:
+                self.assertIn(game.winner, (cpu, 'draw'), game.move_history)
+                return
+            if game.current_player == cpu:
+                moves = [best_move(game)]
+            else:
+                moves = [p for p in range(9) if game.is_valid_move(p)]
+            for position in moves:
+                child = TicTacToe.from_board(game.to_board(), game.current_player)
+                child.move_history = game.move_history + [position]
+                child.play(position)
+                explore(child, cpu)
+
+        explore(TicTacToe(), 'X')
+        explore(TicTacToe(), 'O')
+
+    def test_takes_a_win_and_blocks(self):
+        # X の手番で 0,1 が揃っているので 2 で勝つ
+        game = TicTacToe.from_board(['X', 'X', ' ', 'O', 'O', ' ', ' ', ' ', ' '], 'X')
+        self.assertEqual(best_move(game), 2)
+        self.assertGreater(evaluate(game), 0)
+        # O の手番で X の 0,4 の対角線を 8 で止める
+        game = TicTacToe.from_board(['X', 'O', ' ', ' ', 'X', ' ', ' ', ' ', ' '], 'O')
+        self.assertEqual(best_move(game), 8)
+        self.assertLess(evaluate(game), 0)
+
+
+class HitAndBlowScoreTests(SimpleTestCase):
+    def test_code_indices_match_all_codes(self):
+        for digits in (2, 3, 4):
+            codes = all_codes(digits)
+            self.assertEqual(code_indices(codes).tolist(), list(range(len(codes))))
+
+    def test_matrix_matches_calculate_result(self):
+        rng = random.Random(0)
+        for digits in (2, 3):
+            game = HitAndBlow(digits)
+            codes = all_codes(digits).tolist()
+            hits, blows = decode_score(score_matrix(digits))
+            # 3桁は全組み合わせだと多いので予想を抜き出して照合する
+            rows = range(len(codes)) if digits == 2 else rng.sample(range(len(codes)), 40)
+            for i in rows:
+                for j, secret in enumerate(codes):
+                    expected = game.calculate_result(secret, codes[i])
+                    self.assertEqual((hits[i, j], blows[i, j]), (expected['hit'], expected['blow']))
+
+    def test_batch_scoring(self):
+        game = HitAndBlow(3)
+        secrets = [[1, 2, 3], [3, 2, 1], [4, 5, 6], [1, 0, 2]]
+        hits, blows = game.score_many([1, 2, 3], secrets)
+        self.assertEqual(hits.tolist(), [3, 1, 0, 1])
+        self.assertEqual(blows.tolist(), [0, 2, 0, 1])
+        hits, blows = game.score_guesses(secrets, [1, 2, 3])
+        self.assertEqual(hits.tolist(), [3, 1, 0, 1])
+        self.assertEqual(blows.tolist(), [0, 2, 0, 1])
+        # 判定表を持たない桁数はその場で計算する
+        hits, blows = HitAndBlow(5).score_many([0, 1, 2, 3, 4], [[0, 1, 2, 4, 3], [5, 6, 7, 8, 9]])
+        self.assertEqual((hits.tolist(), blows.tolist()), ([3, 0], [2, 0]))
+
+    def test_is_valid_input(self):
+        game = HitAndBlow(3)
+        self.assertTrue(game.is_valid_input([0, 1, 2]))
+        for value in ([1, 2], [1, 1, 2], [1, 2, 10], [-1, 2, 3]):
+            self.assertFalse(game.is_valid_input(value))
+
+
+class HitAndBlowSolverTests(SimpleTestCase):
+    def test_finds_every_secret(self):
+        game = HitAndBlow(3)
+        rng = random.Random(0)
+        for secret in all_codes(3).tolist():
+            # 思考時間を0にすると最初のまとまりだけを評価する（結果が時間に左右されない）
+            solver = HitAndBlowSolver(3, time_budget=0, rng=rng)
+            for turn in range(1, 8):
+                guess = solver.next_guess()
+                self.assertTrue(game.is_valid_input(guess))
+                result = game.calculate_result(secret, guess)
+                if result['hit'] == 3:
+                    break
+                solver.observe(guess, result['hit'], result['blow'])
+                self.assertIn(code_indices([secret])[0], solver.remaining)
+            else:
+                self.fail(f'{secret} を7手で当てられませんでした')
+
+    def test_contradiction_raises(self):
+        solver = HitAndBlowSolver(3, rng=random.Random(0))
+        solver.observe([1, 2, 3], 3, 0)
+        self.assertEqual(solver.next_guess(), [1, 2, 3])
+        solver.observe([1, 2, 3], 0, 0)
+        with self.assertRaises(ValueError):
+            solver.next_guess()
+        with self.assertRaises(ValueError):
+            solver.observe([1, 1, 2], 0, 0)
+
+
+class ECardTests(SimpleTestCase):
+    def test_round_flow_and_scoring(self):
+        match = ECardMatch(['alice', 'bob'])
+        self.assertEqual(match.side_of('alice'), 'emperor_side')
+        # 市民同士は続行し、皇帝対市民で皇帝側が勝つ
+        self.assertIsNone(match.play('alice', 'C'))
+        self.assertFalse(match.play('bob', 'C')['round_over'])
+        self.assertEqual(match.hands['alice'].count('C'), CITIZENS - 1)
+        match.play('bob', 'C')
+        result = match.play('alice', 'E')
+        self.assertEqual((result['round_over'], result['winner_side']), (True, 'emperor_side'))
+        self.assertEqual(match.points, {'alice': EMPEROR_WIN_POINTS, 'bob': 0})
+        self.assertEqual(match.history[-1]['turn'], 2)
+        self.assertEqual(match.round, 2)
+        self.assertEqual(match.hands['alice'], initial_hand('emperor_side'))
+
+    def test_invalid_plays(self):
+        match = ECardMatch(['alice', 'bob'])
+        for player, card in (('alice', 'S'), ('carol', 'C')):
+            with self.assertRaises(ValueError):
+                match.play(player, card)
+        match.play('alice', 'C')
+        with self.assertRaises(ValueError):
+            match.play('alice', 'C')
+
+    def test_sides_switch_and_match_ends(self):
+        match = ECardMatch(['alice', 'bob'])
+        emperors = []
+        while not match.game_over:
+            emperor, slave = match.player_of('emperor_side'), match.player_of('slave_side')
+            emperors.append(emperor)
+            match.play(emperor, 'E')
+            match.play(slave, 'S')
+        self.assertEqual(emperors, (['alice'] * 3 + ['bob'] * 3) * 2)
+        self.assertEqual(len(match.history), ROUNDS)
+        # どちらも奴隷側で6回勝つので同点
+        self.assertEqual(match.points, {'alice': 6 * SLAVE_WIN_POINTS, 'bob': 6 * SLAVE_WIN_POINTS})
+        self.assertEqual(match.winner, 'draw')
+        with self.assertRaises(ValueError):
+            match.play('alice', 'C')
+        restored = ECardMatch.from_state(json.loads(json.dumps(match.get_state())))
+        self.assertEqual(restored.get_state(), match.get_state())
+
+    def test_solve_round_is_an_equilibrium(self):
+        self.assertEqual(solve_round(0), (1.0, 1.0, -SLAVE_WIN_POINTS))
+        self.assertEqual(solve_round(1), (0.5, 0.5, -2.0))
+        for k in range(1, CITIZENS + 1):
+            p, q, value = solve_round(k)
+            continuation = solve_round(k - 1)[2]
+            # 均衡では相手がどちらを出しても期待得点差が同じ（＝ゲームの値）になる
+            against_slave = p * -SLAVE_WIN_POINTS + (1 - p) * EMPEROR_WIN_POINTS
+            against_citizen = p * EMPEROR_WIN_POINTS + (1 - p) * continuation
+            self.assertAlmostEqual(against_slave, value)
+            self.assertAlmostEqual(against_citizen, value)
+            with_emperor = q * -SLAVE_WIN_POINTS + (1 - q) * EMPEROR_WIN_POINTS
+            with_citizen = q * EMPEROR_WIN_POINTS + (1 - q) * continuation
+            self.assertAlmostEqual(with_emperor, value)
+            self.assertAlmostEqual(with_citizen, value)
+
+    def test_bot_card_is_in_hand(self):
+        rng = random.Random(0)
+        for side in ('emperor_side', 'slave_side'):
+            for _ in range(100):
+                hand = initial_hand(side)
+                # 特殊カードを出すとラウンドが終わる
+                card = 'C'
+                while card == 'C':
+                    card = bot_card(side, hand, rng)
+                    self.assertIn(card, hand)
+                    hand.remove(card)
+
+
+class MoveCodecTests(SimpleTestCase):
+    def test_tictactoe_round_trip(self):
+        moves = [4, 0, 8, 2, 1, 7, 6, 3, 5]
+        self.assertEqual(decode_tictactoe(encode_tictactoe(moves)), moves)
+
+    def test_hitandblow_round_trip(self):
+        rng = random.Random(0)
+        for digits in (3, 4, 5):
+            codes = [rng.sample(range(10), digits) for _ in range(7)]
+            data = encode_hitandblow(digits, codes[0], codes[1], codes[2:])
+            self.assertEqual(len(data), 1 + 7 * ((digits + 1) // 2))
+            self.assertEqual(decode_hitandblow(data), {
+                'digits': digits, 'secret_first': codes[0], 'secret_second': codes[1], 'guesses': codes[2:],
+            })
+        # 予想がないまま終わった対局
+        data = encode_hitandblow(3, [1, 2, 3], [4, 5, 6], [])
+        self.assertEqual(decode_hitandblow(data)['guesses'], [])
+
+    def test_ecard_round_trip(self):
+        rounds = [
+            {'turn': turn, 'emperor_card': emperor_card, 'slave_card': slave_card}
+            for turn in range(1, CITIZENS + 2)
+            for emperor_card, slave_card in ECARD_OUTCOMES
+        ]
+        data = encode_ecard(rounds)
+        self.assertEqual(len(data), len(rounds))
+        self.assertEqual(decode_ecard(data), rounds)
+
+
+class UserHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice')
+        cls.bob = User.objects.create_user('bob')
+        batch = []
+        for i in range(25):
+            game_type = 'tictactoe' if i % 2 else 'ecard'
+            if i % 5 == 0:
+                batch.append((game_type, BOT_NAME, 'alice', 'alice', b'', 'normal'))
+            elif i % 3 == 0:
+                batch.append((game_type, 'bob', 'alice', 'draw', b'', 'timeout'))
+            else:
+                batch.append((game_type, 'alice', 'bob', 'bob', b'', 'normal'))
+        save_records(batch)
+        # 同じ時刻の対局が続いても id で順序が決まること
+        ids = list(GameRecord.objects.order_by('id').values_list('id', flat=True))
+        GameRecord.objects.filter(id__in=ids[8:16]).update(created_at=GameRecord.objects.get(id=ids[8]).created_at)
+
+    def expected_ids(self, **filters):
+        records = GameRecord.objects.filter(Q(player1=self.alice) | Q(player2=self.alice), **filters)
+        return list(records.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def read_all(self, limit, game_type=None):
+        ids, cursor = [], None
+        while True:
+            games, cursor = user_history(self.alice, cursor, limit, game_type)
+            self.assertLessEqual(len(games), limit)
+            ids.extend(game['id'] for game in games)
+            if cursor is None:
+                return ids
+
+    def test_pages_cover_every_game_once_in_order(self):
+        for limit in (1, 7, 10, 25, 100):
+            self.assertEqual(self.read_all(limit), self.expected_ids())
+        self.assertEqual(self.read_all(4, 'ecard'), self.expected_ids(game_type='ecard'))
+
+    def test_result_and_opponent_from_each_side(self):
+        games = {game['id']: game for game in user_history(self.alice, limit=100)[0]}
+        for record in GameRecord.objects.all():
+            game = games[record.id]
+            if record.player2_id is None:
+                self.assertEqual((game['opponent'], game['result'], game['first']), (None, 'win', False))
+            elif record.is_draw:
+                self.assertEqual((game['opponent'], game['result'], game['end_reason']), ('bob', 'draw', 'timeout'))
+            else:
+                self.assertEqual((game['opponent'], game['result'], game['first']), ('bob', 'loss', True))
+
+    def test_stats_match_records(self):
+        for stats in UserGameStats.objects.filter(user=self.alice):
+            records = GameRecord.objects.filter(Q(player1=self.alice) | Q(player2=self.alice),
+                                                game_type=stats.game_type)
+            self.assertEqual(stats.games, records.count())
+            self.assertEqual(stats.wins, records.filter(winner=self.alice).count())
+            self.assertEqual(stats.draws, records.filter(is_draw=True).count())
+
+
+class Glicko2Tests(SimpleTestCase):
+    def test_glickman_example(self):
+        # Glickman "Example of the Glicko-2 system" の例（τ = 0.5）
+        system = Glicko2(5, tau=0.5)
+        system.mu = (np.array([1500.0, 1400.0, 1550.0, 1700.0, 1500.0]) - DEFAULT_RATING) / SCALE
+        system.phi = np.array([200.0, 30.0, 100.0, 300.0, 200.0]) / SCALE
+        system.rate_period(np.array([0, 0, 0]), np.array([1, 2, 3]), np.array([1.0, 0.0, 0.0]))
+        # 論文の値は途中の μ' を丸めて出しているので 0.05 まで許す
+        self.assertAlmostEqual(system.ratings[0], 1464.06, delta=0.05)
+        self.assertAlmostEqual(system.deviations[0], 151.52, places=2)
+        self.assertAlmostEqual(system.sigma[0], 0.05999, places=4)
+        # 対局のなかったプレイヤーはレートが変わらず RD だけ広がる
+        self.assertAlmostEqual(system.ratings[4], 1500.0)
+        expected_rd = math.sqrt((200.0 / SCALE) ** 2 + DEFAULT_VOLATILITY ** 2) * SCALE
+        self.assertAlmostEqual(system.deviations[4], expected_rd)
+
+    def test_results_move_ratings_symmetrically(self):
+        system = Glicko2(2)
+        system.rate_period(np.array([0]), np.array([1]), np.array([1.0]))
+        self.assertGreater(system.ratings[0], DEFAULT_RATING)
+        self.assertAlmostEqual(system.ratings[0] - DEFAULT_RATING, DEFAULT_RATING - system.ratings[1])
+        self.assertLess(system.deviations[0], DEFAULT_RD)
+
+
+class SnapshotTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'room_snapshot.bin')
+
+    def test_round_trip(self):
+        rooms = {f'room:{i}': {'board': ['X', ' ', 'O'], 'players': {'X': f'user{i}'}, 'seq': i} for i in range(50)}
+        self.assertEqual(SnapshotFile(self.path).save((key, None, value, 60) for key, value in rooms.items()), 50)
+
+        restored = SnapshotFile(self.path)
+        for key, value in rooms.items():
+            found, ttl = restored.lookup(key)
+            self.assertEqual(found, value)
+            self.assertTrue(0 < ttl <= 60)
+        # 一度引いたキーはメモリ側が正しいので、もう復元しない
+        self.assertIsNone(restored.lookup('room:0'))
+        self.assertIsNone(restored.lookup('room:missing'))
+
+    def test_carries_rooms_not_yet_restored(self):
+        SnapshotFile(self.path).save([('room:a', None, {'n': 1}, 60), ('room:b', None, {'n': 2}, 60)])
+        store = SnapshotFile(self.path)
+        self.assertEqual(store.lookup('room:a')[0], {'n': 1})
+        store.touch('room:a')
+        # room:a は削除済み、room:b は一度も引かれていないので引き継ぐ
+        self.assertEqual(store.save([('room:c', None, {'n': 3}, 60)]), 2)
+        restored = SnapshotFile(self.path)
+        self.assertIsNone(restored.lookup('room:a'))
+        self.assertEqual(restored.lookup('room:b')[0], {'n': 2})
+        self.assertEqual(restored.lookup('room:c')[0], {'n': 3})
+
+    def test_expired_and_broken_files(self):
+        write_snapshot(self.path, [('room:old', time.time() - 1, encode_value({'n': 1}))])
+        self.assertIsNone(SnapshotFile(self.path).lookup('room:old'))
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot file')
+        with self.assertLogs('team6.snapshot', 'ERROR'):
+            self.assertIsNone(SnapshotFile(self.path).lookup('room:old'))
+
+
+class TimerWheelTests(SimpleTestCase):
+    async def test_fires_in_order_after_delay(self):
+        wheel = TimerWheel(tick=0.01, slots=8)
+        loop = asyncio.get_running_loop()
+        fired = []
+        start = loop.time()
+        # 1周（0.08秒）を超える期限も、時刻が来た周で切れる
+        def expire(key, delay):
+            fired.append((key, loop.time() - start >= delay))
+
+        for key, delay in (('c', 0.15), ('a', 0.02), ('b', 0.05)):
+            wheel.schedule(key, delay, expire, key, delay)
+        self.assertEqual(len(wheel), 3)
+        await asyncio.sleep(0.3)
+        self.assertEqual(fired, [('a', True), ('b', True), ('c', True)])
+        self.assertEqual(len(wheel), 0)
+
+    async def test_cancel_and_reschedule(self):
+        wheel = TimerWheel(tick=0.01, slots=8)
+        fired = []
+        wheel.schedule('a', 0.02, fired.append, 'a')
+        wheel.schedule('b', 0.02, fired.append, 'b')
+        wheel.cancel('a')
+        wheel.cancel('missing')
+        self.assertNotIn('a', wheel)
+        # 同じキーで設け直すと前の期限は置き換わる
+        wheel.schedule('b', 0.15, fired.append, 'b2')
+        await asyncio.sleep(0.05)
+        self.assertEqual(fired, [])
+        await asyncio.sleep(0.2)
+        self.assertEqual(fired, ['b2'])
+
+    async def test_failing_callback_does_not_stop_others(self):
+        wheel = TimerWheel(tick=0.01, slots=8)
+        fired = []
+        wheel.schedule('bad', 0.01, lambda: 1 / 0)
+        wheel.schedule('good', 0.01, fired.append, 'good')
+        with self.assertLogs('team6.timers', 'ERROR'):
+            await asyncio.sleep(0.05)
+        self.assertEqual(fired, ['good'])
+
+    def test_forfeit_turn_is_required(self):
+        with self.assertRaises(TypeError):
+            type('Consumer', (TurnTimerMixin,), {})
+
+        async def forfeit_turn(self, room, state):
+            pass
+
+        consumer = type('Consumer', (TurnTimerMixin,), {'forfeit_turn': forfeit_turn})
+        self.assertIs(consumer.forfeit_turn, forfeit_turn)
+        self.assertFalse(hasattr(TurnTimerMixin, 'forfeit_turn'))
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        for username, rating in (('alice', 1600), ('bob', 1600), ('carol', 1500), ('dave', MAX_RATING + 50)):
+            User.objects.create_user(username)
+            UserProfile.objects.filter(user__username=username).update(rating=rating)
+        self.board = Leaderboard()
+
+    def test_rank_counts_ties_once(self):
+        self.assertEqual(self.board.rank('dave'), {'rank': 1, 'rating': MAX_RATING + 50, 'total': 4})
+        self.assertEqual(self.board.rank('alice')['rank'], 2)
+        self.assertEqual(self.board.rank('bob')['rank'], 2)
+        self.assertEqual(self.board.rank('carol')['rank'], 4)
+        self.assertIsNone(self.board.rank('nobody'))
+
+    def test_top_orders_by_rating_then_name(self):
+        self.assertEqual([(row['rank'], row['username']) for row in self.board.top(10)],
+                         [(1, 'dave'), (2, 'alice'), (2, 'bob'), (4, 'carol')])
+        # 同じレートの途中で切れても順位は変わらない
+        self.assertEqual([row['username'] for row in self.board.top(2)], ['dave', 'alice'])
+        self.assertEqual(self.board.top(0), [])
+
+    def test_update_many_moves_users_between_buckets(self):
+        self.board.top()
+        self.board.update_many({'carol': 1700, 'bob': 1400})
+        self.assertEqual([(row['rank'], row['username'], row['rating']) for row in self.board.top(10)],
+                         [(1, 'dave', MAX_RATING + 50), (2, 'carol', 1700), (3, 'alice', 1600), (4, 'bob', 1400)])
+        self.assertEqual(self.board.rank('bob'), {'rank': 4, 'rating': 1400, 'total': 4})
+        # 誰もいなくなったレートは残さない
+        self.assertNotIn(1500, self.board._values)
+
+    def test_answers_from_the_database_while_loading(self):
+        expected = [(1, 'dave'), (2, 'alice'), (2, 'bob'), (4, 'carol')]
+        # 別のスレッドが読み込み中（ロックを持っている）
+        with self.board._lock:
+            self.assertEqual([(row['rank'], row['username']) for row in self.board.top(10)], expected)
+            self.assertEqual(self.board.rank('bob'), {'rank': 2, 'rating': 1600, 'total': 4})
+            self.assertFalse(self.board._loaded)
+        self.assertEqual([(row['rank'], row['username']) for row in self.board.top(10)], expected)
+        self.assertTrue(self.board._loaded)
+
+    def test_registered_users_appear_in_top(self):
+        # 登録のフックはプロセスのランキング（leaderboard）に加える
+        leaderboard.reset()
+        self.addCleanup(leaderboard.reset)
+        leaderboard.top()
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.create_user('erin')
+        # rank() を呼ばなくても上位に出る
+        self.assertIn({'rank': 4, 'username': 'erin', 'rating': 1500}, leaderboard.top(10))
+        self.assertEqual(len(leaderboard), 5)
+
+
+class WriteBehindDrainTests(TestCase):
+    def test_drain_writes_results_still_queued(self):
+        User.objects.create_user('alice')
+        User.objects.create_user('bob')
+        queue = WriteBehindQueue(apply_results, interval=60)
+
+        async def finish_game():
+            queue.put(('alice', 'bob', 1.0))
+
+        # 書き込みの間隔より前にイベントループが終わった（プロセスの終了）
+        async_to_sync(finish_game)()
+        self.assertEqual(len(queue), 1)
+        queue.drain()
+        self.assertEqual(len(queue), 0)
+        ratings = dict(UserProfile.objects.values_list('user__username', 'rating'))
+        self.assertEqual(ratings, {'alice': 1516, 'bob': 1484})
+
+    def test_drain_writes_records_still_queued(self):
+        User.objects.create_user('alice')
+
+        async def finish_game():
+            record_game('tictactoe', 'alice', BOT_NAME, 'alice', encode_tictactoe([4, 0, 8]))
+
+        async_to_sync(finish_game)()
+        self.addCleanup(record_queue._items.clear)
+        record_queue.drain()
+        record = GameRecord.objects.get()
+        self.assertEqual((record.player1.username, record.winner.username), ('alice', 'alice'))
+        self.assertEqual(decode_tictactoe(bytes(record.moves)), [4, 0, 8])
+        self.assertEqual(UserGameStats.objects.get(user__username='alice').wins, 1)
+
+    def test_drain_drops_a_failing_batch_and_continues(self):
+        written = []
+
+        def flush(batch):
+            if batch == [1]:
+                raise RuntimeError('boom')
+            written.extend(batch)
+
+        queue = WriteBehindQueue(flush, max_batch=1)
+        queue._items.extend([1, 2])
+        with self.assertLogs('team6.write_behind', 'ERROR'):
+            queue.drain()
+        self.assertEqual((written, len(queue)), ([2], 0))
+
+
+@contextlib.asynccontextmanager
+async def running_broker():
+    """一時ディレクトリのソケットでブローカーを動かし、そのパスを返す"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'broker.sock')
+        server = asyncio.ensure_future(BrokerServer(path).serve_forever())
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        try:
+            yield path
+        finally:
+            # クライアントを先に切り、ブローカー側の接続の処理を終わらせてから止める
+            writer = get_client(path)._writer
+            if writer is not None:
+                writer.close()
+                await asyncio.sleep(0.01)
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+
+class LeaderboardSyncTests(TestCase):
+    async def test_committed_ratings_reach_every_process(self):
+        await sync_to_async(User.objects.create_user)('alice')
+        await sync_to_async(User.objects.create_user)('bob')
+        async with running_broker() as path:
+            with self.settings(TEAM6_BROKER_SOCKET=path):
+                # 2つのプロセスのランキングの代わり（どちらも読み込みの前に購読する）
+                writer, reader = Leaderboard(), Leaderboard()
+                self.assertEqual(len(await sync_to_async(reader.top)()), 2)
+                await sync_to_async(writer.top)()
+                await sync_to_async(writer.publish)({'bob': 1700})
+                self.assertEqual(writer.rank('bob')['rank'], 1)
+                for _ in range(100):
+                    if reader._ratings.get('bob') == 1700:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(await sync_to_async(reader.top)(), [
+                    {'rank': 1, 'username': 'bob', 'rating': 1700},
+                    {'rank': 2, 'username': 'alice', 'rating': 1500},
+                ])
+
+
+class _ResumeConsumer(ResumeMixin):
+    """ResumeMixin だけを持つコンシューマーの代わり（送ったメッセージと切断負けを記録する）"""
+
+    metrics_game = 'tictactoe'
+    delta_mode = True
+
+    def __init__(self, username, query=b''):
+        self.user = SimpleNamespace(username=username)
+        self.scope = {'query_string': query}
+        self.last_seq = None
+        self.sent = []
+        self.forfeits = []
+        self.setup_resume()
+
+    async def send(self, text_data):
+        self.sent.append(json.loads(text_data))
+
+    async def forfeit_away(self, room, state, username):
+        self.forfeits.append((username, dict(state)))
+
+
+class _User:
+    is_authenticated = True
+
+    def __init__(self, username):
+        self.username = username
+
+
+def _communicator(path, username):
+    """ログイン済みのユーザーとしてゲームの WebSocket に接続する"""
+    app = URLRouter(websocket_urlpatterns)
+
+    async def with_user(scope, receive, send):
+        return await app(dict(scope, user=_User(username)), receive, send)
+
+    return WebsocketCommunicator(with_user, path)
+
+
+async def _receive_all(communicator, timeout=0.1):
+    messages = []
+    while not await communicator.receive_nothing(timeout=timeout):
+        messages.append(json.loads(await communicator.receive_from()))
+    return messages
+
+
+def _fold(state, messages):
+    """差分モードのクライアントと同じように、受け取ったスナップショットと差分を状態に反映する"""
+    for message in messages:
+        if message.get('type') == 'delta':
+            assert message['seq'] == state['seq'] + 1, (message['seq'], state['seq'])
+            apply_ops(state, message['ops'])
+            state['seq'] = message['seq']
+        elif 'seq' in message:
+            state.clear()
+            state.update(message)
+    return state
+
+
+class ResumeTests(SimpleTestCase):
+    def test_forfeit_away_is_required(self):
+        with self.assertRaises(TypeError):
+            type('Consumer', (ResumeMixin,), {})
+
+        async def forfeit_away(self, room, state, username):
+            pass
+
+        consumer = type('Consumer', (ResumeMixin,), {'forfeit_away': forfeit_away})
+        self.assertIs(consumer.forfeit_away, forfeit_away)
+        self.assertFalse(hasattr(ResumeMixin, 'forfeit_away'))
+
+    def test_resume_token_and_cursor(self):
+        token = resume_token('game_state_room', 'alice')
+        self.assertEqual(token, resume_token('game_state_room', 'alice'))
+        self.assertNotEqual(token, resume_token('game_state_room', 'bob'))
+        self.assertNotEqual(token, resume_token('game_state_other', 'alice'))
+        self.assertEqual(resume_cursor({'query_string': f'resume={token}&epoch=ab12&seq=7'.encode()}),
+                         (token, 'ab12', 7))
+        for query in (b'', b'resume=&seq=1', f'resume={token}&seq=x'.encode(), f'resume={token}'.encode()):
+            self.assertIsNone(resume_cursor({'query_string': query}))
+
+    async def publish_states(self, room, count):
+        for i in range(count):
+            room.state = {'board': [i], 'turn': i}
+            room.stream.publish(room.state)
+
+    async def test_replays_only_the_missed_deltas(self):
+        room = await rooms.acquire('game_state_resume_replay')
+        self.addCleanup(rooms.release, room)
+        await room.submit(self.publish_states, 5)
+        token = resume_token(room.key, 'alice')
+        consumer = _ResumeConsumer('alice', f'resume={token}&epoch={room.stream.epoch}&seq=3'.encode())
+        await room.submit(consumer.resume_session)
+        self.assertEqual(consumer.sent[0], {
+            'type': 'session', 'token': token, 'epoch': room.stream.epoch, 'grace': resume_grace(),
+        })
+        self.assertEqual([(m['type'], m['seq']) for m in consumer.sent[1:]], [('delta', 4), ('delta', 5)])
+        self.assertEqual(consumer.last_seq, 5)
+
+    async def test_falls_back_to_a_snapshot(self):
+        room = await rooms.acquire('game_state_resume_snapshot')
+        self.addCleanup(rooms.release, room)
+        await room.submit(self.publish_states, REPLAY_SIZE + 5)
+        token = resume_token(room.key, 'alice')
+        cursors = [
+            (token, 'other-epoch', room.stream.seq - 1),                # アクターが作り直された
+            (resume_token(room.key, 'bob'), room.stream.epoch, room.stream.seq - 1),  # 他人のトークン
+            (token, room.stream.epoch, 2),                              # 残っている差分より古い
+        ]
+        for token_, epoch, seq in cursors:
+            consumer = _ResumeConsumer('alice', f'resume={token_}&epoch={epoch}&seq={seq}'.encode())
+            await room.submit(consumer.resume_session)
+            # セッションだけを送り、次の配信でスナップショットを送る
+            self.assertEqual([m['type'] for m in consumer.sent], ['session'])
+            self.assertIsNone(consumer.last_seq)
+
+    async def test_grace_expiry_forfeits_once(self):
+        room = await rooms.acquire('game_state_resume_grace')
+        self.addCleanup(rooms.release, room)
+        consumer = _ResumeConsumer('alice')
+
+        async def leave(room):
+            room.state = {'game_over': False}
+            consumer.mark_away(room, room.state)
+
+        with self.settings(TEAM6_RESUME_GRACE=0.05):
+            await room.submit(leave)
+            self.assertIn('alice', room.state['away'])
+            await asyncio.sleep(0.4)
+        self.assertEqual(consumer.forfeits, [('alice', {'game_over': False})])
+        self.assertNotIn('away', room.state)
+        self.assertFalse(room.has_deadline(timer='away:alice'))
+
+    async def test_return_within_grace_cancels_forfeit(self):
+        room = await rooms.acquire('game_state_resume_return')
+        self.addCleanup(rooms.release, room)
+        consumer = _ResumeConsumer('alice')
+
+        async def leave(room):
+            room.state = {'game_over': False}
+            consumer.mark_away(room, room.state)
+
+        with self.settings(TEAM6_RESUME_GRACE=0.1):
+            await room.submit(leave)
+            await room.submit(consumer.resume_session)
+            await asyncio.sleep(0.3)
+        self.assertEqual(consumer.forfeits, [])
+        self.assertEqual(room.state, {'game_over': False})
+
+    async def test_reconnect_end_to_end(self):
+        path = '/ws/game/resume-e2e/?proto=delta'
+        alice = _communicator(path, 'alice')
+        self.assertTrue((await alice.connect())[0])
+        seen_by_alice = _fold({}, await _receive_all(alice))
+        bob = _communicator(path, 'bob')
+        self.assertTrue((await bob.connect())[0])
+        bob_messages = await _receive_all(bob)
+        session = next(m for m in bob_messages if m['type'] == 'session')
+        seen_by_bob = _fold({}, bob_messages)
+        _fold(seen_by_alice, await _receive_all(alice))
+        players = {'alice': alice, 'bob': bob}
+        await players[seen_by_alice['player_x']].send_to(text_data=json.dumps({'type': 'move', 'position': 4}))
+        _fold(seen_by_alice, await _receive_all(alice))
+        _fold(seen_by_bob, await _receive_all(bob))
+
+        # 対局中に切断してもすぐには負けにならない
+        await bob.disconnect()
+        _fold(seen_by_alice, await _receive_all(alice))
+        self.assertIn('bob', seen_by_alice['away'])
+        self.assertFalse(seen_by_alice['game_over'])
+        if seen_by_alice['player_o'] == 'alice':
+            await alice.send_to(text_data=json.dumps({'type': 'move', 'position': 0}))
+            _fold(seen_by_alice, await _receive_all(alice))
+
+        # 見逃した差分だけを受け取り、つなぎ直した後の状態が一致する
+        query = f"&resume={session['token']}&epoch={session['epoch']}&seq={seen_by_bob['seq']}"
+        bob = _communicator(path + query, 'bob')
+        self.assertTrue((await bob.connect())[0])
+        resumed = await _receive_all(bob)
+        self.assertEqual(resumed[0]['type'], 'session')
+        self.assertEqual({m['type'] for m in resumed[1:]}, {'delta'})
+        _fold(seen_by_bob, resumed)
+        _fold(seen_by_alice, await _receive_all(alice))
+        self.assertNotIn('away', seen_by_alice)
+        self.assertEqual(seen_by_bob, seen_by_alice)
+
+        # 系列が違えばスナップショット
+        stale = _communicator(path + f"&resume={session['token']}&epoch=stale&seq=1", 'bob')
+        self.assertTrue((await stale.connect())[0])
+        self.assertEqual([m['type'] for m in await _receive_all(stale)], ['session', 'game_state'])
+        for communicator in (stale, bob, alice):
+            await communicator.disconnect()
+
+
+class RoomActorTests(SimpleTestCase):
+    async def start_actor(self, key):
+        actor = RoomActor(key)
+        stopped = asyncio.Event()
+        actor.start(lambda actor: stopped.set())
+        self.addCleanup(actor._task.cancel)
+        return actor, stopped
+
+    async def test_concurrent_submits_run_in_order(self):
+        actor, _ = await self.start_actor('game_state_actor_order')
+        seen = []
+
+        async def handler(room, i):
+            # 途中で制御を手放しても、次のイベントは前のイベントが終わってから始まる
+            seen.append(('start', i))
+            await asyncio.sleep(random.random() / 1000)
+            seen.append(('end', i))
+            return i
+
+        results = await asyncio.gather(*(actor.submit(handler, i) for i in range(20)))
+        self.assertEqual(results, list(range(20)))
+        self.assertEqual(seen, [(step, i) for i in range(20) for step in ('start', 'end')])
+
+    async def test_exception_reaches_only_its_own_future(self):
+        actor, _ = await self.start_actor('game_state_actor_error')
+
+        async def fail(room):
+            raise ValueError("bad move")
+
+        async def increment(room):
+            room.state = {'count': (room.state or {'count': 0})['count'] + 1}
+            return room.state['count']
+
+        results = await asyncio.gather(
+            actor.submit(increment), actor.submit(fail), actor.submit(increment), return_exceptions=True)
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 2)
+        self.assertFalse(actor._task.done())
+        self.assertEqual(await actor.submit(increment), 3)
+
+    async def test_checkpoint_writes_to_room_store(self):
+        key = 'game_state_actor_checkpoint'
+        self.addCleanup(async_to_sync(room_store.delete), key)
+        with mock.patch('team6.rooms.CHECKPOINT_INTERVAL', 0.02):
+            actor, _ = await self.start_actor(key)
+
+            async def update(room):
+                room.state = {'board': [1]}
+
+            await actor.submit(update)
+            await asyncio.sleep(0.1)
+            self.assertEqual(await room_store.get(key), {'board': [1]})
+
+            async def remove(room):
+                room.state = None
+
+            await actor.submit(remove)
+            await asyncio.sleep(0.1)
+            self.assertIsNone(await room_store.get(key))
+
+    async def test_idle_stop_checkpoints_first(self):
+        key = 'game_state_actor_idle'
+        self.addCleanup(async_to_sync(room_store.delete), key)
+        with mock.patch('team6.rooms.CHECKPOINT_INTERVAL', 0.02), mock.patch('team6.rooms.IDLE_TIMEOUT', 0.05):
+            actor, stopped = await self.start_actor(key)
+            actor.connections = 1
+
+            async def update(room):
+                room.state = {'board': [2]}
+
+            await actor.submit(update)
+            await asyncio.sleep(0.1)
+            # 接続がある間は止まらない
+            self.assertFalse(stopped.is_set())
+            actor.connections = 0
+            actor._idle_since = time.monotonic()
+            await asyncio.wait_for(stopped.wait(), timeout=1)
+        await asyncio.sleep(0)
+        self.assertTrue(actor._task.done())
+        self.assertEqual(await room_store.get(key), {'board': [2]})
+
+
+class _FakeBacking:
+    """書き込みを記録するバッキングストア（fail が True の間は書き込みに失敗する）"""
+
+    def __init__(self):
+        self.values = {}
+        self.fail = False
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set_many(self, items):
+        if self.fail:
+            raise ConnectionError("backing store is down")
+        self.values.update({key: value for key, (value, ttl) in items.items()})
+
+    async def delete_many(self, keys):
+        if self.fail:
+            raise ConnectionError("backing store is down")
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class RoomStateStoreTests(SimpleTestCase):
+    async def test_stale_compare_and_set_is_rejected(self):
+        store = RoomStateStore()
+        await store.set('room', {'turn': 'X'})
+        _, version = await store.get_versioned('room')
+        self.assertTrue(await store.compare_and_set('room', version, {'turn': 'O'}))
+        self.assertFalse(await store.compare_and_set('room', version, {'turn': 'X'}))
+        self.assertEqual(await store.get('room'), {'turn': 'O'})
+        # 存在しないキーはバージョン0で作れる
+        self.assertFalse(await store.compare_and_set('new', 1, {}))
+        self.assertTrue(await store.compare_and_set('new', 0, {}))
+
+    async def test_versions_stay_monotonic_after_delete_and_recreate(self):
+        store = RoomStateStore()
+        await store.set('room', {'board': 1})
+        _, first = await store.get_versioned('room')
+        await store.delete('room')
+        self.assertEqual(await store.get_versioned('room'), (None, 0))
+        await store.set('room', {'board': 1})
+        _, second = await store.get_versioned('room')
+        self.assertGreater(second, first)
+        self.assertFalse(await store.compare_and_set('room', first, {'board': 2}))
+
+    async def test_entries_expire_after_ttl(self):
+        store = RoomStateStore(ttl=0.05)
+        await store.set('room', {'board': 1})
+        await store.set('long', {'board': 2}, ttl=60)
+        self.assertEqual(await store.get('room'), {'board': 1})
+        await asyncio.sleep(0.1)
+        self.assertIsNone(await store.get('room'))
+        self.assertEqual([key for key, _, _ in store.live_entries()], ['long'])
+
+    async def test_flush_writes_dirty_keys(self):
+        backing = _FakeBacking()
+        backing.values['gone'] = {'old': True}
+        store = RoomStateStore(backing=backing)
+        self.addCleanup(lambda: store._flusher.cancel())
+        await store.set('room', {'board': [1]})
+        await store.delete('gone')
+        await store.flush()
+        self.assertEqual(backing.values, {'room': {'board': [1]}})
+        self.assertEqual(store._dirty, set())
+        # メモリにないキーはバッキングストアから読み込む
+        self.assertEqual(await RoomStateStore(backing=backing).get('room'), {'board': [1]})
+
+    async def test_failed_flush_keeps_keys_dirty(self):
+        backing = _FakeBacking()
+        store = RoomStateStore(backing=backing)
+        self.addCleanup(lambda: store._flusher.cancel())
+        await store.set('room', {'board': [1]})
+        backing.fail = True
+        with self.assertRaises(ConnectionError):
+            await store.flush()
+        self.assertEqual(store._dirty, {'room'})
+        backing.fail = False
+        await store.flush()
+        self.assertEqual(backing.values, {'room': {'board': [1]}})
+
+    async def test_flush_loop_survives_a_failure(self):
+        backing = _FakeBacking()
+        backing.fail = True
+        store = RoomStateStore(backing=backing)
+        with mock.patch('team6.state_store.FLUSH_INTERVAL', 0.01), self.assertLogs('team6.state_store', 'ERROR'):
+            await store.set('room', {'board': [1]})
+            await asyncio.sleep(0.05)
+            backing.fail = False
+            await asyncio.sleep(0.05)
+        self.assertEqual(backing.values, {'room': {'board': [1]}})
+        self.assertEqual(store._dirty, set())
+        await asyncio.sleep(0.02)
+        self.assertTrue(store._flusher.done())
+
+
+class RecomputeRatingsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('alice', 'bob', 'carol', 'dave'):
+            User.objects.create_user(name)
+        save_records([('tictactoe', 'alice', 'bob', 'alice', b'', 'normal')] * 3
+                     + [('ecard', 'carol', 'dave', 'dave', b'', 'normal')])
+        UserProfile.objects.update(rating=1700)
+
+    def ratings(self):
+        return dict(UserProfile.objects.values_list('user__username', 'rating'))
+
+    def test_all_games_rates_everyone(self):
+        call_command('recompute_ratings', stdout=io.StringIO())
+        ratings = self.ratings()
+        self.assertGreater(ratings['alice'], DEFAULT_RATING)
+        self.assertLess(ratings['bob'], DEFAULT_RATING)
+        self.assertGreater(ratings['dave'], DEFAULT_RATING)
+
+    def test_game_only_updates_its_players(self):
+        leaderboard.reset()
+        self.addCleanup(leaderboard.reset)
+        leaderboard.top()
+        call_command('recompute_ratings', game='tictactoe', stdout=io.StringIO())
+        ratings = self.ratings()
+        self.assertGreater(ratings['alice'], DEFAULT_RATING)
+        self.assertLess(ratings['bob'], DEFAULT_RATING)
+        self.assertEqual((ratings['carol'], ratings['dave']), (1700, 1700))
+        # 同じプロセスのランキングは読み直す
+        self.assertEqual(leaderboard.rank('alice')['rating'], ratings['alice'])
+
+
+class BrokerTests(SimpleTestCase):
+    async def connect(self, path):
+        """別のプロセスのクライアントの代わり（このイベントループの get_client とは別の接続）"""
+        client = BrokerClient(path)
+        await client._connect()
+        return client
+
+    async def close(self, *clients):
+        for client in clients:
+            if client._writer is not None:
+                client._writer.close()
+        await asyncio.sleep(0.01)
+
+    async def test_compare_and_set_rejects_stale_versions(self):
+        async with running_broker() as path:
+            client = get_client(path)
+            self.assertTrue(await client.compare_and_set('room', 0, {'turn': 'X'}, 60))
+            value, version = await client.get_versioned('room')
+            self.assertEqual(value, {'turn': 'X'})
+            self.assertFalse(await client.compare_and_set('room', 0, {'turn': 'O'}, 60))
+            self.assertTrue(await client.compare_and_set('room', version, {'turn': 'O'}, 60))
+            self.assertFalse(await client.compare_and_set('room', version, {'turn': 'X'}, 60))
+            # 削除して作り直してもバージョンは戻らない
+            self.assertTrue(await client.compare_and_set('room', version + 1, None, 60))
+            await client.set('room', {'turn': 'X'}, 60)
+            self.assertGreater((await client.get_versioned('room'))[1], version + 1)
+
+    async def test_locks_are_released_when_the_holder_disconnects(self):
+        async with running_broker() as path:
+            holder, waiter = await self.connect(path), await self.connect(path)
+            await holder.call('lock', 'room')
+            waiting = asyncio.ensure_future(waiter.call('lock', 'room'))
+            await asyncio.sleep(0.02)
+            self.assertFalse(waiting.done())
+            await self.close(holder)
+            self.assertTrue(await asyncio.wait_for(waiting, timeout=1))
+            # 次に待っている接続へ渡る
+            third = await self.connect(path)
+            waiting = asyncio.ensure_future(third.call('lock', 'room'))
+            await waiter.call('unlock', 'room')
+            self.assertTrue(await asyncio.wait_for(waiting, timeout=1))
+            await self.close(waiter, third)
+
+    async def test_group_send_reaches_another_process(self):
+        async with running_broker() as path:
+            layer = BrokerChannelLayer(path)
+            other = await self.connect(path)
+            delivered = []
+            other.on_message(lambda channels, message: delivered.append((channels, message)))
+            local = await layer.new_channel()
+            remote = f"{other.prefix}!specific.abc"
+            await layer.group_add('room', local)
+            await other.call('group_add', 'room', remote)
+
+            await layer.group_send('room', {'type': 'game.update', 'n': 1})
+            self.assertEqual(await asyncio.wait_for(layer.receive(local), timeout=1), {'type': 'game.update', 'n': 1})
+            for _ in range(100):
+                if delivered:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(delivered, [([remote], {'type': 'game.update', 'n': 1})])
+
+            # 逆向き（もう一方のプロセスからの group_send）も届く
+            await other.cast('group_send', 'room', {'type': 'game.update', 'n': 2})
+            self.assertEqual(await asyncio.wait_for(layer.receive(local), timeout=1), {'type': 'game.update', 'n': 2})
+            await self.close(other)
+
+    async def test_publish_reaches_subscribers_only(self):
+        async with running_broker() as path:
+            subscriber, publisher = await self.connect(path), await self.connect(path)
+            received = asyncio.Queue()
+            await subscriber.subscribe('topic', received.put_nowait)
+            await subscriber.subscribe('topic', received.put_nowait)
+            await publisher.call('publish', 'other', {'n': 0})
+            await publisher.call('publish', 'topic', {'n': 1})
+            self.assertEqual(await asyncio.wait_for(received.get(), timeout=1), {'n': 1})
+            await asyncio.sleep(0.02)
+            # 同じ関数は1回だけ呼ばれる
+            self.assertTrue(received.empty())
+            await self.close(subscriber, publisher)
+
+
+class _VirtualClockLoop(asyncio.SelectorEventLoop):
+    """時刻をテストから進めるイベントループ（asyncio.sleep の期限は now を進めるまで来ない）"""
+
+    now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class _Watcher:
+    def __init__(self, loop):
+        self.loop = loop
+        self.received = []
+
+    async def send(self, text_data):
+        self.received.append((self.loop.now, text_data))
+
+
+class _FakeLayer:
+    """観戦のリレーが使うチャネルレイヤーの代わり（送った内容を記録し、受け取る内容はキューから渡す）"""
+
+    def __init__(self):
+        self.sent = []
+        self.groups = {}
+        self.inbox = asyncio.Queue()
+
+    async def new_channel(self, prefix='specific'):
+        return f'{prefix}!local'
+
+    async def group_add(self, group, channel):
+        self.groups.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        self.groups.get(group, set()).discard(channel)
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+    async def receive(self, channel):
+        return await self.inbox.get()
+
+
+class SpectatorRelayTests(SimpleTestCase):
+    def run_virtual(self, test):
+        loop = _VirtualClockLoop()
+        try:
+            loop.run_until_complete(test(loop))
+        finally:
+            # リレーのタスクを止めてから閉じる
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    async def advance(self, loop, seconds):
+        loop.now += seconds
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def load(self):
+        return 'frame0'
+
+    def test_updates_are_coalesced_to_the_latest(self):
+        async def test(loop):
+            relay = SpectatorRelay(interval=0.5)
+            watcher = _Watcher(loop)
+            await relay.watch('room', watcher, self.load)
+            # 最初の更新はすぐに送る
+            await relay.publish('room', 'frame1')
+            await self.advance(loop, 0)
+            for i in range(2, 6):
+                await self.advance(loop, 0.1)
+                await relay.publish('room', f'frame{i}')
+            self.assertEqual(watcher.received, [(0.0, 'frame0'), (0.0, 'frame1')])
+            # 間隔が空いたら、それまでの更新のうち最新のものだけを送る
+            await self.advance(loop, 0.1)
+            self.assertEqual(watcher.received[2:], [(0.5, 'frame5')])
+            # 更新がなければ何も送らない
+            await self.advance(loop, 2.0)
+            self.assertEqual(len(watcher.received), 3)
+            await relay.publish('room', 'frame6')
+            await self.advance(loop, 0)
+            self.assertEqual(watcher.received[3:], [(2.5, 'frame6')])
+            # 観戦者のいないルームの更新は残さない
+            await relay.publish('empty', 'frame')
+            self.assertNotIn('empty', relay._latest)
+
+        self.run_virtual(test)
+
+    def test_sends_in_batches(self):
+        async def test(loop):
+            relay = SpectatorRelay(interval=0.5)
+            watchers = [_Watcher(loop) for _ in range(7)]
+            for watcher in watchers:
+                await relay.watch('room', watcher, self.load)
+            with mock.patch('team6.spectators.SEND_BATCH', 3):
+                await relay.publish('room', 'frame1')
+                counts = []
+                for _ in range(4):
+                    await asyncio.sleep(0)
+                    counts.append(sum(len(watcher.received) - 1 for watcher in watchers))
+            # SEND_BATCH 件ごとにイベントループへ処理を返す
+            self.assertEqual(counts, [3, 6, 7, 7])
+
+        self.run_virtual(test)
+
+    def test_shared_mode_relays_through_the_layer(self):
+        async def test(loop):
+            layer = _FakeLayer()
+            relay = SpectatorRelay(interval=0.5)
+            watcher = _Watcher(loop)
+            with self.settings(TEAM6_BROKER_SOCKET='/tmp/unused.sock', TEAM6_ROUTED_WORKER=False), \
+                    mock.patch('team6.spectators.get_channel_layer', return_value=layer):
+                await relay.watch('room', watcher, self.load)
+                self.assertEqual(layer.groups, {'watch_room': {'relay.!local'}})
+                # 観戦者が何人いても、他のプロセスへはルームごとに1件だけ送る
+                await relay.publish('room', 'frame1')
+                self.assertEqual(layer.sent, [('watch_room', {
+                    'type': 'relay.frame', 'group': 'room', 'text': 'frame1', 'origin': 'relay.!local'})])
+                await self.advance(loop, 0)
+                # 自分が送ったものは受け取っても無視し、他のプロセスからのものは観戦者へ送る
+                layer.inbox.put_nowait({'group': 'room', 'text': 'frame1', 'origin': 'relay.!local'})
+                layer.inbox.put_nowait({'group': 'room', 'text': 'frame2', 'origin': 'relay.!other'})
+                await self.advance(loop, 0.5)
+                self.assertEqual([text for _, text in watcher.received], ['frame0', 'frame1', 'frame2'])
+                await relay.unwatch('room', watcher)
+                self.assertEqual(layer.groups, {'watch_room': set()})
+
+        self.run_virtual(test)
+
+
+class _FullLayer:
+    """full のチャネルへの send で ChannelFull を送出するチャネルレイヤーの代わり"""
+
+    def __init__(self, full=()):
+        self.full = set(full)
+        self.sent = []
+
+    async def send(self, channel, message):
+        if channel in self.full:
+            raise ChannelFull(channel)
+        self.sent.append((channel, message))
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class RoomSendTests(SimpleTestCase):
+    async def receive_texts(self, communicator):
+        texts = []
+        while not await communicator.receive_nothing(timeout=0.1):
+            texts.append(await communicator.receive_from())
+        return texts
+
+    async def test_broadcast_is_encoded_once(self):
+        path = '/ws/game/encode-once/'
+        alice, bob = _communicator(path, 'alice'), _communicator(path, 'bob')
+        self.assertTrue((await alice.connect())[0])
+        await self.receive_texts(alice)
+        encoded = []
+
+        def encode(*args):
+            encoded.append(encode_state_frames(*args))
+            return encoded[-1]
+
+        with mock.patch('team6.protocol.encode_state_frames', side_effect=encode):
+            self.assertTrue((await bob.connect())[0])
+            texts = {'alice': await self.receive_texts(alice), 'bob': await self.receive_texts(bob)}
+        # 2人目の入室で始まった対局の状態を1回だけ JSON にし、2人ともその文字列をそのまま受け取る
+        self.assertEqual(len(encoded), 1)
+        self.assertIn(encoded[0]['full'], texts['alice'])
+        self.assertIn(encoded[0]['full'], texts['bob'])
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    async def test_full_channel_falls_back_to_the_group(self):
+        actor = RoomActor('game_state_send_full')
+        actor.start(lambda actor: None)
+        self.addCleanup(actor._task.cancel)
+        await actor.join('alice-channel')
+        await actor.join('bob-channel')
+        layer = _FullLayer(full={'bob-channel'})
+        with self.assertLogs('team6.rooms', 'WARNING'):
+            await actor.send_members(layer, 'room', {'type': 'move', 'n': 1})
+        # 詰まっていないメンバーにはそのまま届く
+        self.assertEqual(layer.sent, [('alice-channel', {'type': 'move', 'n': 1})])
+        # 次からはグループへ送る（受け取られていないチャネルはグループの有効期限で外れる）
+        await actor.send_members(layer, 'room', {'type': 'move', 'n': 2})
+        self.assertEqual(layer.sent[1:], [('room', {'type': 'move', 'n': 2})])
+        # メンバーが変わったら直接送るのに戻す
+        await actor.leave('bob-channel')
+        await actor.send_members(layer, 'room', {'type': 'move', 'n': 3})
+        self.assertEqual(layer.sent[2:], [('alice-channel', {'type': 'move', 'n': 3})])
@@ -0,0 +1,188 @@
+"""
+手番の期限（サーバー側のタイマー）
+
+期限はプロセスに1つのタイマーホイール（TimerWheel）に載せ、ルームごとに asyncio のタスクや
+call_later のハンドルを作らない。ホイールは TICK 秒ごとのスロットを SLOTS 個並べた輪で、
+期限をスロットに入れる・取り消すのは dict の操作だけ（O(1)）。1つのタスクが TICK ごとに起きて
+今のスロットだけを見るので、期限が何件あっても1回の見回りで触るのはその時刻に切れるものだけになる。
+期限が1件もない間はタスクも眠ったまま起きない。
+輪の1周（TICK × SLOTS 秒）より先の期限は同じスロットに残しておき、時刻が来た周で取り出す。
+
+手番の期限は状態にも turn_deadline（UNIX 時刻）として入れる。クライアントはそれで残り時間を表示し、
+期限が切れたときのハンドラーは状態の turn_deadline を見て本当に切れているかを確かめる。
+共有モードで別のプロセスが手番を進めて期限を延ばしていれば、古いタイマーは何もしない。
+"""
+
+import asyncio
+import logging
+import math
+import time
+
+from django.conf import settings
+
+from .metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+TICK = 0.1          # ホイールの1目盛り（秒）。期限はこれだけ遅れて切れうる
+SLOTS = 1024        # ホイールのスロット数（1周 = TICK × SLOTS 秒）
+TURN_TIMEOUT = 20.0  # 手番の持ち時間（秒。settings.TEAM6_TURN_TIMEOUT で変更できる）
+
+turn_timeouts = Counter('team6_turn_timeouts_total', 'Turns forfeited because the deadline passed', ['game'])
+
+
+class TimerWheel:
+    """
+    キーごとに1つの期限を持つタイマーホイール
+
+    Args:
+        tick (float): 1目盛りの長さ（秒）
+        slots (int): スロット数
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]
+        self._due = {}       # キー -> 期限の目盛り（ループの時刻 / tick）
+        self._current = 0    # 次に見るスロットの目盛り
+        self._task = None
+        self._wake = None
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def schedule(self, key, delay, callback, *args):
+        """
+        delay 秒後に callback(*args) を呼ぶ（同じキーの期限があれば置き換える）
+
+        callback はホイールのタスクから同期的に呼ぶので、重い処理や await はタスクに渡すこと
+
+        Args:
+            key: 期限のキー（ルームのストアキーなど）
+            delay (float): 秒
+            callback: 期限が切れたときに呼ぶ関数
+        """
+        loop = self._ensure()
+        self.cancel(key)
+        now = loop.time()
+        if not self._due:
+            # 眠っていた間の目盛りは見回らない
+            self._current = math.floor(now / self.tick)
+        due = max(math.ceil((now + max(0.0, delay)) / self.tick), self._current)
+        self._slots[due % len(self._slots)][key] = (due, callback, args)
+        self._due[key] = due
+        self._wake.set()
+
+    def cancel(self, key):
+        """期限を取り消す（なければ何もしない）"""
+        due = self._due.pop(key, None)
+        if due is not None:
+            del self._slots[due % len(self._slots)][key]
+
+    def _ensure(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            # 別のイベントループに残っていた期限は呼べないので捨てる
+            self._slots = [{} for _ in self._slots]
+            self._due = {}
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        return loop
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._due:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            now = math.floor(loop.time() / self.tick)
+            while self._current <= now and self._due:
+                # 期限切れの処理の中で設けた期限は次の目盛り以降に入る
+                tick = self._current
+                self._current += 1
+                self._expire(tick)
+            await asyncio.sleep(max(0.0, self._current * self.tick - loop.time()))
+
+    def _expire(self, tick):
+        slot = self._slots[tick % len(self._slots)]
+        if not slot:
+            return
+        expired = [key for key, (due, _, _) in slot.items() if due <= tick]
+        for key in expired:
+            _, callback, args = slot.pop(key)
+            del self._due[key]
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("タイマーの処理に失敗しました: %s", key)
+
+
+wheel = TimerWheel()
+
+Gauge('team6_turn_timers', 'Pending turn deadlines in this process', collect=lambda: {(): len(wheel)})
+
+
+def turn_timeout():
+    return getattr(settings, 'TEAM6_TURN_TIMEOUT', TURN_TIMEOUT)
+
+
+class TurnTimerMixin:
+    """
+    コンシューマー用: 手番の期限をサーバーで管理し、切れたら手番のプレイヤーの負けにする
+
+    使う側は turn_of(state) と async forfeit_turn(room, state) を実装し、ルームのアクター内で状態を変えたら
+    sync_turn_timer を呼ぶ（手番が変わったときだけ期限を設け直す）。
+    forfeit_turn は期限が切れたときにルームのアクター内で、state から turn_deadline を消した後に呼ばれる。
+    game_over、winner、end_reason（'timeout'）を書き、対局を記録してから broadcast すること。
+    forfeit_turn を定義していないクラスは定義した時点で TypeError になる（期限が切れてから気づかないように）。
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not callable(getattr(cls, 'forfeit_turn', None)):
+            raise TypeError(f"{cls.__name__} は forfeit_turn を実装してください")
+
+    def turn_of(self, state):
+        """手番を表す値（手番が変わると変わる値。state が None のときや期限を設けない状態なら None）"""
+        return None
+
+    def sync_turn_timer(self, room, state, before):
+        """
+        手番が変わっていれば期限を設け直し、期限のない状態になったら取り消す
+
+        Args:
+            room (RoomActor): ルームのアクター
+            state (dict): 変更後の状態（turn_deadline を書き込む）
+            before: 変更前の turn_of の値
+        """
+        turn = self.turn_of(state)
+        if turn is None:
+            if state:
+                state.pop('turn_deadline', None)
+            room.clear_deadline()
+            return
+        now = time.time()
+        if turn != before or 'turn_deadline' not in state:
+            state['turn_deadline'] = round(now + turn_timeout(), 3)
+        elif room.has_deadline():
+            return
+        # 再起動後に復元したルームや、共有モードで別のプロセスが期限を設けたルームも見張る
+        room.set_deadline(state['turn_deadline'] - now, self._turn_expired)
+
+    async def _turn_expired(self, room):
+        state = room.state
+        deadline = state.get('turn_deadline') if state else None
+        if deadline is None or self.turn_of(state) is None:
+            return
+        remaining = deadline - time.time()
+        if remaining > TICK:
+            # 共有モードで別のプロセスが手番を進めて期限を延ばしていた
+            room.set_deadline(remaining, self._turn_expired)
+            return
+        del state['turn_deadline']
+        turn_timeouts.inc(self.metrics_game)
+        await self.forfeit_turn(room, state)
@@ -16,6 +16,8 @@ urlpatterns = [
     path('login/', auth_views.LoginView.as_view(), name='login'),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('dashboard/', views.dashboard, name='dashboard'),
+    path('history/', views.history_api, name='history_api'),
+    path('leaderboard/', views.leaderboard_api, name='leaderboard_api'),
     path('hb/<str:room_name>/', views.hitandblow_game, name='hitandblow_game'),
     
 ]
\ No newline at end of file
@@ -2,6 +2,16 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import login
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.utils.crypto import constant_time_compare
+
+from . import metrics, profiling
+from .leaderboard import leaderboard
+from .models import GameRecord, UserGameStats
+from .records import HISTORY_LIMIT, user_history
+from .router import METRICS_PROXY_HEADER
 
 # --- 既存のビュー ---
 
@@ -20,8 +30,76 @@ def tictactoe_game(request, room_name="lobby"):
 
 @login_required
 def dashboard(request):
-    """ダッシュボード"""
-    return render(request, 'team6/dashboard.html')
+    """ダッシュボード（成績は UserGameStats を読むだけなので対局数によらず一定の時間で表示できる）"""
+    names = dict(GameRecord.GAME_TYPE_CHOICES)
+    stats = [
+        {'name': names.get(row.game_type, row.game_type), 'row': row}
+        for row in UserGameStats.objects.filter(user=request.user).order_by('game_type')
+    ]
+    # 順位と上位ランキングはメモリ上のランキングから読む（複数プロセス構成でもレートの変更は全プロセスに届く）
+    context = {
+        'stats': stats,
+        'my_rank': leaderboard.rank(request.user.username),
+        'top_players': leaderboard.top(10),
+    }
+    return render(request, 'team6/dashboard.html', context)
+
+@login_required
+def leaderboard_api(request):
+    """ランキング（JSON）。クエリ: limit（上位の人数）"""
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        return JsonResponse({'error': 'invalid parameter'}, status=400)
+    return JsonResponse({
+        'top': leaderboard.top(limit),
+        'me': leaderboard.rank(request.user.username),
+    })
+
+@login_required
+def history_api(request):
+    """
+    対戦履歴（JSON）
+
+    クエリ: cursor（前のページの next_cursor）、limit（件数）、game（ゲームの種類）
+    """
+    try:
+        limit = int(request.GET.get('limit', HISTORY_LIMIT))
+        games, next_cursor = user_history(
+            request.user,
+            cursor=request.GET.get('cursor') or None,
+            limit=limit,
+            game_type=request.GET.get('game') or None,
+        )
+    except ValueError:
+        return JsonResponse({'error': 'invalid parameter'}, status=400)
+    return JsonResponse({'games': games, 'next_cursor': next_cursor})
+
+async def metrics_view(request):
+    """
+    メトリクス（Prometheus のテキスト形式）
+
+    値はイベントループ上で更新しているので、async ビューにしてループ上で書き出す。
+    settings.TEAM6_METRICS_ALLOWED_IPS のアドレスからだけ読める。
+    run_workers のワーカーでは、合言葉（settings.TEAM6_METRICS_PROXY_TOKEN）を付けたプロキシからも読める
+    """
+    token = settings.TEAM6_METRICS_PROXY_TOKEN
+    from_proxy = token and constant_time_compare(request.headers.get(METRICS_PROXY_HEADER, ''), token)
+    if not from_proxy and request.META.get('REMOTE_ADDR') not in settings.TEAM6_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@staff_member_required
+def profile_view(request):
+    """
+    プロファイラー（team6.profiling）の今の集計（スタッフのみ）
+
+    run_workers 構成ではどのワーカーに届くか決まらないので、SIGUSR2 で書き出したファイルを見る
+    """
+    if not profiling.sampler.running and not profiling.sampler.samples:
+        return HttpResponse("profiler is not running (set TEAM6_PROFILE=1 or send SIGUSR2)\n",
+                            content_type='text/plain; charset=utf-8')
+    return HttpResponse(profiling.sampler.report(), content_type='text/plain; charset=utf-8')
 
 
 
@@ -0,0 +1,92 @@
+"""
+ライトビハインド・キュー
+
+対局の終了時などに発生する DB への書き込みをその場では行わず、キューに積んで
+一定間隔ごとにまとめて1回の書き込み処理（1トランザクション）で反映する。
+put はイベントループ上で即座に終わるので、ゲームの進行が DB を待つことはない。
+プロセス終了時に積み残した分は drain で同期的に書き込む（使う側が atexit に登録する）。
+"""
+
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.25  # まとめて書き込む間隔（秒）
+MAX_BATCH = 1000       # 1回の書き込みで扱う最大件数
+MAX_ATTEMPTS = 3       # 書き込みに失敗したバッチを再試行する回数
+
+
+class WriteBehindQueue:
+    """
+    Args:
+        flush: バッチ（リスト）を受け取って DB に書き込む同期関数。スレッドプールで実行する
+        interval (float): 書き込み間隔（秒）
+        max_batch (int): 1回の書き込みで扱う最大件数
+    """
+
+    def __init__(self, flush, interval=FLUSH_INTERVAL, max_batch=MAX_BATCH):
+        self._flush = flush
+        self._flush_batch = database_sync_to_async(flush)
+        self.interval = interval
+        self.max_batch = max_batch
+        self._items = []
+        self._attempts = 0
+        self._worker = None
+        self.flushed = 0  # これまでに書き込んだ件数
+        self.batches = 0  # これまでの書き込み回数
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """書き込む内容をキューに積む（待たない）"""
+        self._items.append(item)
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._items:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """積まれている内容をすぐに書き込む（テスト用。終了時は drain）"""
+        while self._items:
+            batch = self._items[:self.max_batch]
+            del self._items[:self.max_batch]
+            try:
+                await self._flush_batch(batch)
+            except Exception:
+                self._attempts += 1
+                if self._attempts < MAX_ATTEMPTS:
+                    logger.exception("書き込みに失敗しました。次の間隔で再試行します（%d件）", len(batch))
+                    self._items[:0] = batch
+                else:
+                    logger.exception("書き込みに %d 回失敗したため破棄します（%d件）", MAX_ATTEMPTS, len(batch))
+                    self._attempts = 0
+                return
+            self._attempts = 0
+            self.flushed += len(batch)
+            self.batches += 1
+
+    def drain(self):
+        """
+        積まれている内容を同期的に書き込む（プロセス終了時用。イベントループの外から呼ぶ）
+
+        再試行待ちのバッチも積まれた内容に戻してあるので一緒に書き込む。
+        書き込めなかったバッチはログに出して捨てる（終了時なので再試行はしない）
+        """
+        while self._items:
+            batch = self._items[:self.max_batch]
+            del self._items[:self.max_batch]
+            try:
+                self._flush(batch)
+            except Exception:
+                logger.exception("終了時の書き込みに失敗しました（%d件）", len(batch))
+                continue
+            self.flushed += len(batch)
+            self.batches += 1